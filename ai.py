@@ -1,12 +1,81 @@
 import json
 import os
-from openai import OpenAI
 from datetime import datetime, timezone, timedelta
 from zoneinfo import ZoneInfo
 from typing import Optional, Tuple
 import logging
+import time
+
+import metrics
+import llm
+from cache import TTLCache, hash_payload
+from utils import normalize_text
+
+# Deterministic replies used when the LLM misses its deadline
+INTENT_FALLBACK = {
+    "intent": "unknown",
+    "confidence": 0.0,
+    "entities": {},
+    "next_action": "fallback"
+}
+
+AI_RESPONSE_FALLBACK = (
+    "Perdón, estoy tardando más de lo normal en responder 🙏\n"
+    "¿Podrías repetir tu pregunta en un momento?"
+)
+
+# ==========================================================
+# Response cache (analyze_intent / product extraction)
+# Cached paths always run at temperature 0 so a cached answer
+# is the same answer the model would give again.
+# ==========================================================
+LLM_CACHE_MAX_ENTRIES = int(os.getenv("LLM_CACHE_MAX_ENTRIES", "2048"))
+LLM_CACHE_TTL_SECONDS = float(os.getenv("LLM_CACHE_TTL_SECONDS", "21600"))
+
+# Only confident classifications are cached. Intent keys include
+# the (compacted) history the prompt sees: "sí" or "2" mean
+# different things in different conversations.
+INTENT_CACHE_MIN_CONFIDENCE = float(
+    os.getenv("INTENT_CACHE_MIN_CONFIDENCE", "0.9")
+)
+
+intent_cache = TTLCache(LLM_CACHE_MAX_ENTRIES, LLM_CACHE_TTL_SECONDS)
+extraction_cache = TTLCache(LLM_CACHE_MAX_ENTRIES, LLM_CACHE_TTL_SECONDS)
+
+
+def _cache_lookup(cache: TTLCache, name: str, key: str):
+    """
+    Returns the cached result (or None) and updates
+    hit / miss / saved latency counters.
+    """
+    entry = cache.get(key)
+
+    if entry is None:
+        metrics.increment(f"cache.{name}.miss")
+        return None
+
+    result, latency_ms = entry
+    metrics.increment(f"cache.{name}.hit")
+    metrics.increment(f"cache.{name}.saved_ms", latency_ms)
+
+    return result
+
 
-client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
+def _cache_store(cache: TTLCache, key: str, result, started_at: float):
+    latency_ms = round((time.monotonic() - started_at) * 1000, 1)
+    cache.set(key, (result, latency_ms))
+
+
+def _catalog_version() -> str:
+    """
+    Catalog part of the extraction / fused cache keys: the snapshot
+    version, instead of hashing the whole catalog on every call.
+    """
+    # Imported here so prompt_budget.py can render prompts offline
+    # (catalog → db connects to Supabase on import)
+    from catalog import get_catalog_version
+
+    return get_catalog_version()
 
 SYSTEM_PROMPT = """
 You are an intent classification engine for a distributor customer support assistant.
@@ -137,13 +206,14 @@ JSON format:
 }
 """
 # ==========================================================
-# GPT -  Analyze Intent
+# Prompt builders (pure: used by the calls below and by the
+# offline prompt budget check in prompt_budget.py)
 # ==========================================================
-def analyze_intent(
+def build_intent_messages(
     message_text: str,
     context: dict | None = None,
     history: list | None = None
-) -> dict:
+) -> list:
 
     payload = {
         "message": message_text,
@@ -151,48 +221,66 @@ def analyze_intent(
         "recent_conversation": history or []
     }
 
-    response = client.chat.completions.create(
-        model="gpt-4o-mini",
-        temperature=0.2,
-        messages=[
-            {
-                "role": "system",
-                "content": SYSTEM_PROMPT
-            },
-            {
-                "role": "user",
-                "content": json.dumps(payload, ensure_ascii=False)
-            }
-        ]
-    )
-
-    try:
-        return json.loads(response.choices[0].message.content)
-    except json.JSONDecodeError:
-        return {
-            "intent": "unknown",
-            "confidence": 0.0,
-            "entities": {},
-            "next_action": "fallback"
+    return [
+        {
+            "role": "system",
+            "content": SYSTEM_PROMPT
+        },
+        {
+            "role": "user",
+            "content": json.dumps(payload, ensure_ascii=False)
         }
+    ]
+
 
 # ==========================================================
-# GPT - Generate AI Response
+# GPT -  Analyze Intent
 # ==========================================================
-def generate_ai_response(
+def analyze_intent(
+    message_text: str,
+    context: dict | None = None,
+    history: list | None = None
+) -> dict:
+
+    cache_key = "|".join([
+        normalize_text(message_text),
+        hash_payload(context or {}),
+        hash_payload(history or [])
+    ])
+
+    cached = _cache_lookup(intent_cache, "intent", cache_key)
+    if cached is not None:
+        return cached
+
+    started_at = time.monotonic()
+
+    try:
+        response = llm.complete(
+            "intent",
+            model="gpt-4o-mini",
+            temperature=0,
+            messages=build_intent_messages(message_text, context, history)
+        )
+
+        result = json.loads(response.choices[0].message.content)
+
+    except Exception as e:
+        logging.error(f"❌ GPT intent analysis error: {e}")
+        return dict(INTENT_FALLBACK)
+
+    if (result.get("confidence") or 0) >= INTENT_CACHE_MIN_CONFIDENCE:
+        _cache_store(intent_cache, cache_key, result, started_at)
+
+    return result
+
+def build_response_messages(
     base_system_prompt: str,
     user_message: str,
     context_data: str,
-    customer_timezone: str,
-    last_message_time=None,
+    greeting_type: str,
+    time_of_day: str,
     distributor_name: str | None = None
-):
-    """
-    Sends full reasoning task to GPT with dynamic greeting intelligence.
-    """
-
-    greeting_type, time_of_day = build_greeting_context(last_message_time,
-                                                       customer_timezone)
+) -> list:
 
     greeting_context = f"""
 Greeting rules:
@@ -218,18 +306,111 @@ Instructions:
         greeting_context
     ])
 
-    response = client.chat.completions.create(
-        model="gpt-4o-mini",
-        temperature=0.2,
-        messages=[
-            {"role": "system", "content": full_system_prompt},
-            {"role": "system", "content": f"Relevant data:\n{context_data}"},
-            {"role": "user", "content": user_message}
-        ]
-    )
+    return [
+        {"role": "system", "content": full_system_prompt},
+        {"role": "system", "content": f"Relevant data:\n{context_data}"},
+        {"role": "user", "content": user_message}
+    ]
+
+
+def build_price_context(products: list) -> str:
+    """
+    Compact catalog injected for ask_prices responses.
+    """
+    return json.dumps([
+        {
+            "name": p["product"],
+            "sku": p.get("sku"),
+            "price": p["price"]
+        }
+        for p in products
+    ])
+
+
+# ==========================================================
+# GPT - Generate AI Response
+# ==========================================================
+def generate_ai_response(
+    base_system_prompt: str,
+    user_message: str,
+    context_data: str,
+    customer_timezone: str,
+    last_message_time=None,
+    distributor_name: str | None = None
+):
+    """
+    Sends full reasoning task to GPT with dynamic greeting intelligence.
+    """
+
+    greeting_type, time_of_day = build_greeting_context(last_message_time,
+                                                       customer_timezone)
+
+    try:
+        response = llm.complete(
+            "response",
+            model="gpt-4o-mini",
+            temperature=0.2,
+            messages=build_response_messages(
+                base_system_prompt=base_system_prompt,
+                user_message=user_message,
+                context_data=context_data,
+                greeting_type=greeting_type,
+                time_of_day=time_of_day,
+                distributor_name=distributor_name
+            )
+        )
+
+    except Exception as e:
+        logging.error(f"❌ GPT response error: {e}")
+        return AI_RESPONSE_FALLBACK
 
     return response.choices[0].message.content
 
+def generate_ai_response_stream(
+    base_system_prompt: str,
+    user_message: str,
+    context_data: str,
+    customer_timezone: str,
+    last_message_time=None,
+    distributor_name: str | None = None
+):
+    """
+    Same as generate_ai_response but yields the reply as text
+    deltas while it is being generated.
+    """
+
+    greeting_type, time_of_day = build_greeting_context(last_message_time,
+                                                       customer_timezone)
+
+    has_output = False
+
+    try:
+        for delta in llm.stream(
+            "response",
+            model="gpt-4o-mini",
+            temperature=0.2,
+            messages=build_response_messages(
+                base_system_prompt=base_system_prompt,
+                user_message=user_message,
+                context_data=context_data,
+                greeting_type=greeting_type,
+                time_of_day=time_of_day,
+                distributor_name=distributor_name
+            )
+        ):
+            has_output = True
+            yield delta
+
+    except Exception as e:
+        logging.error(f"❌ GPT streamed response error: {e}")
+
+        # Part of the reply may already be on its way to the
+        # customer: the sender decides how to close it
+        if has_output:
+            raise
+
+        yield AI_RESPONSE_FALLBACK
+
 # ==========================================================
 # GPT - Build Greeting Context
 # ==========================================================
@@ -285,14 +466,52 @@ def build_greeting_context(
 
 
 
-def extract_order_products_with_gpt(message_text: str, product_catalog: list):
-    """
-    Uses GPT to extract products from message.
-    Supports:
-    - Multiple products
-    - Misspellings
-    - Ambiguous matches
-    """
+EXTRACTION_RULES = """
+Rules:
+
+1. Default quantity to 1 if not specified.
+2. Interpret numbers written as words (uno, dos, etc).
+3. Only use SKUs from the provided list.
+4. If a product clearly matches ONE SKU → add to "items".
+5. If multiple SKUs could match → add to "ambiguous_items".
+6. If no product matches → ignore it.
+7. "requested_text" is the customer's phrase for the product,
+   without the quantity (e.g. "platino de 500").
+"""
+
+EXTRACTION_FORMAT = """
+{
+  "needs_clarification": boolean,
+  "items": [
+    {
+      "sku": "VALID_SKU",
+      "quantity": number,
+      "requested_text": "original phrase"
+    }
+  ],
+  "ambiguous_items": [
+    {
+      "requested_text": "original phrase",
+      "quantity": number,
+      "possible_matches": [
+        {
+          "sku": "VALID_SKU",
+          "name": "Product Name"
+        }
+      ]
+    }
+  ]
+}
+"""
+
+EMPTY_EXTRACTION = {
+    "needs_clarification": False,
+    "items": [],
+    "ambiguous_items": []
+}
+
+
+def build_extraction_messages(message_text: str, product_catalog: list) -> list:
 
     system_prompt = f"""
 You are a product extraction and SKU matching assistant.
@@ -313,61 +532,176 @@ No extra text.
 AVAILABLE PRODUCTS:
 {json.dumps(product_catalog, ensure_ascii=False)}
 -------------------------
+{EXTRACTION_RULES}
+Response format:
+{EXTRACTION_FORMAT}"""
 
-Rules:
+    return [
+        {"role": "system", "content": system_prompt},
+        {"role": "user", "content": message_text}
+    ]
 
-1. Default quantity to 1 if not specified.
-2. Interpret numbers written as words (uno, dos, etc).
-3. Only use SKUs from the provided list.
-4. If a product clearly matches ONE SKU → add to "items".
-5. If multiple SKUs could match → add to "ambiguous_items".
-6. If no product matches → ignore it.
 
-Response format:
+def extract_order_products_with_gpt(message_text: str, product_catalog: list):
+    """
+    Uses GPT to extract products from message.
+    Supports:
+    - Multiple products
+    - Misspellings
+    - Ambiguous matches
+    """
 
-{{
-  "needs_clarification": boolean,
-  "items": [
-    {{
-      "sku": "VALID_SKU",
-      "quantity": number
-    }}
-  ],
-  "ambiguous_items": [
-    {{
-      "requested_text": "original phrase",
-      "possible_matches": [
-        {{
-          "sku": "VALID_SKU",
-          "name": "Product Name"
-        }}
-      ]
-    }}
-  ]
-}}
-"""
+    extraction, _ = extract_order_products_with_usage(
+        message_text,
+        product_catalog
+    )
+
+    return extraction
+
+
+def extract_order_products_with_usage(
+    message_text: str,
+    product_catalog: list
+) -> Tuple[dict, int]:
+    """
+    Same as extract_order_products_with_gpt but also returns the
+    total tokens consumed (used by speculative extraction metrics).
+
+    Results are cached per normalized message and catalog version;
+    cache hits report 0 tokens.
+    """
+
+    cache_key = (
+        f"{normalize_text(message_text)}|{_catalog_version()}"
+    )
+
+    cached = _cache_lookup(extraction_cache, "extraction", cache_key)
+    if cached is not None:
+        return cached, 0
+
+    started_at = time.monotonic()
+
+    total_tokens = 0
 
     try:
-        response = client.chat.completions.create(
+        response = llm.complete(
+            "extraction",
             model="gpt-4o-mini",
             temperature=0,
-            messages=[
-                {"role": "system", "content": system_prompt},
-                {"role": "user", "content": message_text}
-            ]
+            messages=build_extraction_messages(message_text, product_catalog)
         )
 
+        if response.usage:
+            total_tokens = response.usage.total_tokens
+
         content = response.choices[0].message.content.strip()
 
         logging.info("🤖 Raw GPT extraction response:")
         logging.info(content)
 
-        return json.loads(content)
+        extraction = json.loads(content)
+        _cache_store(extraction_cache, cache_key, extraction, started_at)
+
+        return extraction, total_tokens
 
     except Exception as e:
         logging.error(f"❌ GPT extraction error: {e}")
+        return dict(EMPTY_EXTRACTION), total_tokens
+
+
+def build_fused_messages(
+    message_text: str,
+    product_catalog: list,
+    context: dict | None = None,
+    history: list | None = None
+) -> list:
+
+    system_prompt = f"""{SYSTEM_PROMPT}
+--------------------------------------
+PRODUCT EXTRACTION
+--------------------------------------
+
+If the intent is place_order, add_to_cart or modify_cart you must ALSO
+extract the products mentioned in the message and match them ONLY to
+valid SKUs from the catalog below. NEVER invent SKUs.
+For any other intent return an empty extraction.
+
+AVAILABLE PRODUCTS:
+{json.dumps(product_catalog, ensure_ascii=False)}
+{EXTRACTION_RULES}
+Add the extraction to the JSON response under the key "extraction":
+{EXTRACTION_FORMAT}"""
+
+    messages = build_intent_messages(message_text, context, history)
+    messages[0] = {"role": "system", "content": system_prompt}
+
+    return messages
+
+
+# ==========================================================
+# GPT - Fused Intent + Product Extraction (cart messages)
+# ==========================================================
+def analyze_intent_with_products(
+    message_text: str,
+    product_catalog: list,
+    context: dict | None = None,
+    history: list | None = None
+) -> dict:
+    """
+    Classifies intent AND extracts cart products in a single call.
+
+    Used when the message looks like a cart operation, so the
+    order handlers can consume the extraction instead of making
+    a second round-trip.
+
+    Returns the analyze_intent format plus an "extraction" key
+    in the extract_order_products_with_gpt format.
+    """
+
+    cache_key = "|".join([
+        normalize_text(message_text),
+        hash_payload(context or {}),
+        hash_payload(history or []),
+        _catalog_version()
+    ])
+
+    cached = _cache_lookup(intent_cache, "fused", cache_key)
+    if cached is not None:
+        return cached
+
+    started_at = time.monotonic()
+
+    try:
+        response = llm.complete(
+            "fused",
+            model="gpt-4o-mini",
+            temperature=0,
+            response_format={"type": "json_object"},
+            messages=build_fused_messages(
+                message_text,
+                product_catalog,
+                context,
+                history
+            )
+        )
+
+        result = json.loads(response.choices[0].message.content)
+
+    except Exception as e:
+        logging.error(f"❌ GPT fused intent extraction error: {e}")
         return {
-            "needs_clarification": False,
-            "items": [],
-            "ambiguous_items": []
+            **INTENT_FALLBACK,
+            "extraction": dict(EMPTY_EXTRACTION)
         }
+
+    extraction = result.get("extraction") or {}
+    result["extraction"] = {
+        "needs_clarification": bool(extraction.get("needs_clarification")),
+        "items": extraction.get("items") or [],
+        "ambiguous_items": extraction.get("ambiguous_items") or []
+    }
+
+    if (result.get("confidence") or 0) >= INTENT_CACHE_MIN_CONFIDENCE:
+        _cache_store(intent_cache, cache_key, result, started_at)
+
+    return result
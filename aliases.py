@@ -0,0 +1,211 @@
+import logging
+import math
+import os
+import re
+import threading
+from datetime import datetime, timezone
+
+from utils import normalize_text
+from order_parser import strip_fillers
+from db import (
+    get_product_aliases,
+    upsert_product_alias,
+    delete_product_aliases
+)
+
+# ==========================================================
+# Learned phrase → SKU aliases
+#
+# Every successful extraction maps a customer phrase
+# ("el platino de 500") to a SKU. We keep those mappings so
+# repeat orders resolve locally without a model call.
+# ==========================================================
+
+# Confidence assigned to a phrase learned from a GPT extraction.
+# Below ALIAS_MIN_CONFIDENCE on purpose: a phrase must be resolved
+# twice to the same SKU before it skips the LLM.
+EXTRACTED_CONFIDENCE = 0.7
+
+# Reinforcement never takes an alias above this
+MAX_CONFIDENCE = 1.0
+
+# Each repeat of the same resolution reinforces the alias
+REINFORCEMENT_STEP = 0.1
+
+# Minimum (decayed) confidence required to skip the LLM
+ALIAS_MIN_CONFIDENCE = float(os.getenv("ALIAS_MIN_CONFIDENCE", "0.75"))
+
+# Confidence halves every ALIAS_HALF_LIFE_DAYS without use
+ALIAS_HALF_LIFE_DAYS = float(os.getenv("ALIAS_HALF_LIFE_DAYS", "60"))
+
+LEADING_ARTICLES = {"el", "la", "los", "las", "un", "una", "unos", "unas"}
+
+
+_lock = threading.Lock()
+_aliases = None
+
+
+# ==========================================================
+# Phrase normalization
+# ==========================================================
+def normalize_alias_phrase(text: str) -> str:
+    """
+    Normalizes a product phrase for alias lookup:
+    accents/case removed, punctuation stripped, cart verbs
+    and leading articles dropped.
+    """
+    text = normalize_text(text)
+    text = re.sub(r"[^\w\s\-\.]", " ", text)
+
+    words = strip_fillers(text.split())
+
+    while words and words[0] in LEADING_ARTICLES:
+        words = words[1:]
+
+    return " ".join(words)
+
+
+# ==========================================================
+# Store
+# ==========================================================
+def _load_aliases() -> dict:
+    global _aliases
+
+    with _lock:
+        if _aliases is not None:
+            return _aliases
+
+        aliases = {}
+
+        for row in get_product_aliases():
+            last_seen = row.get("last_seen_at")
+            aliases[row["phrase"]] = {
+                "sku": row["sku"],
+                "confidence": float(row.get("confidence") or 0),
+                "hits": int(row.get("hits") or 0),
+                "last_seen_at": (
+                    datetime.fromisoformat(last_seen.replace("Z", "+00:00"))
+                    if last_seen else datetime.now(timezone.utc)
+                )
+            }
+
+        _aliases = aliases
+        logging.info(f"📚 Loaded {len(aliases)} product aliases")
+
+        return _aliases
+
+
+def _effective_confidence(alias: dict, now: datetime) -> float:
+    age_days = (now - alias["last_seen_at"]).total_seconds() / 86400
+    decay = math.pow(0.5, max(age_days, 0) / ALIAS_HALF_LIFE_DAYS)
+    return alias["confidence"] * decay
+
+
+def record_alias(phrase: str, sku: str):
+    """
+    Records a phrase → SKU resolution.
+    - repeated resolutions reinforce the alias
+    - a different SKU for the same phrase replaces it
+    """
+    phrase = normalize_alias_phrase(phrase)
+
+    if not phrase or not sku:
+        return
+
+    aliases = _load_aliases()
+    now = datetime.now(timezone.utc)
+
+    with _lock:
+        alias = aliases.get(phrase)
+
+        if alias and alias["sku"] == sku:
+            confidence = min(
+                MAX_CONFIDENCE,
+                _effective_confidence(alias, now) + REINFORCEMENT_STEP
+            )
+        else:
+            confidence = EXTRACTED_CONFIDENCE
+
+        hits = alias["hits"] + 1 if alias and alias["sku"] == sku else 1
+
+        aliases[phrase] = {
+            "sku": sku,
+            "confidence": confidence,
+            "hits": hits,
+            "last_seen_at": now
+        }
+
+    upsert_product_alias({
+        "phrase": phrase,
+        "sku": sku,
+        "confidence": round(confidence, 4),
+        "hits": hits,
+        "last_seen_at": now.isoformat()
+    })
+
+
+def learn_from_extraction(extraction: dict, is_ambiguous=None):
+    """
+    Records every clearly matched item of an extraction.
+    Ambiguous items are NOT learned, and neither are phrases for
+    which is_ambiguous(phrase) is true (e.g. a product family
+    without its size): the pick made for one customer must not
+    become the answer for everyone.
+    """
+    for item in extraction.get("items", []):
+        requested_text = item.get("requested_text")
+
+        if not requested_text or not item.get("sku"):
+            continue
+
+        if is_ambiguous and is_ambiguous(requested_text):
+            continue
+
+        record_alias(requested_text, item["sku"])
+
+
+def invalidate_skus(valid_skus: set):
+    """
+    Drops aliases pointing at SKUs no longer in the catalog.
+    """
+    aliases = _load_aliases()
+
+    with _lock:
+        stale = [
+            phrase for phrase, alias in aliases.items()
+            if alias["sku"] not in valid_skus
+        ]
+
+        for phrase in stale:
+            del aliases[phrase]
+
+    if stale:
+        logging.info(f"🧹 Invalidated {len(stale)} aliases (discontinued SKUs)")
+        delete_product_aliases(stale)
+
+
+# ==========================================================
+# Local resolver
+# ==========================================================
+def resolve_alias(phrase: str, valid_skus: set) -> str | None:
+    """
+    Returns the SKU for a phrase when the alias is confident
+    enough and the SKU is still in the catalog.
+    """
+    phrase = normalize_alias_phrase(phrase)
+    aliases = _load_aliases()
+
+    with _lock:
+        alias = aliases.get(phrase)
+
+    if not alias:
+        return None
+
+    if alias["sku"] not in valid_skus:
+        invalidate_skus(valid_skus)
+        return None
+
+    if _effective_confidence(alias, datetime.now(timezone.utc)) < ALIAS_MIN_CONFIDENCE:
+        return None
+
+    return alias["sku"]
@@ -0,0 +1,162 @@
+"""
+Promotion engine micro-benchmark.
+
+Evaluates synthetic promotion sets (category / line / product
+percentages, buy-X-get-Y, bundles, some capped) against random carts
+with the unified engine (promotions.evaluate_cart), and reports the
+discount a stacking evaluator would have given for comparison.
+
+    python bench_promotions.py [promotions] [cart sizes...]
+    # default: 300 promotions, carts of 5 20 100 500 lines
+"""
+import random
+import sys
+import time
+
+from promotions import build_promotion_index, compile_promotions, evaluate_cart
+
+DEFAULT_PROMOTIONS = 300
+DEFAULT_CART_SIZES = [5, 20, 100, 500]
+
+CATALOG_SIZE = 5000
+CATEGORIES = 60
+PRODUCT_LINES = 15
+CARTS_PER_SIZE = 20
+
+
+def synthetic_catalog(rng: random.Random) -> list:
+    return [
+        {
+            "sku": f"SKU-{i}",
+            "category_id": f"CAT-{rng.randrange(CATEGORIES)}",
+            "line_id": f"LINE-{rng.randrange(PRODUCT_LINES)}",
+            "unit_price": round(rng.uniform(20, 900), 2)
+        }
+        for i in range(CATALOG_SIZE)
+    ]
+
+
+def synthetic_promotions(rng: random.Random, count: int, catalog: list) -> list:
+    skus = [product["sku"] for product in catalog]
+    promotions = []
+
+    for i in range(count):
+        kind = rng.choice(["category", "line", "product", "buy_x_get_y", "bundle"])
+
+        promo = {
+            "promotion_id": f"PROMO-{i}",
+            "name": f"Promo {i}",
+            "priority_weight": rng.randint(0, 100),
+            "is_active": True,
+            "reward": {"type": "percentage", "value": rng.choice([5, 10, 15, 20, 50, 100])}
+        }
+
+        if rng.random() < 0.3:
+            promo["max_discount_cap"] = rng.choice([100, 250, 500])
+
+        if kind == "category":
+            promo["rules"] = {"scope": "category", "category_ids": [f"CAT-{rng.randrange(CATEGORIES)}"]}
+        elif kind == "line":
+            promo["rules"] = {"scope": "line", "line_ids": [f"LINE-{rng.randrange(PRODUCT_LINES)}"]}
+        elif kind == "product":
+            promo["rules"] = {"scope": "product", "product_skus": rng.sample(skus, 20)}
+        elif kind == "buy_x_get_y":
+            promo["promotion_type"] = "buy_x_get_y"
+            promo["rules"] = {
+                "scope": "product_group",
+                "product_skus": rng.sample(skus, 40),
+                "buy_quantity": rng.randint(1, 3),
+                "reward_quantity": 1
+            }
+        else:
+            promo["promotion_type"] = "bundle"
+            promo["rules"] = {
+                "trigger_products": rng.sample(skus, 10),
+                "reward_products": rng.sample(skus, 10)
+            }
+
+        promotions.append(promo)
+
+    return promotions
+
+
+def synthetic_cart(rng: random.Random, catalog: list, size: int) -> list:
+    cart = []
+
+    for product in rng.sample(catalog, size):
+        quantity = rng.randint(1, 6)
+        cart.append({
+            **product,
+            "quantity": quantity,
+            "line_subtotal": round(product["unit_price"] * quantity, 2)
+        })
+
+    return cart
+
+
+def stacked_discount(cart: list, index: dict) -> float:
+    """
+    Upper bound of the old stacking display: every eligible
+    percentage promotion on every line, uncapped.
+    """
+    total = 0.0
+
+    for line in cart:
+        positions = (
+            index["by_sku"].get(line["sku"], frozenset())
+            | index["by_category"].get(line["category_id"], frozenset())
+            | index["by_line"].get(line["line_id"], frozenset())
+        )
+        for position in positions:
+            rule = index["rules"][position]
+            if rule.kind == "percentage":
+                total += line["line_subtotal"] * rule.reward_factor
+
+    return total
+
+
+def main(promotion_count: int, cart_sizes: list) -> int:
+    rng = random.Random(42)
+
+    catalog = synthetic_catalog(rng)
+    rows = synthetic_promotions(rng, promotion_count, catalog)
+
+    started_at = time.perf_counter()
+    index = build_promotion_index(compile_promotions(rows))
+    build_ms = (time.perf_counter() - started_at) * 1000
+
+    print(f"{promotion_count} promotions compiled + indexed in {build_ms:.1f} ms")
+    print(
+        f"{'lines':>6} {'avg ms':>8} {'max ms':>8} {'applied':>8} "
+        f"{'discount':>10} {'stacked':>10}"
+    )
+
+    for size in cart_sizes:
+        timings = []
+        applied = 0
+        discount = 0.0
+        stacked = 0.0
+
+        for _ in range(CARTS_PER_SIZE):
+            cart = synthetic_cart(rng, catalog, size)
+
+            started_at = time.perf_counter()
+            result = evaluate_cart(cart, index)
+            timings.append((time.perf_counter() - started_at) * 1000)
+
+            applied += len(result["applied"])
+            discount += result["total_discount"]
+            stacked += stacked_discount(cart, index)
+
+        print(
+            f"{size:>6} {sum(timings) / len(timings):>8.2f} {max(timings):>8.2f} "
+            f"{applied / CARTS_PER_SIZE:>8.1f} {discount / CARTS_PER_SIZE:>10.2f} "
+            f"{stacked / CARTS_PER_SIZE:>10.2f}"
+        )
+
+    return 0
+
+
+if __name__ == "__main__":
+    args = [int(arg) for arg in sys.argv[1:]]
+    sys.exit(main(args[0] if args else DEFAULT_PROMOTIONS, args[1:] or DEFAULT_CART_SIZES))
@@ -0,0 +1,111 @@
+"""
+Catalog search micro-benchmark.
+
+Compares the per-query linear scan (normalize_text + SequenceMatcher
+on every product name) with the precomputed search index
+(find_matches) and the vectorized top-k scorer (search), on
+synthetic catalogs grown from fixtures/catalog.json.
+
+    python bench_search.py [sizes...]     # default: 500 5000 50000
+"""
+import json
+import os
+import sys
+import time
+from difflib import SequenceMatcher
+
+from search import build_search_index, find_matches, search
+from utils import normalize_text
+
+FIXTURE_CATALOG = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)),
+    "fixtures",
+    "catalog.json"
+)
+
+DEFAULT_SIZES = [500, 5000, 50000]
+
+QUERIES = [
+    "Shampoo Argán Avyna 500 ml Serie 3",  # exact
+    "mascarilla keratina",                  # partial
+    "shampo argan avyna 250 ml serie 1",    # typo (fuzzy)
+    "tinte rubio cenizo",                   # no match
+]
+
+
+def linear_matches(query: str, products: list) -> list:
+    """
+    The original flows matcher: normalizes and scores every name.
+    """
+    normalized_query = normalize_text(query)
+    matches = []
+    fuzzy_matches = []
+
+    for product in products:
+        name = normalize_text(product["product"])
+
+        if normalized_query == name:
+            return [product]
+
+        if normalized_query in name:
+            matches.append(product)
+            continue
+
+        if SequenceMatcher(None, normalized_query, name).ratio() > 0.75:
+            fuzzy_matches.append(product)
+
+    return matches or fuzzy_matches
+
+
+def synthetic_catalog(base: list, size: int) -> list:
+    return [
+        {
+            **base[i % len(base)],
+            "sku": f"{base[i % len(base)]['sku']}-{i // len(base)}",
+            "product": f"{base[i % len(base)]['product']} Serie {i // len(base)}"
+        }
+        for i in range(size)
+    ]
+
+
+def time_ms(fn, repeat: int) -> float:
+    started_at = time.perf_counter()
+    for _ in range(repeat):
+        fn()
+    return (time.perf_counter() - started_at) * 1000 / repeat
+
+
+def main(sizes: list) -> int:
+    with open(FIXTURE_CATALOG, encoding="utf-8") as f:
+        base = json.load(f)
+
+    print(
+        f"{'products':>9} {'build ms':>9}  {'query':<38} "
+        f"{'linear ms':>10} {'index ms':>9} {'top-5 ms':>9} {'matches':>8}"
+    )
+
+    for size in sizes:
+        products = synthetic_catalog(base, size)
+
+        started_at = time.perf_counter()
+        index = build_search_index(products, version=str(size))
+        build_ms = (time.perf_counter() - started_at) * 1000
+
+        linear_repeat = max(1, 5000 // size)
+
+        for query in QUERIES:
+            linear_ms = time_ms(lambda: linear_matches(query, products), linear_repeat)
+            index_ms = time_ms(lambda: find_matches(index, query), 20)
+            top_k_ms = time_ms(lambda: search(index, query, k=5), 20)
+            matches = len(find_matches(index, query))
+
+            print(
+                f"{size:>9} {build_ms:>9.1f}  {query[:38]:<38} "
+                f"{linear_ms:>10.2f} {index_ms:>9.3f} {top_k_ms:>9.3f} {matches:>8}"
+            )
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main([int(size) for size in sys.argv[1:]] or DEFAULT_SIZES))
@@ -0,0 +1,72 @@
+import copy
+import hashlib
+import json
+import threading
+import time
+from collections import OrderedDict
+
+
+# ==========================================================
+# Payload hashing (cache keys / catalog versions)
+# ==========================================================
+def hash_payload(payload) -> str:
+    """
+    Stable short hash of any JSON-serializable payload.
+    """
+    raw = json.dumps(payload, sort_keys=True, ensure_ascii=False, default=str)
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()[:16]
+
+
+# ==========================================================
+# Bounded LRU + TTL cache
+# ==========================================================
+class TTLCache:
+    """
+    Thread-safe LRU cache with per-entry expiration.
+
+    Values are deep-copied on read so callers can mutate
+    the returned dicts without corrupting the cache
+    (copy_values=False for values treated as read-only).
+    """
+
+    def __init__(self, max_entries: int = 1024, ttl_seconds: float = 3600, copy_values: bool = True):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self._copy = copy.deepcopy if copy_values else (lambda value: value)
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+
+            if entry is None:
+                return None
+
+            value, expires_at = entry
+
+            if expires_at < time.monotonic():
+                del self._entries[key]
+                return None
+
+            self._entries.move_to_end(key)
+            return self._copy(value)
+
+    def set(self, key, value):
+        with self._lock:
+            self._entries[key] = (
+                self._copy(value),
+                time.monotonic() + self.ttl_seconds
+            )
+            self._entries.move_to_end(key)
+
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        with self._lock:
+            return len(self._entries)
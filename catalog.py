@@ -0,0 +1,74 @@
+import logging
+import os
+import threading
+import time
+
+import metrics
+from cache import hash_payload
+from db import get_all_products
+
+# ==========================================================
+# In-memory product catalog
+#
+# Price questions, cart parsing and prompt builders all read
+# the same snapshot instead of refetching the products table
+# on every message. The snapshot is refreshed after
+# CATALOG_TTL_SECONDS and carries a version (content hash) so
+# derived structures can be rebuilt only when it changes.
+# ==========================================================
+
+CATALOG_TTL_SECONDS = float(os.getenv("CATALOG_TTL_SECONDS", "300"))
+
+_lock = threading.Lock()
+_snapshot = None
+_loaded_at = 0.0
+
+
+def _load() -> dict:
+    products = get_all_products()
+
+    return {
+        "products": products,
+        "by_sku": {product["sku"]: product for product in products},
+        "version": hash_payload(products)
+    }
+
+
+def get_catalog() -> dict:
+    """
+    Returns { "products": [...], "by_sku": {...}, "version": str }.
+    A failed refresh keeps serving the previous snapshot.
+    """
+    global _snapshot, _loaded_at
+
+    with _lock:
+        if _snapshot is not None and time.monotonic() - _loaded_at < CATALOG_TTL_SECONDS:
+            metrics.increment("catalog.hit")
+            return _snapshot
+
+        metrics.increment("catalog.miss")
+
+        snapshot = _load()
+
+        if snapshot["products"] or _snapshot is None:
+            if _snapshot and _snapshot["version"] != snapshot["version"]:
+                logging.info(f"📦 Catalog updated to version {snapshot['version']}")
+            _snapshot = snapshot
+        else:
+            logging.warning("⚠️ Empty catalog refresh, keeping previous snapshot")
+
+        _loaded_at = time.monotonic()
+
+        return _snapshot
+
+
+def get_products() -> list:
+    return get_catalog()["products"]
+
+
+def get_catalog_product(sku: str) -> dict | None:
+    return get_catalog()["by_sku"].get(sku)
+
+
+def get_catalog_version() -> str:
+    return get_catalog()["version"]
@@ -0,0 +1,219 @@
+"""
+Buy-X-get-Y equivalence check.
+
+allocate_cheapest_units (and so evaluate_cart) works on
+(unit_price, quantity) runs. This script checks it against the
+straightforward reference it replaced: expand every line into one
+entry per unit, stable-sort by price and discount the first reward
+units. Random carts (tied prices, zero quantities, large
+quantities) and random buy/reward/percent/cap rules; exits with
+status 1 on the first mismatch.
+
+    python check_promotion_units.py [carts] [seed]
+    # default: 3000 carts, seed 42
+"""
+import random
+import sys
+from decimal import Decimal
+
+from pricing import from_cents, to_cents
+from promotions import (
+    allocate_cheapest_units,
+    build_promotion_index,
+    compile_promotions,
+    evaluate_cart
+)
+
+DEFAULT_CARTS = 3000
+DEFAULT_SEED = 42
+
+SKU_POOL = 12
+MAX_LINES = 8
+MAX_QUANTITY = 40
+
+# Few distinct prices so ties are common
+PRICES = [9.99, 12.5, 12.5, 35.0, 49.9, 120.0, 0.35]
+
+
+# ==========================================================
+# Expanded-unit reference
+# ==========================================================
+def reference_allocation(runs: list, reward_units: int) -> list:
+    """
+    [(key, unit_price, units)] from one entry per unit, merging
+    consecutive units of the same key.
+    """
+    units = [(unit_price, key) for unit_price, quantity, key in runs for _ in range(quantity)]
+    units.sort(key=lambda unit: unit[0])
+
+    allocations = []
+
+    for unit_price, key in units[:reward_units]:
+        if allocations and allocations[-1][0] == key:
+            allocations[-1] = (key, unit_price, allocations[-1][2] + 1)
+        else:
+            allocations.append((key, unit_price, 1))
+
+    return allocations
+
+
+def reference_discounts(lines: list, promo: dict) -> list:
+    """
+    Uncapped discount per line of one buy_x_get_y promotion,
+    exact (Decimal): half-cent totals are not at the mercy of
+    float summation order.
+    """
+    rules = promo["rules"]
+    factor = Decimal(str(promo["reward"]["value"])) / 100
+
+    units = []
+
+    for i, line in enumerate(lines):
+        if line["sku"] in rules["product_skus"]:
+            units.extend([(line["unit_price"], i)] * line["quantity"])
+
+    units.sort(key=lambda unit: unit[0])
+
+    group = rules["buy_quantity"] + rules["reward_quantity"]
+    reward_units = (len(units) // group) * rules["reward_quantity"]
+
+    discounts = [Decimal(0)] * len(lines)
+
+    for unit_price, i in units[:reward_units]:
+        discounts[i] += Decimal(str(unit_price)) * factor
+
+    return discounts
+
+
+# ==========================================================
+# Random cases
+# ==========================================================
+def random_cart(rng: random.Random) -> list:
+    return [
+        {
+            "sku": f"SKU-{rng.randrange(SKU_POOL)}",
+            "category_id": "CAT-1",
+            "line_id": "LINE-1",
+            "quantity": rng.choice([0, 1, 1, 2, 3, rng.randint(4, MAX_QUANTITY)]),
+            "unit_price": rng.choice(PRICES)
+        }
+        for _ in range(rng.randint(1, MAX_LINES))
+    ]
+
+
+def random_promotion(rng: random.Random) -> dict:
+    promo = {
+        "promotion_id": "PROMO-BXGY",
+        "name": "Promo BXGY",
+        "promotion_type": "buy_x_get_y",
+        "priority_weight": 1,
+        "is_active": True,
+        "reward": {"type": "percentage", "value": rng.choice([10, 25, 50, 100])},
+        "rules": {
+            "scope": "product_group",
+            "product_skus": rng.sample([f"SKU-{i}" for i in range(SKU_POOL)], rng.randint(1, SKU_POOL)),
+            "buy_quantity": rng.randint(1, 4),
+            "reward_quantity": rng.randint(1, 3)
+        }
+    }
+
+    if rng.random() < 0.3:
+        promo["max_discount_cap"] = rng.choice([5, 20, 100])
+
+    return promo
+
+
+# ==========================================================
+# Checks
+# ==========================================================
+def check_allocation(lines: list, reward_units: int) -> str | None:
+    runs = [(line["unit_price"], line["quantity"], i) for i, line in enumerate(lines)]
+
+    expected = reference_allocation(runs, reward_units)
+    actual = allocate_cheapest_units(runs, reward_units)
+
+    if actual != expected:
+        return f"allocate_cheapest_units({runs}, {reward_units}) = {actual}, expected {expected}"
+
+    return None
+
+
+def check_evaluation(lines: list, promo: dict) -> str | None:
+    """
+    With a single promotion every eligible line takes it, so
+    evaluate_cart must give the reference discounts: the total
+    to the cent (capped), each line within its rounding cent
+    except the one line that takes the rounding residual, and the
+    lines adding up to the total. An exact half-cent total may
+    land on either cent (the engine multiplies floats).
+    """
+    index = build_promotion_index(compile_promotions([promo]))
+    result = evaluate_cart(lines, index)
+
+    discounts = reference_discounts(lines, promo)
+    raw_total = sum(discounts)
+    total = raw_total
+
+    if promo.get("max_discount_cap"):
+        total = min(total, Decimal(str(promo["max_discount_cap"])))
+
+    expected_cents = {to_cents(total)}
+
+    if (total * 100) % 1 == Decimal("0.5"):
+        expected_cents.add(to_cents(total) - 1)
+
+    if to_cents(result["total_discount"]) not in expected_cents:
+        return f"total {result['total_discount']} != {from_cents(to_cents(total))}"
+
+    line_cents = [to_cents(allocation["discount_amount"]) for allocation in result["lines"]]
+
+    if sum(line_cents) != to_cents(result["total_discount"]):
+        return f"lines add up to {from_cents(sum(line_cents))}, total {result['total_discount']}"
+
+    scale = total / raw_total if raw_total else Decimal(0)
+
+    off = [
+        i for i, cents in enumerate(line_cents)
+        if abs(cents - discounts[i] * scale * 100) > 1
+    ]
+
+    # Only the residual line may be more than a cent away
+    if len(off) > 1:
+        return "lines " + ", ".join(
+            f"{i}: {from_cents(line_cents[i])} != {float(discounts[i] * scale):.4f}"
+            for i in off
+        )
+
+    return None
+
+
+def main(carts: int, seed: int) -> int:
+    rng = random.Random(seed)
+
+    for case in range(carts):
+        lines = random_cart(rng)
+        promo = random_promotion(rng)
+
+        total_units = sum(line["quantity"] for line in lines)
+
+        error = (
+            check_allocation(lines, rng.randint(0, total_units + 2))
+            or check_evaluation(lines, promo)
+        )
+
+        if error:
+            print(f"MISMATCH case {case} (seed {seed}): {error}")
+            print(f"  lines: {lines}")
+            print(f"  promotion: {promo}")
+            return 1
+
+    print(f"OK {carts} carts (seed {seed})")
+    return 0
+
+
+if __name__ == "__main__":
+    args = [int(arg) for arg in sys.argv[1:]]
+    sys.exit(main(
+        args[0] if args else DEFAULT_CARTS,
+        args[1] if len(args) > 1 else DEFAULT_SEED
+    ))
@@ -0,0 +1,200 @@
+import re
+
+from utils import normalize_text
+from order_parser import content_tokens
+
+# ==========================================================
+# Numbered clarification state
+#
+# When an extraction returns ambiguous_items the options are
+# numbered and stored in conversation_state.context under
+# "pending_clarification". The customer's follow-up ("la 2",
+# "el de 500", "AVY-ARG-SHP-500") is then resolved here,
+# without intent analysis nor a catalog extraction.
+#
+# pending_clarification:
+# {
+#     "groups": [
+#         {
+#             "requested_text": "shampoo argan",
+#             "quantity": 2,
+#             "options": [{ "number": 1, "sku": str, "name": str }]
+#         }
+#     ]
+# }
+# ==========================================================
+
+ORDINAL_WORDS = {
+    "primera": 1, "primero": 1, "segunda": 2, "segundo": 2,
+    "tercera": 3, "tercero": 3, "cuarta": 4, "cuarto": 4,
+    "quinta": 5, "quinto": 5, "sexta": 6, "sexto": 6,
+}
+
+# Words allowed around option numbers ("la 2", "opción 1 y 3")
+REFERENCE_WORDS = {
+    "la", "el", "las", "los", "opcion", "numero", "num", "no", "y",
+    "quiero", "dame", "mejor", "esa", "ese", "porfa", "por", "favor",
+}
+
+
+def build_pending_clarification(ambiguous_items: list) -> dict:
+    """
+    Numbers every option continuously across ambiguous groups.
+    """
+    groups = []
+    number = 1
+
+    for item in ambiguous_items:
+        options = []
+
+        for match in item.get("possible_matches", []):
+            options.append({
+                "number": number,
+                "sku": match["sku"],
+                "name": match.get("name") or match["sku"]
+            })
+            number += 1
+
+        if options:
+            groups.append({
+                "requested_text": item.get("requested_text", ""),
+                "quantity": item.get("quantity") or 1,
+                "options": options
+            })
+
+    return {"groups": groups}
+
+
+def format_clarification_question(pending: dict) -> str:
+    reply = "Necesito un poco más de información 👇\n\n"
+
+    for group in pending["groups"]:
+        reply += f"Para *{group['requested_text']}* tengo estas opciones:\n"
+        for option in group["options"]:
+            reply += f"{option['number']}. {option['name']} ({option['sku']})\n"
+        reply += "\n"
+
+    reply += "¿Cuál prefieres? Responde con el número (ej. *la 1*)."
+
+    return reply
+
+
+def _option_numbers(text: str) -> list | None:
+    """
+    "la 2" → [2], "opción 1 y 3" → [1, 3], "la segunda" → [2].
+    None when the reply contains anything besides option references.
+    """
+    words = re.sub(r"[^\w\s]", " ", text).split()
+    numbers = []
+
+    for word in words:
+        if word.isdigit():
+            numbers.append(int(word))
+        elif word in ORDINAL_WORDS:
+            numbers.append(ORDINAL_WORDS[word])
+        elif word not in REFERENCE_WORDS:
+            return None
+
+    return numbers or None
+
+
+def _match_option(text: str, options: list) -> dict | None:
+    """
+    Unique option matched by SKU or by name tokens ("el de 500").
+    """
+    for option in options:
+        if option["sku"].lower() in text:
+            return option
+
+    tokens = content_tokens(text) - REFERENCE_WORDS
+
+    if not tokens:
+        return None
+
+    matches = [
+        option for option in options
+        if tokens <= content_tokens(option["name"]) | {option["sku"].lower()}
+    ]
+
+    return matches[0] if len(matches) == 1 else None
+
+
+def resolve_clarification_reply(message_text: str, pending: dict):
+    """
+    Maps a follow-up reply to SKUs of the pending options.
+
+    Returns (items, remaining_groups) or None when the reply does
+    not pick any option (the customer moved on).
+    """
+    groups = (pending or {}).get("groups") or []
+
+    if not groups:
+        return None
+
+    text = normalize_text(message_text)
+    picked = {}
+
+    numbers = _option_numbers(text)
+
+    by_number = {
+        option["number"]: (index, option)
+        for index, group in enumerate(groups)
+        for option in group["options"]
+    }
+
+    # "500" is a size, not option 500: fall back to name matching
+    if numbers and all(number in by_number for number in numbers):
+        for number in numbers:
+            index, option = by_number[number]
+            picked[index] = option
+
+    else:
+        for index, group in enumerate(groups):
+            option = _match_option(text, group["options"])
+            if option:
+                picked[index] = option
+
+        # "el de 250" matching several groups is still ambiguous,
+        # unless every pick was an explicit SKU
+        explicit = all(
+            option["sku"].lower() in text for option in picked.values()
+        )
+        if len(picked) > 1 and not explicit:
+            return None
+
+    if not picked:
+        return None
+
+    items = [
+        {
+            "sku": option["sku"],
+            "quantity": groups[index]["quantity"],
+            "requested_text": groups[index]["requested_text"]
+        }
+        for index, option in picked.items()
+    ]
+
+    remaining = [
+        group for index, group in enumerate(groups)
+        if index not in picked
+    ]
+
+    return items, remaining
+
+
+def groups_to_ambiguous_items(groups: list) -> list:
+    """
+    Converts unresolved groups back to the extraction format so
+    the handler asks about them again.
+    """
+    return [
+        {
+            "requested_text": group["requested_text"],
+            "quantity": group["quantity"],
+            "possible_matches": [
+                {"sku": option["sku"], "name": option["name"]}
+                for option in group["options"]
+            ]
+        }
+        for group in groups
+    ]
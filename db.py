@@ -4,6 +4,8 @@ from supabase import create_client
 from datetime import datetime, timezone, timedelta, date
 from typing import List, Dict
 
+from pricing import from_cents, price_lines, to_cents, totals
+
 
 # ==========================================================
 # Supabase
@@ -112,6 +114,26 @@ def upsert_conversation_state(
         return None
 
 
+# ==========================================================
+# SupaBase – Update only the Conversation Context
+# ==========================================================
+def update_conversation_context(customer_id: str, context: dict):
+    try:
+        response = (
+            supabase
+            .table("conversation_state")
+            .update({"context": context or {}})
+            .eq("customer_id", customer_id)
+            .execute()
+        )
+
+        return response.data
+
+    except Exception as e:
+        logging.exception("Error updating conversation context")
+        return None
+
+
 # ==========================================================
 # SupaBase – Lookup Product by SKU or Name
 # ==========================================================
@@ -321,7 +343,7 @@ def upsert_draft_line(draft_order_id: str, sku: str, quantity: int):
 
     product = product_resp.data[0]
     unit_price = float(product["price"])
-    line_subtotal = unit_price * quantity
+    line_subtotal = from_cents(to_cents(unit_price) * quantity)
 
     # 2️⃣ Check if line exists
     line_resp = (
@@ -339,7 +361,7 @@ def upsert_draft_line(draft_order_id: str, sku: str, quantity: int):
         # Update existing line
         existing_line = line_resp.data[0]
         new_quantity = existing_line["quantity"] + quantity
-        new_subtotal = unit_price * new_quantity
+        new_subtotal = from_cents(to_cents(unit_price) * new_quantity)
 
         update_resp = (
             supabase.table("draft_order_lines")
@@ -378,19 +400,21 @@ def upsert_draft_line(draft_order_id: str, sku: str, quantity: int):
         return insert_resp.data[0]
 
 
-def update_draft_order_totals(draft_order_id: str):
-    lines = get_draft_order_lines(draft_order_id)
-
-    subtotal = sum(float(line["line_subtotal"]) for line in lines)
-    discount_total = sum(float(line["discount_amount"]) for line in lines)
-    final_total = sum(float(line["final_line_total"]) for line in lines)
+def update_draft_order_totals(draft_order_id: str, lines: list | None = None, priced: dict | None = None):
+    """
+    Header totals from the pricing kernel (integer cents).
+    priced: pricing.price_cart result when the caller already has it;
+    otherwise the stored lines (given or fetched) are priced.
+    """
+    if priced is None:
+        if lines is None:
+            lines = get_draft_order_lines(draft_order_id)
+        priced = price_lines(lines)
 
     response = (
         supabase.table("draft_orders")
         .update({
-            "subtotal": subtotal,
-            "discount_total": discount_total,
-            "final_total": final_total,
+            **totals(priced),
             "updated_at": datetime.utcnow().isoformat()
         })
         .eq("draft_order_id", draft_order_id)
@@ -451,6 +475,80 @@ def convert_draft_to_order(draft_order_id: str):
 
     return order
 
+# ==========================================================
+# Order history pages (keyset pagination)
+# ==========================================================
+def get_orders_page(since: str, until: str, after_order_id: str | None = None, limit: int = 500):
+    """
+    Next page of orders created in [since, until), ordered by
+    order_id and starting after after_order_id (keyset, no OFFSET).
+    """
+    query = (
+        supabase.table("orders")
+        .select("order_id, customer_id, created_at")
+        .gte("created_at", since)
+        .lt("created_at", until)
+    )
+
+    if after_order_id is not None:
+        query = query.gt("order_id", after_order_id)
+
+    response = query.order("order_id").limit(limit).execute()
+
+    return response.data or []
+
+
+# Order ids per order_lines query (keeps the in_() URL short)
+ORDER_LINES_ID_BATCH = 100
+
+# Rows per request, under PostgREST's max-rows (1000 by default)
+ORDER_LINES_PAGE_SIZE = 1000
+
+
+def get_order_lines_for_orders(order_ids: list):
+    """
+    Lines of a page of orders: order ids in batches, each batch
+    read in .range() pages until its exact row count is reached,
+    so a server-side row cap can never truncate it silently.
+    """
+    lines = []
+
+    for start in range(0, len(order_ids), ORDER_LINES_ID_BATCH):
+        batch = order_ids[start:start + ORDER_LINES_ID_BATCH]
+        batch_lines = []
+        expected = None
+
+        while expected is None or len(batch_lines) < expected:
+            response = (
+                supabase.table("order_lines")
+                .select(
+                    "order_id, product_id, sku, quantity, unit_price, discount_amount",
+                    count="exact"
+                )
+                .in_("order_id", batch)
+                .order("order_id")
+                .order("product_id")
+                .range(len(batch_lines), len(batch_lines) + ORDER_LINES_PAGE_SIZE - 1)
+                .execute()
+            )
+
+            expected = response.count or 0
+            rows = response.data or []
+
+            if not rows:
+                break
+
+            batch_lines.extend(rows)
+
+        if len(batch_lines) != expected:
+            raise RuntimeError(
+                f"order_lines read incomplete: {len(batch_lines)} of {expected} rows"
+            )
+
+        lines.extend(batch_lines)
+
+    return lines
+
 # ==========================================================
 # Conversation History Management
 # ==========================================================
@@ -556,7 +654,7 @@ def remove_draft_line_quantity(draft_order_id: str, sku: str, quantity: int):
 
     else:
         unit_price = float(line["unit_price"])
-        new_subtotal = unit_price * new_quantity
+        new_subtotal = from_cents(to_cents(unit_price) * new_quantity)
 
         supabase.table("draft_order_lines")\
             .update({
@@ -586,6 +684,122 @@ def delete_draft_line(draft_order_id: str, sku: str):
 
     return True
 
+# ==========================================================
+# Set Draft Order Line Quantity
+# ==========================================================
+def set_draft_line_quantity(draft_order_id: str, sku: str, quantity: int, unit_price: float):
+    """
+    Sets the absolute quantity of a draft line in a single write.
+    unit_price is the line's stored price (from the cart summary).
+    """
+
+    line_subtotal = from_cents(to_cents(unit_price) * quantity)
+
+    response = (
+        supabase.table("draft_order_lines")
+        .update({
+            "quantity": quantity,
+            "line_subtotal": line_subtotal,
+            "final_line_total": line_subtotal,
+            "updated_at": datetime.utcnow().isoformat()
+        })
+        .eq("draft_order_id", draft_order_id)
+        .eq("sku", sku)
+        .execute()
+    )
+
+    return response.data[0] if response.data else None
+
+
+# ==========================================================
+# Draft Order Line Promotions (pricing columns only)
+#
+# One round trip for all changed lines, through this function:
+#
+#   create or replace function update_draft_line_allocations(allocations jsonb)
+#   returns table (draft_order_line_id uuid)
+#   language sql as $$
+#     update draft_order_lines l
+#     set applied_promotion_id = a.applied_promotion_id,
+#         discount_amount      = a.discount_amount,
+#         line_subtotal        = a.line_subtotal,
+#         final_line_total     = a.final_line_total,
+#         updated_at           = now()
+#     from jsonb_to_recordset(allocations) as a(
+#         draft_order_line_id uuid,
+#         quantity integer,
+#         applied_promotion_id uuid,
+#         discount_amount numeric,
+#         line_subtotal numeric,
+#         final_line_total numeric
+#     )
+#     where l.draft_order_line_id = a.draft_order_line_id
+#       and l.quantity = a.quantity
+#     returning l.draft_order_line_id;
+#   $$;
+# ==========================================================
+def save_draft_line_allocations(lines: list):
+    """
+    Writes the pricing columns (applied_promotion_id,
+    discount_amount, line_subtotal, final_line_total) of the lines
+    whose allocation changed, in a single UPDATE.
+
+    Never an upsert: a line deleted meanwhile is not re-inserted,
+    and the quantity is never written. A line is only updated
+    while it still has the quantity it was priced with; if a
+    concurrent message changed it, that message's own reprice
+    writes the right values.
+
+    lines: draft_order_lines rows with the new values.
+    Returns the ids of the updated lines, None if the write failed.
+    """
+    allocations = [
+        {
+            "draft_order_line_id": line["draft_order_line_id"],
+            "quantity": line["quantity"],
+            "applied_promotion_id": line["applied_promotion_id"],
+            "discount_amount": line["discount_amount"],
+            "line_subtotal": line["line_subtotal"],
+            "final_line_total": line["final_line_total"]
+        }
+        for line in lines
+    ]
+
+    try:
+        response = supabase.rpc(
+            "update_draft_line_allocations",
+            {"allocations": allocations}
+        ).execute()
+
+        return response.data or []
+
+    except Exception as e:
+        logging.exception("Error saving draft line allocations")
+        return None
+
+
+# ==========================================================
+# Draft Order Cart Summary (materialized on cart changes)
+# ==========================================================
+def save_draft_cart_summary(draft_order_id: str, line_index: dict, cart_summary: dict):
+    """
+    One write with the rendered summary and its numbering:
+    line_index:   { "1": { "sku": str, "unit_price": float }, ... }
+    cart_summary: { "message", "cart_version", "promotion_version" }
+    """
+    try:
+        supabase.table("draft_orders")\
+            .update({
+                "line_index": line_index,
+                "cart_summary": cart_summary
+            })\
+            .eq("draft_order_id", draft_order_id)\
+            .execute()
+
+    except Exception as e:
+        logging.exception("Error saving draft cart summary")
+
+
 # ==========================================================
 # Pending Customer Message
 # ==========================================================
@@ -648,3 +862,62 @@ def get_products_by_ids(product_ids: list):
         logging.warning("No products found for IDs: %s", unique_ids)
 
     return response.data or []
+
+
+# ==========================================================
+# Product Aliases (learned phrase → SKU resolutions)
+# ==========================================================
+def get_product_aliases():
+    """
+    Returns all learned phrase → SKU aliases.
+    """
+    try:
+        response = (
+            supabase.table("product_aliases")
+            .select("phrase, sku, confidence, hits, last_seen_at")
+            .execute()
+        )
+
+        return response.data or []
+
+    except Exception:
+        logging.exception("Error fetching product aliases")
+        return []
+
+
+def upsert_product_alias(alias: dict):
+    """
+    Inserts or updates an alias row keyed by phrase.
+    """
+    try:
+        response = (
+            supabase.table("product_aliases")
+            .upsert(alias, on_conflict="phrase")
+            .execute()
+        )
+
+        return response.data
+
+    except Exception:
+        logging.exception("Error saving product alias")
+        return None
+
+
+def delete_product_aliases(phrases: list):
+    """
+    Deletes aliases by phrase (e.g. discontinued SKUs).
+    """
+    if not phrases:
+        return None
+
+    try:
+        return (
+            supabase.table("product_aliases")
+            .delete()
+            .in_("phrase", phrases)
+            .execute()
+        ).data
+
+    except Exception:
+        logging.exception("Error deleting product aliases")
+        return None
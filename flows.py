@@ -1,15 +1,82 @@
-from db import get_all_products
-from utils import normalize_text
-from difflib import SequenceMatcher
+from search import get_search_index, find_matches
+from presentations import resolve_presentation
+
+# More matches than this is not a "presentations" answer:
+# the question is too broad and goes to the LLM
+PRICE_MAX_PRESENTATIONS = 8
+
 
 # ==========================================================
-# Fuzzy similarity helper
+# Price matcher
 # ==========================================================
-def similarity(a: str, b: str) -> float:
+def find_price_matches(product_name: str) -> list:
+    """
+    Intelligent matching over the precomputed catalog index
+    - Product family + size ("shampoo argan de 500")
+    - Accent insensitive
+    - Exact / partial match
+    - Fuzzy match (trigram candidates only)
+    """
+    index = get_search_index()
+
+    family, presentation = resolve_presentation(index["families"], product_name)
+
+    if presentation:
+        return [presentation["product"]]
+
+    if family:
+        return [p["product"] for p in family["presentations"]]
+
+    return find_matches(index, product_name)
+
+
+def format_price_reply(matches: list) -> str:
+    # ------------------------------------------------------
+    # Single match
+    # ------------------------------------------------------
+    if len(matches) == 1:
+        product = matches[0]
+
+        return (
+            f"El precio de *{product['product']}* es "
+            f"${product['price']} MXN 💰\n\n"
+            "¿Te gustaría agregarlo a tu pedido?"
+        )
+
+    # ------------------------------------------------------
+    # Multiple presentations
+    # Example:
+    # Shampoo Avyna 250ml
+    # Shampoo Avyna 500ml
+    # Shampoo Avyna 1L
+    # ------------------------------------------------------
+    response_lines = ["Encontré varias presentaciones:\n"]
+
+    for product in matches:
+        response_lines.append(
+            f"• *{product['product']}* — ${product['price']} MXN"
+        )
+
+    response_lines.append("\n¿Cuál presentación te interesa?")
+
+    return "\n".join(response_lines)
+
+
+def answer_price_question(product_name: str | None) -> str | None:
     """
-    Returns similarity score between 0 and 1.
+    Deterministic ask_prices answer from the in-memory catalog.
+    Returns None when there is no confident match, so the caller
+    escalates to the LLM.
     """
-    return SequenceMatcher(None, a, b).ratio()
+    if not product_name:
+        return None
+
+    matches = find_price_matches(product_name)
+
+    if not matches or len(matches) > PRICE_MAX_PRESENTATIONS:
+        return None
+
+    return format_price_reply(matches)
 
 
 def handle_intent(intent_data: dict, state: dict | None) -> str:
@@ -26,78 +93,15 @@ def handle_intent(intent_data: dict, state: dict | None) -> str:
         if not product_name:
             return "Claro 😊 ¿De qué producto necesitas el precio?"
 
-        # ------------------------------------------------------
-        # STEP 1 – Normalize user input
-        # ------------------------------------------------------
-        normalized_input = normalize_text(product_name)
-
-        # ------------------------------------------------------
-        # STEP 2 – Fetch product catalog
-        # ------------------------------------------------------
-        products = get_all_products()
-
-        matches = []
-
-        # ------------------------------------------------------
-        # STEP 3 – Intelligent matching
-        # - Accent insensitive
-        # - Partial match
-        # - Fuzzy match
-        # ------------------------------------------------------
-        for product in products:
-
-            db_name = product.get("product", "")
-            normalized_db_name = normalize_text(db_name)
-
-            # Direct containment match
-            if normalized_input in normalized_db_name:
-                matches.append(product)
-                continue
-
-            # Fuzzy similarity match
-            score = similarity(normalized_input, normalized_db_name)
+        matches = find_price_matches(product_name)
 
-            if score > 0.75:  # You can tune this threshold
-                matches.append(product)
-
-        # ------------------------------------------------------
-        # STEP 4 – No matches
-        # ------------------------------------------------------
         if not matches:
             return (
                 f"No encontré el producto '{product_name}'. "
                 "¿Podrías confirmar el nombre?"
             )
 
-        # ------------------------------------------------------
-        # STEP 5 – Single match
-        # ------------------------------------------------------
-        if len(matches) == 1:
-            product = matches[0]
-
-            return (
-                f"El precio de *{product['product']}* es "
-                f"${product['price']} MXN 💰\n\n"
-                "¿Te gustaría agregarlo a tu pedido?"
-            )
-
-        # ------------------------------------------------------
-        # STEP 6 – Multiple presentations
-        # Example:
-        # Shampoo Avyna 250ml
-        # Shampoo Avyna 500ml
-        # Shampoo Avyna 1L
-        # ------------------------------------------------------
-        response_lines = ["Encontré varias presentaciones:\n"]
-
-        for product in matches:
-            response_lines.append(
-                f"• *{product['product']}* — ${product['price']} MXN"
-            )
-
-        response_lines.append("\n¿Cuál presentación te interesa?")
-
-        return "\n".join(response_lines)
+        return format_price_reply(matches)
 
         
     if intent == "ask_promotions":
@@ -0,0 +1,135 @@
+import json
+import os
+import re
+
+from utils import estimate_tokens
+
+# ==========================================================
+# Conversation history compaction
+#
+# Bot replies carry whole cart summaries and price lists, so
+# raw history often dwarfs the actual question. Before it goes
+# into analyze_intent the history is compacted:
+# 1. bot cart summaries → compact structured stand-ins
+# 2. long turns truncated
+# 3. oldest turns dropped until under the token budget
+# The most recent user turns are always kept verbatim.
+# ==========================================================
+
+HISTORY_TOKEN_BUDGET = int(os.getenv("HISTORY_TOKEN_BUDGET", "400"))
+
+# Max tokens of a single (non protected) turn
+HISTORY_MAX_TURN_TOKENS = int(os.getenv("HISTORY_MAX_TURN_TOKENS", "80"))
+
+# Most recent user turns never truncated nor dropped
+HISTORY_KEEP_USER_TURNS = int(os.getenv("HISTORY_KEEP_USER_TURNS", "2"))
+
+CART_SUMMARY_MARKER = "Tu pedido actual"
+
+CART_LINE_PATTERN = re.compile(r"^(?:\d+\. )?\d+x \*", re.MULTILINE)
+
+CART_TOTAL_PATTERN = re.compile(r"\*Total: \$([\d,]+(?:\.\d+)?)\*")
+
+
+# ==========================================================
+# Cart summary stand-ins
+# ==========================================================
+def is_cart_summary(content: str) -> bool:
+    return bool(content) and CART_SUMMARY_MARKER in content
+
+
+def has_cart_summary(history: list) -> bool:
+    return any(
+        turn["role"] == "assistant" and is_cart_summary(turn["content"])
+        for turn in history
+    )
+
+
+def summarize_cart_message(content: str, cart_id: str | None = None) -> str:
+    """
+    Replaces a format_cart_summary() reply by a compact stand-in:
+    {"cart_summary": {"cart_id": ..., "lines": 3, "total": 1234.5}}
+    """
+    total_match = CART_TOTAL_PATTERN.search(content)
+
+    summary = {
+        "cart_id": cart_id,
+        "lines": len(CART_LINE_PATTERN.findall(content)),
+        "total": (
+            float(total_match.group(1).replace(",", ""))
+            if total_match else None
+        )
+    }
+
+    return json.dumps({"cart_summary": summary})
+
+
+def history_tokens(history: list) -> int:
+    return sum(estimate_tokens(turn["content"]) for turn in history)
+
+
+def _truncate(content: str, max_tokens: int) -> str:
+    if estimate_tokens(content) <= max_tokens:
+        return content
+
+    return content[:max_tokens * 4].rstrip() + "…"
+
+
+# ==========================================================
+# Compactor
+# ==========================================================
+def compact_history(
+    history: list,
+    max_tokens: int = HISTORY_TOKEN_BUDGET,
+    cart_id: str | None = None
+) -> list:
+    """
+    Returns a copy of history ([{role, content}], chronological)
+    that fits in max_tokens.
+    """
+    if not history:
+        return []
+
+    # Indexes of the most recent user turns (kept verbatim)
+    user_indexes = [
+        index for index, turn in enumerate(history)
+        if turn["role"] == "user"
+    ]
+    protected = set(user_indexes[-HISTORY_KEEP_USER_TURNS:])
+
+    compacted = []
+
+    for index, turn in enumerate(history):
+        content = turn["content"] or ""
+
+        if index not in protected:
+            if turn["role"] == "assistant" and is_cart_summary(content):
+                content = summarize_cart_message(content, cart_id)
+            else:
+                content = _truncate(content, HISTORY_MAX_TURN_TOKENS)
+
+        compacted.append({
+            "role": turn["role"],
+            "content": content,
+            "protected": index in protected
+        })
+
+    # Drop the oldest unprotected turns until under budget
+    total = history_tokens(compacted)
+
+    while total > max_tokens:
+        oldest = next(
+            (i for i, turn in enumerate(compacted) if not turn["protected"]),
+            None
+        )
+
+        if oldest is None:
+            break
+
+        total -= estimate_tokens(compacted[oldest]["content"])
+        del compacted[oldest]
+
+    return [
+        {"role": turn["role"], "content": turn["content"]}
+        for turn in compacted
+    ]
@@ -0,0 +1,347 @@
+import asyncio
+import contextvars
+import logging
+import os
+import queue
+import threading
+import time
+
+from openai import (
+    AsyncOpenAI,
+    RateLimitError,
+    InternalServerError,
+    APIConnectionError
+)
+
+import metrics
+
+# ==========================================================
+# Async OpenAI client layer
+#
+# All completions run on ONE dedicated event loop thread:
+# - a global semaphore caps concurrent OpenAI calls
+# - every call gets a deadline derived from the per-message
+#   latency budget (see start_message_budget)
+# - 429 / 5xx / connection errors are retried a bounded number
+#   of times while the deadline allows it
+#
+# Callers are sync code running in worker threads (the webhook
+# wraps them in asyncio.to_thread): complete() and stream() block
+# that thread only, never the webhook event loop.
+# ==========================================================
+
+LLM_MAX_CONCURRENCY = int(os.getenv("LLM_MAX_CONCURRENCY", "8"))
+
+# Total time all LLM calls of one inbound message may take
+LLM_MESSAGE_BUDGET_SECONDS = float(os.getenv("LLM_MESSAGE_BUDGET_SECONDS", "20"))
+
+# Hard cap for a single call, even with budget left
+LLM_CALL_TIMEOUT_SECONDS = float(os.getenv("LLM_CALL_TIMEOUT_SECONDS", "12"))
+
+LLM_MAX_RETRIES = int(os.getenv("LLM_MAX_RETRIES", "2"))
+
+LLM_RETRY_BACKOFF_SECONDS = 0.5
+
+RETRYABLE_ERRORS = (RateLimitError, InternalServerError, APIConnectionError)
+
+
+# Sentinel closing a streamed completion
+_STREAM_END = object()
+
+
+class LLMDeadlineExceeded(Exception):
+    """
+    Raised when a call cannot finish inside its deadline.
+    Callers answer with a deterministic fallback instead.
+    """
+
+
+_message_deadline = contextvars.ContextVar("llm_message_deadline", default=None)
+
+# Usage records of every LLM call made for the current message
+_message_usage = contextvars.ContextVar("llm_message_usage", default=None)
+
+client = None
+_loop = None
+_loop_lock = threading.Lock()
+_semaphore = None
+
+
+# ==========================================================
+# Per-message latency budget
+# ==========================================================
+def start_message_budget(seconds: float | None = None):
+    """
+    Starts the LLM latency budget for the current inbound message.
+    Context variables are copied into asyncio.to_thread workers,
+    so handlers running in threads share the same deadline.
+    """
+    budget = seconds if seconds is not None else LLM_MESSAGE_BUDGET_SECONDS
+    _message_deadline.set(time.monotonic() + budget)
+    _message_usage.set([])
+
+
+def remaining_budget() -> float | None:
+    deadline = _message_deadline.get()
+
+    if deadline is None:
+        return None
+
+    return deadline - time.monotonic()
+
+
+def _call_deadline() -> float:
+    call_deadline = time.monotonic() + LLM_CALL_TIMEOUT_SECONDS
+    message_deadline = _message_deadline.get()
+
+    if message_deadline is None:
+        return call_deadline
+
+    return min(call_deadline, message_deadline)
+
+
+# ==========================================================
+# Dedicated event loop
+# ==========================================================
+def _get_loop() -> asyncio.AbstractEventLoop:
+    global client, _loop, _semaphore
+
+    with _loop_lock:
+        if _loop is None:
+            client = AsyncOpenAI(
+                api_key=os.getenv("OPENAI_API_KEY"),
+                max_retries=0  # retries are handled here, bounded by the deadline
+            )
+            _loop = asyncio.new_event_loop()
+            _semaphore = asyncio.Semaphore(LLM_MAX_CONCURRENCY)
+
+            threading.Thread(
+                target=_loop.run_forever,
+                name="llm-loop",
+                daemon=True
+            ).start()
+
+        return _loop
+
+
+async def _complete(call_type: str, deadline: float, kwargs: dict):
+    started_at = time.monotonic()
+    attempt = 0
+
+    try:
+        while True:
+            remaining = deadline - time.monotonic()
+
+            if remaining <= 0:
+                raise LLMDeadlineExceeded(f"{call_type}: budget exhausted")
+
+            try:
+                # Waiting for a slot counts against the deadline too
+                return await asyncio.wait_for(
+                    _guarded_create(kwargs),
+                    timeout=remaining
+                )
+
+            except asyncio.TimeoutError:
+                raise LLMDeadlineExceeded(f"{call_type}: deadline exceeded")
+
+            except RETRYABLE_ERRORS as e:
+                attempt += 1
+                backoff = LLM_RETRY_BACKOFF_SECONDS * (2 ** (attempt - 1))
+
+                if attempt > LLM_MAX_RETRIES or backoff >= deadline - time.monotonic():
+                    raise
+
+                logging.warning(
+                    f"⚠️ LLM {call_type} retry {attempt}/{LLM_MAX_RETRIES}: {e}"
+                )
+                metrics.increment(f"llm.{call_type}.retries")
+                await asyncio.sleep(backoff)
+
+    except LLMDeadlineExceeded:
+        metrics.increment(f"llm.{call_type}.deadline_exceeded")
+        raise
+
+    finally:
+        metrics.observe(
+            f"llm.{call_type}",
+            (time.monotonic() - started_at) * 1000
+        )
+
+
+async def _guarded_create(kwargs: dict):
+    async with _semaphore:
+        return await client.chat.completions.create(**kwargs)
+
+
+async def _stream(call_type: str, deadline: float, kwargs: dict, deltas: queue.Queue):
+    """
+    Streams a completion, pushing content deltas into a thread-safe
+    queue. Streams are not retried: part of the reply may already
+    have been delivered.
+    """
+    started_at = time.monotonic()
+
+    try:
+        remaining = deadline - time.monotonic()
+
+        if remaining <= 0:
+            raise LLMDeadlineExceeded(f"{call_type}: budget exhausted")
+
+        return await asyncio.wait_for(
+            _guarded_stream(kwargs, deltas),
+            timeout=remaining
+        )
+
+    except asyncio.TimeoutError:
+        metrics.increment(f"llm.{call_type}.deadline_exceeded")
+        raise LLMDeadlineExceeded(f"{call_type}: deadline exceeded")
+
+    finally:
+        deltas.put(_STREAM_END)
+        metrics.observe(
+            f"llm.{call_type}",
+            (time.monotonic() - started_at) * 1000
+        )
+
+
+async def _guarded_stream(kwargs: dict, deltas: queue.Queue):
+    """
+    Returns the final chunk carrying the usage totals.
+    """
+    async with _semaphore:
+        response = await client.chat.completions.create(
+            stream=True,
+            stream_options={"include_usage": True},
+            **kwargs
+        )
+
+        usage_chunk = None
+
+        async for chunk in response:
+            if getattr(chunk, "usage", None):
+                usage_chunk = chunk
+
+            if chunk.choices and chunk.choices[0].delta.content:
+                deltas.put(chunk.choices[0].delta.content)
+
+        return usage_chunk
+
+
+# ==========================================================
+# Token & latency accounting
+# ==========================================================
+USAGE_FIELDS = ("prompt_tokens", "cached_tokens", "completion_tokens", "wall_ms")
+
+
+def _record_usage(call_type: str, model: str, response, wall_ms: float):
+    """
+    Records prompt / cached / completion tokens and wall time of
+    one call, globally per call type and for the current message.
+    """
+    usage = getattr(response, "usage", None)
+    details = getattr(usage, "prompt_tokens_details", None)
+
+    record = {
+        "call_type": call_type,
+        "model": model,
+        "prompt_tokens": getattr(usage, "prompt_tokens", 0) or 0,
+        "cached_tokens": getattr(details, "cached_tokens", 0) or 0,
+        "completion_tokens": getattr(usage, "completion_tokens", 0) or 0,
+        "wall_ms": round(wall_ms, 1)
+    }
+
+    metrics.increment(f"llm.{call_type}.calls")
+    metrics.increment(f"model.{model}.calls")
+
+    for field in USAGE_FIELDS:
+        metrics.increment(f"llm.{call_type}.{field}", record[field])
+
+    records = _message_usage.get()
+    if records is not None:
+        records.append(record)
+
+
+def finish_message(intent: str | None) -> dict:
+    """
+    Aggregates the LLM usage of the current message under its
+    final intent and returns the per-message totals.
+    """
+    records = _message_usage.get() or []
+    intent = intent or "unknown"
+
+    totals = {
+        field: round(sum(record[field] for record in records), 1)
+        for field in USAGE_FIELDS
+    }
+    totals["calls"] = len(records)
+
+    metrics.increment(f"intent.{intent}.messages")
+
+    for field, value in totals.items():
+        metrics.increment(f"intent.{intent}.{field}", value)
+
+    logging.info(f"📊 LLM usage for '{intent}': {totals}")
+
+    _message_usage.set([])
+
+    return totals
+
+
+# ==========================================================
+# Public API
+# ==========================================================
+def complete(call_type: str, **kwargs):
+    """
+    Blocking chat completion for sync code running in worker threads.
+    Raises LLMDeadlineExceeded when the deadline is exceeded.
+    """
+    started_at = time.monotonic()
+
+    future = asyncio.run_coroutine_threadsafe(
+        _complete(call_type, _call_deadline(), kwargs),
+        _get_loop()
+    )
+
+    response = future.result()
+
+    _record_usage(
+        call_type,
+        kwargs.get("model"),
+        response,
+        (time.monotonic() - started_at) * 1000
+    )
+
+    return response
+
+
+def stream(call_type: str, **kwargs):
+    """
+    Blocking generator of content deltas for sync code running in
+    worker threads. Raises (after the last delta) when the stream
+    fails or exceeds its deadline.
+    """
+    started_at = time.monotonic()
+    deltas = queue.Queue()
+
+    future = asyncio.run_coroutine_threadsafe(
+        _stream(call_type, _call_deadline(), kwargs, deltas),
+        _get_loop()
+    )
+
+    while True:
+        delta = deltas.get()
+
+        if delta is _STREAM_END:
+            break
+
+        yield delta
+
+    usage_chunk = future.result()
+
+    _record_usage(
+        call_type,
+        kwargs.get("model"),
+        usage_chunk,
+        (time.monotonic() - started_at) * 1000
+    )
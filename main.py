@@ -9,18 +9,32 @@ from datetime import datetime, timezone, timedelta
 # ==========================================================
 # Libraries
 # ==========================================================
+import asyncio
 import logging
 import os
 import json
+import time
 # ==========================================================
 # User defined functions
 # ==========================================================
-from utils import split_message
+import llm
+import metrics
+from utils import split_message, stream_chunks
+from sla import ReplyTimer
+from history import compact_history, has_cart_summary, history_tokens
+from order_parser import parse_line_command
 from ai import ( 
     analyze_intent,
-    generate_ai_response
+    analyze_intent_with_products,
+    extract_order_products_with_usage,
+    generate_ai_response,
+    generate_ai_response_stream,
+    build_price_context,
+    AI_RESPONSE_FALLBACK
 )
-from flows import handle_intent
+from flows import handle_intent, answer_price_question
+from catalog import get_products
+from search import search_products
 from db import (
     find_customer_by_phone,
     get_conversation_state,
@@ -28,12 +42,12 @@ from db import (
     upsert_conversation_state,
     save_message,
     get_ai_flow, 
-    get_all_products,
     get_detailed_products,
     get_active_promotions,
     get_recent_conversation_history,
     get_pending_customer_message,
-    clear_pending_customer_message
+    clear_pending_customer_message,
+    get_active_draft_order
 )
 from orders import (
     handle_place_order_intent,
@@ -42,7 +56,14 @@ from orders import (
     handle_modify_cart,
     handle_confirm_order,
     handle_cancel_order,
-    handle_cart_intent
+    handle_cart_intent,
+    looks_like_cart_operation,
+    get_product_catalog,
+    parse_products_locally,
+    complete_local_extraction,
+    llm_remainder,
+    merge_llm_extraction,
+    resolve_pending_clarification
 )
 
 # ==========================================================
@@ -64,6 +85,177 @@ twilio_client = Client(
     TWILIO_AUTH_TOKEN
 )
 
+# ==========================================================
+# AI replies are streamed: each paragraph-bounded chunk is sent
+# as soon as it is generated instead of after the full reply
+# ==========================================================
+STREAM_AI_REPLIES = os.getenv("STREAM_AI_REPLIES", "true").lower() == "true"
+
+# Sent after a streamed reply that broke off midway
+STREAM_INTERRUPTED_REPLY = (
+    "Perdón, se cortó mi respuesta 🙏\n"
+    "¿Me repites tu pregunta para completarla?"
+)
+
+# Price questions escalated to the LLM get only the closest products
+PRICE_CONTEXT_MAX_PRODUCTS = int(os.getenv("PRICE_CONTEXT_MAX_PRODUCTS", "20"))
+
+
+def send_whatsapp_message(to: str, body: str):
+    twilio_client.messages.create(
+        from_=TWILIO_WHATSAPP_FROM,
+        to=to,
+        body=body
+    )
+
+
+def _stream_ai_reply(
+    to: str,
+    deltas,
+    received_at: float,
+    reply_timer: ReplyTimer,
+    prefix: str | None = None
+) -> str:
+    """
+    Sends each chunk of a streamed AI reply in order as soon as it
+    is ready. Runs in a worker thread; returns the text the customer
+    got (to be saved).
+    - nothing sent → AI_RESPONSE_FALLBACK is sent instead
+    - broke off midway → STREAM_INTERRUPTED_REPLY follows the chunks
+    """
+    sent_chunks = []
+
+    try:
+        for chunk in stream_chunks(deltas):
+
+            if not sent_chunks:
+                reply_timer.reply_sent()
+                metrics.observe(
+                    "reply.first_chunk",
+                    (time.monotonic() - received_at) * 1000
+                )
+
+                # Pending customer message goes first (own message if too long)
+                if prefix:
+                    if len(prefix) + len(chunk) + 2 <= 1500:
+                        chunk = f"{prefix}\n\n{chunk}"
+                    else:
+                        send_whatsapp_message(to, prefix)
+                        sent_chunks.append(prefix)
+
+            send_whatsapp_message(to, chunk)
+            sent_chunks.append(chunk)
+
+        logging.info("✅ Streamed WhatsApp reply sent")
+
+    except Exception as e:
+        logging.error(f"❌ Error sending streamed WhatsApp reply: {e}")
+
+        if sent_chunks:
+            metrics.increment("reply.stream_interrupted")
+            _send_fallback(to, STREAM_INTERRUPTED_REPLY, sent_chunks)
+
+    if not sent_chunks:
+        metrics.increment("reply.stream_empty")
+        reply_timer.reply_sent()
+        _send_fallback(
+            to,
+            f"{prefix}\n\n{AI_RESPONSE_FALLBACK}" if prefix else AI_RESPONSE_FALLBACK,
+            sent_chunks
+        )
+
+    return "\n\n".join(sent_chunks)
+
+
+def _send_fallback(to: str, body: str, sent_chunks: list):
+    try:
+        send_whatsapp_message(to, body)
+        sent_chunks.append(body)
+    except Exception as e:
+        logging.error(f"❌ Error sending WhatsApp fallback reply: {e}")
+
+
+# ==========================================================
+# Cart extraction mode
+# - fused: one GPT call classifies intent AND extracts products
+# - speculative: extraction runs concurrently with analyze_intent
+#   and is discarded when the intent is not a cart intent
+# - serial: analyze_intent first, handler extracts afterwards
+# In fused mode a message that only partly parses locally goes
+# the speculative way instead, so ONLY its unparsed remainder is
+# extracted and merged with the local items (the fused prompt
+# would get it whole). Serial extracts the remainder in the
+# handler (orders.extract_products).
+# ==========================================================
+CART_EXTRACTION_MODE = os.getenv("CART_EXTRACTION_MODE", "fused")
+
+CART_INTENTS = {"place_order", "add_to_cart", "modify_cart"}
+
+# Keeps discarded speculative tasks alive until they finish
+_background_tasks = set()
+
+
+# ==========================================================
+# Speculative extraction helpers
+# ==========================================================
+def _record_wasted_speculation(task: asyncio.Task):
+    """
+    Done-callback for discarded speculative extractions.
+    The worker thread cannot be interrupted, so the tokens are
+    counted once the call finishes.
+    """
+    if task.cancelled() or task.exception():
+        return
+
+    _, total_tokens = task.result()
+    metrics.increment("speculation.wasted_tokens", total_tokens)
+
+
+async def _resolve_speculation(task: asyncio.Task, intent: str):
+    """
+    Returns the speculative extraction when the intent needs it,
+    otherwise discards it and returns None.
+    """
+    if intent in CART_INTENTS:
+        extraction, total_tokens = await task
+        metrics.increment("speculation.hit")
+        metrics.increment("speculation.used_tokens", total_tokens)
+        return extraction
+
+    metrics.increment("speculation.miss")
+    _background_tasks.add(task)
+    task.add_done_callback(_background_tasks.discard)
+    task.add_done_callback(_record_wasted_speculation)
+    return None
+
+
+# ==========================================================
+# Metrics
+# ==========================================================
+@app.get("/metrics")
+async def get_metrics():
+    return {
+        "counters": metrics.snapshot(),
+        "latency": metrics.histogram_snapshot(),
+        "speculation_hit_rate": metrics.rate(
+            "speculation.hit",
+            "speculation.launched"
+        ),
+        "ask_prices_local_rate": metrics.rate(
+            "ask_prices.local",
+            "ask_prices.questions"
+        ),
+        "promotions_incremental_rate": metrics.rate(
+            "promotions.incremental",
+            "promotions.evaluations"
+        ),
+        "cart_summary_hit_rate": metrics.hit_rate("cart_summary"),
+        "cache_hit_rate": {
+            name: metrics.hit_rate(f"cache.{name}")
+            for name in ["intent", "fused", "extraction"]
+        }
+    }
+
 
 
 
@@ -80,6 +272,8 @@ async def whatsapp_webhook(request: Request):
     - Returns fast 200 OK (no TwiML)
     """
 
+    received_at = time.monotonic()
+
     form = await request.form()
 
     # Normalize incoming data from Twilio
@@ -98,7 +292,7 @@ async def whatsapp_webhook(request: Request):
     # ------------------------------------------------------
     customer = None
     if message["from_phone"]:
-        customer = find_customer_by_phone(message["from_phone"])
+        customer = await asyncio.to_thread(find_customer_by_phone, message["from_phone"])
 
     # ------------------------------------------------------
     # STEP 2 – Unknown customer flow
@@ -115,11 +309,7 @@ async def whatsapp_webhook(request: Request):
 
         # Send reply immediately
         try:
-            twilio_client.messages.create(
-                from_=TWILIO_WHATSAPP_FROM,
-                to=message["from_raw"],
-                body=reply_text
-            )
+            await asyncio.to_thread(send_whatsapp_message, message["from_raw"], reply_text)
         except Exception as e:
             logging.error(f"❌ Error sending WhatsApp reply: {e}")
 
@@ -135,39 +325,184 @@ async def whatsapp_webhook(request: Request):
         customer_timezone = customer["timezone"]
     else:
         customer_timezone = "America/Mexico_City"
-    last_message_time = get_last_message_time(customer_id)
+    last_message_time = await asyncio.to_thread(get_last_message_time, customer_id)
 
     logging.info("🟢 Known customer flow")
 
+    # 🔹 LLM latency budget for this message (deadlines + fallbacks)
+    llm.start_message_budget()
+
+    # 🔹 Interim "working on it" message if the reply is slow
+    reply_timer = ReplyTimer(
+        lambda body: send_whatsapp_message(message["from_raw"], body),
+        received_at=received_at
+    )
+    reply_timer.start()
+
     # 🔹 Get conversation state
-    state = get_conversation_state(customer_id)
+    state = await asyncio.to_thread(get_conversation_state, customer_id)
 
     # 🔹 Get recent history (last 5 interactions)
-    conversation_history = get_recent_conversation_history(customer_id)
+    conversation_history = await asyncio.to_thread(get_recent_conversation_history, customer_id)
+
+    # 🔹 Compact history under the token budget
+    # (bot cart summaries become {cart_id, lines, total} stand-ins)
+    cart_id = None
+    if has_cart_summary(conversation_history):
+        draft = await asyncio.to_thread(get_active_draft_order, customer_id)
+        cart_id = draft["draft_order_id"] if draft else None
+
+    raw_history_tokens = history_tokens(conversation_history)
+    conversation_history = compact_history(
+        conversation_history,
+        cart_id=cart_id
+    )
+    metrics.increment(
+        "history.tokens_saved",
+        raw_history_tokens - history_tokens(conversation_history)
+    )
 
     # ------------------------------------------------------
     # STEP 3A – Deliver Pending Customer Message (if any)
     # ------------------------------------------------------
     
-    pending_message = get_pending_customer_message(customer_id)
+    pending_message = await asyncio.to_thread(get_pending_customer_message, customer_id)
     
     if pending_message:
         logging.info("📨 Delivering pending customer message")
     
         # Clear it immediately so it is only sent once
-        clear_pending_customer_message(customer_id)
+        await asyncio.to_thread(clear_pending_customer_message, customer_id)
     
     # 🔹 Analyze intent with ChatGPT
-    intent_data = analyze_intent(
-        message_text=message["body"],
-        context=state["context"] if state else None,
-        history=conversation_history
+    # Cart-looking messages also need product extraction, either
+    # fused into the same call or launched speculatively in parallel
+    is_cart_message = looks_like_cart_operation(message["body"])
+    parsed_locally = None
+    local_extraction = None
+
+    # 🔹 Reply to a numbered clarification ("la 2", "el de 500")
+    # → resolved against the stored options, no LLM call at all
+    pending_clarification = (
+        (state.get("context") or {}).get("pending_clarification")
+        if state else None
+    )
+    clarification_extraction = (
+        resolve_pending_clarification(message["body"], pending_clarification)
+        if pending_clarification else None
+    )
+
+    # 🔹 Positional edit over the numbered cart ("quita la 2")
+    # → handled by the deterministic modifier, no LLM call
+    line_command = (
+        parse_line_command(message["body"])
+        if clarification_extraction is None else None
+    )
+
+    if is_cart_message and clarification_extraction is None and not line_command:
+        # Off the event loop: may refresh the catalog / indexes
+        product_catalog = await asyncio.to_thread(get_product_catalog)
+        parsed_locally = await asyncio.to_thread(
+            parse_products_locally,
+            message["body"],
+            product_catalog
+        )
+        local_extraction = complete_local_extraction(parsed_locally)
+
+    # Part of the message parsed locally → the model only gets the
+    # unparsed remainder, extracted alongside a plain intent call
+    partially_parsed = bool(
+        parsed_locally
+        and local_extraction is None
+        and (parsed_locally["items"] or parsed_locally["ambiguous_items"])
     )
+
+    if clarification_extraction is not None:
+        intent_data = {
+            "intent": "add_to_cart",
+            "confidence": 1.0,
+            "entities": {},
+            "next_action": "clarification_resolved",
+            "extraction": clarification_extraction
+        }
+
+    elif line_command:
+        intent_data = {
+            "intent": "modify_cart",
+            "confidence": 1.0,
+            "entities": {},
+            "next_action": "line_command"
+        }
+
+    elif local_extraction is not None:
+        # Products already resolved locally → plain (cacheable)
+        # intent analysis without the catalog in the prompt
+        intent_data = await asyncio.to_thread(
+            analyze_intent,
+            message_text=message["body"],
+            context=state["context"] if state else None,
+            history=conversation_history
+        )
+        intent_data["extraction"] = local_extraction
+
+    elif is_cart_message and (
+        CART_EXTRACTION_MODE == "speculative"
+        or (CART_EXTRACTION_MODE == "fused" and partially_parsed)
+    ):
+        metrics.increment("speculation.launched")
+
+        speculative_extraction = asyncio.create_task(
+            asyncio.to_thread(
+                extract_order_products_with_usage,
+                llm_remainder(message["body"], parsed_locally),
+                product_catalog
+            )
+        )
+
+        intent_data = await asyncio.to_thread(
+            analyze_intent,
+            message_text=message["body"],
+            context=state["context"] if state else None,
+            history=conversation_history
+        )
+
+        extraction = await _resolve_speculation(
+            speculative_extraction,
+            intent_data.get("intent")
+        )
+
+        # Local items + the model's extraction of the remainder
+        intent_data["extraction"] = (
+            await asyncio.to_thread(
+                merge_llm_extraction,
+                message["body"],
+                parsed_locally,
+                extraction
+            )
+            if extraction is not None else None
+        )
+
+    elif is_cart_message and CART_EXTRACTION_MODE == "fused":
+        intent_data = await asyncio.to_thread(
+            analyze_intent_with_products,
+            message_text=message["body"],
+            product_catalog=product_catalog,
+            context=state["context"] if state else None,
+            history=conversation_history
+        )
+    else:
+        intent_data = await asyncio.to_thread(
+            analyze_intent,
+            message_text=message["body"],
+            context=state["context"] if state else None,
+            history=conversation_history
+        )
     
     logging.info(f"🤖 Intent detected: {intent_data}")
 
     # 🔹 Save inbound message
-    save_message(
+    await asyncio.to_thread(
+        save_message,
         customer_id=customer_id,
         direction="inbound",
         body=message["body"],
@@ -195,25 +530,33 @@ async def whatsapp_webhook(request: Request):
 
         handler = deterministic_intents[intent]
 
+        # Update state BEFORE the handler: handlers may add to the
+        # context (e.g. a pending clarification)
+        await asyncio.to_thread(
+            upsert_conversation_state,
+            customer_id=customer_id,
+            current_flow=intent,
+            current_step=None,
+            context=intent_data.get("entities", {})
+        )
+
         # Some handlers require message_text, some don't
         if intent in ["add_to_cart", "modify_cart", "place_order"]:
-            reply_text = handler(customer_id, message["body"])
+            reply_text = await asyncio.to_thread(
+                handler,
+                customer_id,
+                message["body"],
+                extraction=intent_data.get("extraction")
+            )
         else:
-            reply_text = handler(customer_id)
+            reply_text = await asyncio.to_thread(handler, customer_id)
 
         if pending_message:
             reply_text = f"{pending_message}\n\n{reply_text}"
-        
-        # Update state
-        upsert_conversation_state(
-            customer_id=customer_id,
-            current_flow=intent,
-            current_step=None,
-            context=intent_data.get("entities", {})
-        )
 
         # Save outbound message
-        save_message(
+        await asyncio.to_thread(
+            save_message,
             customer_id=customer_id,
             direction="outbound",
             body=reply_text,
@@ -222,25 +565,49 @@ async def whatsapp_webhook(request: Request):
 
         chunks = split_message(reply_text)
 
+        reply_timer.reply_sent()
+
         # Send WhatsApp message
         try:
             for chunk in chunks:
-                twilio_client.messages.create(
-                    from_=TWILIO_WHATSAPP_FROM,
-                    to=message["from_raw"],
-                    body=chunk
-                )
+                await asyncio.to_thread(send_whatsapp_message, message["from_raw"], chunk)
             logging.info("✅ Deterministic reply sent")
 
         except Exception as e:
             logging.error(f"❌ Error sending WhatsApp reply: {e}")
 
+        llm.finish_message(intent)
+        reply_timer.finish(intent)
+
         return PlainTextResponse("", status_code=200)
 
 
     
-    flow_config = get_ai_flow(intent)
-    if not flow_config:
+    reply_sent = False
+
+    # 🔹 Price questions answered from the in-memory catalog;
+    # the LLM only gets the ones without a confident match
+    local_reply = None
+
+    if intent == "ask_prices":
+        metrics.increment("ask_prices.questions")
+
+        local_reply = await asyncio.to_thread(
+            answer_price_question,
+            intent_data.get("entities", {}).get("product_name")
+        )
+
+        if local_reply:
+            metrics.increment("ask_prices.local")
+
+    flow_config = (
+        await asyncio.to_thread(get_ai_flow, intent)
+        if not local_reply else None
+    )
+
+    if local_reply:
+        system_reply = local_reply
+    elif not flow_config:
         system_reply = "No pude procesar tu solicitud."
     else:
 
@@ -251,22 +618,29 @@ async def whatsapp_webhook(request: Request):
         # PRICING INTENT
         # ==============================
         if intent == "ask_prices":
-            products = get_all_products()
+            # Off the event loop: a catalog refresh reads the products
+            # table and rebuilds the search / family indexes
+            products = await asyncio.to_thread(get_products)
+
+            product_name = intent_data.get("entities", {}).get("product_name")
+
+            if product_name:
+                candidates = await asyncio.to_thread(
+                    search_products,
+                    product_name,
+                    k=PRICE_CONTEXT_MAX_PRODUCTS
+                )
+                if candidates:
+                    products = [c["product"] for c in candidates]
+
             # Send compact product catalog
-            context_data = json.dumps([
-                {
-                    "name": p["product"],
-                    "sku": p.get("sku"),
-                    "price": p["price"]
-                }
-                for p in products
-            ])
+            context_data = build_price_context(products)
 
         # ==============================
         # PROMOTIONS INTENT
         # ==============================
         elif intent == "ask_promotions":
-            promotions = get_active_promotions()
+            promotions = await asyncio.to_thread(get_active_promotions)
 
             context_data = json.dumps({
                 "active_promotions": promotions
@@ -276,7 +650,7 @@ async def whatsapp_webhook(request: Request):
         # PRODUCT INFORMATION INTENT
         # ==============================
         elif intent == "product_info":
-            detailed_products = get_detailed_products()
+            detailed_products = await asyncio.to_thread(get_detailed_products)
     
             context_data = json.dumps({
                 "products": detailed_products
@@ -286,23 +660,42 @@ async def whatsapp_webhook(request: Request):
         # GENERATE RESPONSE
         # ==============================
     
-        system_reply = generate_ai_response(
-            base_system_prompt=flow_config["system_prompt"],
-            user_message=message["body"],
-            context_data=context_data,
-            customer_timezone=customer_timezone,
-            last_message_time=last_message_time,
-            distributor_name=greeting_name
-        )
+        ai_request = {
+            "base_system_prompt": flow_config["system_prompt"],
+            "user_message": message["body"],
+            "context_data": context_data,
+            "customer_timezone": customer_timezone,
+            "last_message_time": last_message_time,
+            "distributor_name": greeting_name
+        }
+
+        if STREAM_AI_REPLIES:
+            reply_text = await asyncio.to_thread(
+                _stream_ai_reply,
+                message["from_raw"],
+                generate_ai_response_stream(**ai_request),
+                received_at,
+                reply_timer,
+                pending_message
+            )
+            reply_sent = True
 
-    # 🔹 Compose final response (include greeting personalization)
-    reply_text = system_reply 
+        else:
+            system_reply = await asyncio.to_thread(
+                generate_ai_response,
+                **ai_request
+            )
 
-    if pending_message:
-        reply_text = f"{pending_message}\n\n{reply_text}"
+    if not reply_sent:
+        # 🔹 Compose final response (include greeting personalization)
+        reply_text = system_reply
+
+        if pending_message:
+            reply_text = f"{pending_message}\n\n{reply_text}"
 
     # 🔹 Update conversation state
-    upsert_conversation_state(
+    await asyncio.to_thread(
+        upsert_conversation_state,
         customer_id=customer_id,
         current_flow=intent_data.get("intent"),
         current_step=intent_data.get("next_action"),
@@ -310,29 +703,32 @@ async def whatsapp_webhook(request: Request):
     )
 
     # 🔹 Save outbound message
-    save_message(
+    await asyncio.to_thread(
+        save_message,
         customer_id=customer_id,
         direction="outbound",
         body=reply_text,
         intent=intent_data.get("intent")
     )
 
-    chunks = split_message(reply_text)
-    
     # ------------------------------------------------------
     # Send WhatsApp response (ONLY ONCE)
     # ------------------------------------------------------
-    try:
-        for chunk in chunks:
-            twilio_client.messages.create(
-                from_=TWILIO_WHATSAPP_FROM,
-                to=message["from_raw"],
-                body=chunk
-            )
-        logging.info("✅ WhatsApp reply sent")
+    if not reply_sent:
+        chunks = split_message(reply_text)
 
-    except Exception as e:
-        logging.error(f"❌ Error sending WhatsApp reply: {e}")
+        reply_timer.reply_sent()
+
+        try:
+            for chunk in chunks:
+                await asyncio.to_thread(send_whatsapp_message, message["from_raw"], chunk)
+            logging.info("✅ WhatsApp reply sent")
+
+        except Exception as e:
+            logging.error(f"❌ Error sending WhatsApp reply: {e}")
+
+    llm.finish_message(intent)
+    reply_timer.finish(intent)
 
     # ------------------------------------------------------
     # ACK Twilio FAST (prevents retries + ghost messages)
@@ -0,0 +1,94 @@
+import bisect
+import threading
+from collections import defaultdict
+
+# ==========================================================
+# In-process metrics
+# Simple counters shared by the webhook and the AI layer.
+# Exposed through GET /metrics in main.py
+# ==========================================================
+_lock = threading.Lock()
+_counters = defaultdict(float)
+_histograms = {}
+
+# Upper bounds (ms) of the latency histogram buckets; last bucket is +inf
+LATENCY_BUCKETS_MS = (100, 250, 500, 1000, 2000, 4000, 8000, 16000)
+
+
+def increment(name: str, value: float = 1):
+    """
+    Adds value to the named counter.
+    """
+    with _lock:
+        _counters[name] += value
+
+
+def get_counter(name: str) -> float:
+    with _lock:
+        return _counters.get(name, 0.0)
+
+
+def rate(numerator: str, denominator: str) -> float:
+    """
+    Ratio between two counters (0 when denominator is empty).
+    """
+    with _lock:
+        total = _counters.get(denominator, 0.0)
+        if not total:
+            return 0.0
+        return round(_counters.get(numerator, 0.0) / total, 4)
+
+
+def snapshot() -> dict:
+    with _lock:
+        return dict(_counters)
+
+
+def hit_rate(prefix: str) -> float:
+    """
+    Hit rate for counters named <prefix>.hit / <prefix>.miss
+    """
+    with _lock:
+        hits = _counters.get(f"{prefix}.hit", 0.0)
+        total = hits + _counters.get(f"{prefix}.miss", 0.0)
+        if not total:
+            return 0.0
+        return round(hits / total, 4)
+
+
+def observe(name: str, value_ms: float):
+    """
+    Records a latency sample (milliseconds) in the named histogram.
+    """
+    with _lock:
+        histogram = _histograms.get(name)
+
+        if histogram is None:
+            histogram = {
+                "count": 0,
+                "sum_ms": 0.0,
+                "max_ms": 0.0,
+                "buckets": [0] * (len(LATENCY_BUCKETS_MS) + 1)
+            }
+            _histograms[name] = histogram
+
+        histogram["count"] += 1
+        histogram["sum_ms"] += value_ms
+        histogram["max_ms"] = max(histogram["max_ms"], value_ms)
+        histogram["buckets"][bisect.bisect_left(LATENCY_BUCKETS_MS, value_ms)] += 1
+
+
+def histogram_snapshot() -> dict:
+    with _lock:
+        result = {}
+
+        for name, histogram in _histograms.items():
+            labels = [f"<={bound}" for bound in LATENCY_BUCKETS_MS] + ["+inf"]
+            result[name] = {
+                "count": histogram["count"],
+                "avg_ms": round(histogram["sum_ms"] / histogram["count"], 1),
+                "max_ms": round(histogram["max_ms"], 1),
+                "buckets": dict(zip(labels, histogram["buckets"]))
+            }
+
+        return result
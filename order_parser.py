@@ -0,0 +1,346 @@
+import re
+
+from utils import normalize_text
+
+# ==========================================================
+# Deterministic order-line parser
+#
+# Understands messages like:
+#   "2 AVY-ARG-SHP-250, 3 AVY-GEL-100"
+#   "dos shampoo argán 250 y una docena de geles"
+# without calling the LLM. Segments it cannot resolve with
+# certainty are returned as "unparsed" for the LLM fallback.
+# ==========================================================
+
+NUMBER_WORDS = {
+    "un": 1, "una": 1, "uno": 1, "dos": 2, "tres": 3, "cuatro": 4,
+    "cinco": 5, "seis": 6, "siete": 7, "ocho": 8, "nueve": 9, "diez": 10,
+    "once": 11, "doce": 12, "trece": 13, "catorce": 14, "quince": 15,
+    "dieciseis": 16, "diecisiete": 17, "dieciocho": 18, "diecinueve": 19,
+    "veinte": 20,
+}
+
+DOZEN_WORDS = {"docena", "docenas"}
+
+# Cart verbs and fillers that are not part of the product phrase
+FILLER_WORDS = {
+    "agrega", "agregame", "agregar", "anade", "anademe", "pon", "ponme",
+    "mandame", "manda", "quiero", "necesito", "tambien", "hacer",
+    "pedido", "ordenar", "quita", "quitar", "elimina", "eliminar",
+    "borra", "saca", "porfa", "favor", "por", "gracias", "mas",
+    "todo", "todos", "todas",
+}
+
+# Words between a quantity and the product ("3 piezas de ...")
+QUANTITY_UNITS = {
+    "pieza", "piezas", "pza", "pzas", "pz", "unidad", "unidades", "x",
+}
+
+# A leading number followed by one of these is a size, not a quantity
+SIZE_UNITS = {"ml", "l", "lt", "lts", "litro", "litros", "g", "gr", "kg", "oz"}
+
+STOP_WORDS = {"el", "la", "los", "las", "de", "del", "con", "en", "para"}
+
+SEGMENT_SEPARATORS = re.compile(r"[,;\n]+|\s+y\s+|\s+e\s+")
+
+SKU_TOKEN = re.compile(r"\b[a-z0-9]+(?:-[a-z0-9]+){2,}\b")
+
+QUANTITY_SUFFIX = re.compile(r"^(?:x\s*(\d+)|(\d+)\s*(?:x|pzas?|piezas?))\b")
+
+# Positional cart edits over the numbered cart summary
+_LINE_REF = r"(?:la|el)?\s*(?:linea|renglon|producto)?\s*(?:numero|no\.?|#)?\s*"
+
+_NUMBER = r"(\d+|[a-z]+)"
+
+REMOVE_LINE_COMMAND = re.compile(
+    r"^(?:quita|quitar|quitame|elimina|eliminar|borra|borrar|saca|sacar)\s+"
+    r"(?=la\b|el\b|linea\b|renglon\b|producto\b|numero\b|no\b|#)"
+    + _LINE_REF + _NUMBER + r"$"
+)
+
+SET_LINE_COMMAND = re.compile(
+    r"^(?:cambia|cambiar|cambiame|pon|ponme|deja|dejame|modifica|modificar)\s+"
+    + _LINE_REF + _NUMBER
+    + r"\s+(?:a|en|por|con)\s+" + _NUMBER
+    + r"(?:\s+(?:piezas?|pzas?|pz|unidades?))?$"
+)
+
+
+# ==========================================================
+# Text helpers
+# ==========================================================
+def _words(text: str) -> list:
+    text = normalize_text(text)
+    # "250ml" → "250 ml", "x3" → "x 3"
+    text = re.sub(r"(\d)([a-z])", r"\1 \2", text)
+    text = re.sub(r"\b([a-z])(\d)", r"\1 \2", text)
+    return re.sub(r"[^\w\s\-\.]", " ", text).split()
+
+
+def strip_fillers(words: list) -> list:
+    while words and words[0] in FILLER_WORDS:
+        words = words[1:]
+
+    while words and words[-1] in FILLER_WORDS:
+        words = words[:-1]
+
+    return words
+
+
+def _singular(word: str) -> str:
+    if len(word) > 4 and word.endswith("es"):
+        return word[:-2]
+    if len(word) > 3 and word.endswith("s"):
+        return word[:-1]
+    return word
+
+
+def content_tokens(text: str) -> set:
+    """
+    Comparable tokens of a product phrase or product name.
+    """
+    return {
+        _singular(word)
+        for word in _words(text)
+        if word not in STOP_WORDS
+    }
+
+
+def split_segments(message_text: str) -> list:
+    """
+    Splits a message on list separators (commas, new lines, "y").
+    """
+    return [
+        segment.strip()
+        for segment in SEGMENT_SEPARATORS.split(normalize_text(message_text))
+        if segment and segment.strip()
+    ]
+
+
+def split_quantity(segment: str) -> tuple[int | None, str]:
+    """
+    '2 platino de 500'          → (2, 'platino de 500')
+    'agrega dos geles'          → (2, 'geles')
+    'una docena de brochas'     → (12, 'brochas')
+    '3 piezas de gel'           → (3, 'gel')
+    '500 ml de shampoo'         → (None, '500 ml de shampoo')
+    """
+    words = strip_fillers(_words(segment))
+
+    if not words:
+        return None, ""
+
+    quantity = None
+    first = words[0]
+    second = words[1] if len(words) > 1 else None
+
+    if first.isdigit() and second not in SIZE_UNITS:
+        quantity = int(first)
+        words = words[1:]
+    elif first == "media" and second in DOZEN_WORDS:
+        quantity = 6
+        words = words[2:]
+    elif first in NUMBER_WORDS and len(words) > 1:
+        quantity = NUMBER_WORDS[first]
+        words = words[1:]
+    elif first in DOZEN_WORDS:
+        quantity = 12
+        words = words[1:]
+
+    if quantity is not None and words and words[0] in DOZEN_WORDS:
+        quantity *= 12
+        words = words[1:]
+
+    while quantity is not None and words and words[0] in QUANTITY_UNITS:
+        words = words[1:]
+
+    if quantity is not None and words and words[0] in ("de", "del"):
+        words = words[1:]
+
+    return quantity, " ".join(words)
+
+
+# ==========================================================
+# Positional commands ("quita la 2", "cambia la 3 a 5 piezas")
+# ==========================================================
+def _to_number(word: str) -> int | None:
+    if word.isdigit():
+        return int(word)
+    return NUMBER_WORDS.get(word)
+
+
+def parse_line_command(message_text: str) -> dict | None:
+    """
+    'quita la 2'              → {"action": "remove", "line": 2}
+    'cambia la 3 a 5 piezas'  → {"action": "set", "line": 3, "quantity": 5}
+    None for anything else (product-based edits, questions...).
+    """
+    text = " ".join(re.sub(r"[^\w\s#\.]", " ", normalize_text(message_text)).split())
+    text = re.sub(r"(?:\s+(?:por favor|porfa|gracias))+$", "", text.rstrip("."))
+
+    match = REMOVE_LINE_COMMAND.match(text)
+    if match:
+        line = _to_number(match.group(1))
+        return {"action": "remove", "line": line} if line else None
+
+    match = SET_LINE_COMMAND.match(text)
+    if match:
+        line = _to_number(match.group(1))
+        quantity = _to_number(match.group(2))
+
+        if not line or quantity is None:
+            return None
+
+        if quantity == 0:
+            return {"action": "remove", "line": line}
+
+        return {"action": "set", "line": line, "quantity": quantity}
+
+    return None
+
+
+# ==========================================================
+# Catalog index (SKU + name tokens)
+# ==========================================================
+def build_parser_index(product_catalog: list) -> dict:
+    """
+    product_catalog: [{ "sku": str, "name": str }]
+    """
+    return {
+        "skus": {
+            p["sku"].lower(): p["sku"]
+            for p in product_catalog
+            if p.get("sku")
+        },
+        "names": [
+            (p["sku"], content_tokens(p.get("name") or ""))
+            for p in product_catalog
+            if p.get("sku")
+        ]
+    }
+
+
+def _match_name(phrase: str, index: dict) -> str | None:
+    """
+    Unique product whose name contains EVERY token of the phrase.
+    Requires at least one non-numeric token; ambiguous → None.
+    """
+    tokens = content_tokens(phrase)
+
+    if not tokens or all(token.isdigit() for token in tokens):
+        return None
+
+    matches = [
+        sku for sku, name_tokens in index["names"]
+        if tokens <= name_tokens
+    ]
+
+    return matches[0] if len(matches) == 1 else None
+
+
+def _parse_sku_segment(segment: str, index: dict) -> list | None:
+    """
+    Parses every '<qty> SKU' / 'SKU x<qty>' pair in a segment.
+    Returns None when the segment has no SKU tokens or any
+    SKU-looking token is not in the catalog.
+    """
+    text = normalize_text(segment)
+    tokens = list(SKU_TOKEN.finditer(text))
+
+    if not tokens:
+        return None
+
+    items = []
+    cursor = 0
+
+    for match in tokens:
+        sku = index["skus"].get(match.group(0))
+
+        if not sku:
+            return None
+
+        quantity, leftover = split_quantity(text[cursor:match.start()])
+
+        if leftover:
+            return None
+
+        suffix = QUANTITY_SUFFIX.match(text[match.end():].strip())
+        if suffix:
+            quantity = int(suffix.group(1) or suffix.group(2))
+            cursor = match.end() + text[match.end():].find(suffix.group(0))
+            cursor += len(suffix.group(0))
+        else:
+            cursor = match.end()
+
+        items.append({
+            "sku": sku,
+            "quantity": quantity or 1,
+            "requested_text": match.group(0)
+        })
+
+    if strip_fillers(_words(text[cursor:])):
+        return None
+
+    return items
+
+
+# ==========================================================
+# Parser
+# ==========================================================
+def parse_order_lines(
+    message_text: str,
+    product_catalog: list,
+    resolve_phrase=None,
+    index: dict | None = None
+) -> dict:
+    """
+    Deterministically parses order lines.
+
+    resolve_phrase: optional callable(phrase) → SKU | None, checked
+    before name matching (e.g. the learned alias table).
+
+    Returns:
+    {
+        "items": [{ "sku", "quantity", "requested_text" }],
+        "unparsed": [ segment, ... ]
+    }
+    """
+    index = index or build_parser_index(product_catalog)
+
+    items = []
+    unparsed = []
+
+    for segment in split_segments(message_text):
+
+        sku_items = _parse_sku_segment(segment, index)
+
+        if sku_items:
+            items.extend(sku_items)
+            continue
+
+        quantity, phrase = split_quantity(segment)
+
+        if not phrase:
+            # Bare filler ("quiero", "por favor") carries no product
+            if quantity is None:
+                continue
+            unparsed.append(segment)
+            continue
+
+        sku = resolve_phrase(phrase) if resolve_phrase else None
+        sku = sku or _match_name(phrase, index)
+
+        if not sku:
+            unparsed.append(segment)
+            continue
+
+        items.append({
+            "sku": sku,
+            "quantity": quantity or 1,
+            "requested_text": phrase
+        })
+
+    return {
+        "items": items,
+        "unparsed": unparsed
+    }
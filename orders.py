@@ -1,9 +1,30 @@
 import logging
 import json
-from promotions import calculate_promotions
+import re
+import metrics
+from utils import normalize_text
+from aliases import resolve_alias, learn_from_extraction
+from order_parser import parse_order_lines, parse_line_command, split_quantity
+from search import search_products, get_search_index
+from presentations import resolve_presentation
+from clarification import (
+    build_pending_clarification,
+    format_clarification_question,
+    resolve_clarification_reply,
+    groups_to_ambiguous_items
+)
+from promotions import (
+    calculate_promotions,
+    cart_version,
+    evaluate_cart,
+    evaluate_draft_cart,
+    near_miss_positions,
+    get_promotion_index
+)
+from pricing import build_cart, from_cents, line_values, price_cart, price_lines, to_cents
 from ai import extract_order_products_with_gpt
+from catalog import get_catalog_product, get_products
 from db import (
-    get_all_products,
     get_product_by_sku
 )
 
@@ -14,13 +35,17 @@ from db import (
     upsert_draft_line,
     get_draft_order_lines,
     update_draft_order_totals,
+    save_draft_line_allocations,
     convert_draft_to_order,
     get_product_by_sku,
     cancel_draft_order,
     remove_draft_line_quantity,
     delete_draft_line,
     get_products_by_ids,
-    get_active_promotions
+    get_conversation_state,
+    update_conversation_context,
+    set_draft_line_quantity,
+    save_draft_cart_summary
 )
 
 def detect_cart_operation(message_text: str) -> tuple[str, bool]:
@@ -75,6 +100,355 @@ def is_cart_query(message_text: str) -> bool:
     return any(t in message_text for t in triggers)
 
 
+# ==========================================================
+# Cart Operation Heuristic (pre intent analysis)
+# ==========================================================
+CART_OPERATION_KEYWORDS = [
+    "pedido",
+    "ordenar",
+    "orden",
+    "quiero",
+    "agrega",
+    "agregar",
+    "añade",
+    "anade",
+    "pon",
+    "ponme",
+    "mandame",
+    "quita",
+    "quitar",
+    "elimina",
+    "eliminar",
+    "borra",
+    "saca",
+    "cambia",
+]
+
+NUMBER_WORDS = [
+    "un", "una", "uno", "dos", "tres", "cuatro", "cinco", "seis",
+    "siete", "ocho", "nueve", "diez", "docena",
+]
+
+PRICE_QUESTION_KEYWORDS = [
+    "cuanto",
+    "cuesta",
+    "cuestan",
+    "precio",
+    "precios",
+]
+
+SKU_PATTERN = re.compile(r"\b[a-z0-9]+(?:-[a-z0-9]+){2,}\b")
+
+
+def looks_like_cart_operation(message_text: str) -> bool:
+    """
+    Cheap heuristic used before intent analysis.
+
+    True when the message mentions cart verbs, quantities or
+    SKU-looking tokens, i.e. it probably needs product extraction.
+    """
+
+    text = normalize_text(message_text)
+
+    if not text:
+        return False
+
+    if is_cart_query(text):
+        return False
+
+    words = set(re.findall(r"\w+", text))
+
+    if any(keyword in words for keyword in PRICE_QUESTION_KEYWORDS):
+        return False
+
+    if SKU_PATTERN.search(text):
+        return True
+
+    if any(keyword in words for keyword in CART_OPERATION_KEYWORDS):
+        return True
+
+    has_quantity = bool(re.search(r"\b\d+\b", text)) or any(
+        word in words for word in NUMBER_WORDS
+    )
+
+    return has_quantity and len(words) > 1
+
+
+# ==========================================================
+# Compact Product Catalog (GPT SKU matching)
+# ==========================================================
+# Suggestions when a product phrase cannot be resolved
+ORDER_SUGGESTION_MAX_OPTIONS = 3
+ORDER_SUGGESTION_MIN_SIMILARITY = 0.35
+ORDER_SUGGESTION_MIN_LENGTH = 4
+
+
+def get_product_catalog():
+    """
+    Compact catalog sent to GPT for SKU matching.
+    """
+
+    products = get_products()
+
+    return [
+        {"sku": p["sku"], "name": p["product"]}
+        for p in products
+    ]
+
+
+# ==========================================================
+# Product Extraction Pipeline
+# pre-extracted (fused / speculative)
+#   → deterministic parser (SKUs, quantities, aliases, names)
+#   → GPT only for the unparsed remainder
+# ==========================================================
+def parse_products_locally(message_text: str, product_catalog: list) -> dict:
+    """
+    Runs the deterministic order-line parser, using the learned
+    alias table and the product families as phrase resolvers.
+    Segments naming a family without a size become ambiguous
+    items with its presentations as options.
+    """
+
+    # Built once per catalog version, with the search index
+    search_index = get_search_index()
+    valid_skus = search_index["valid_skus"]
+    family_index = search_index["families"]
+
+    def resolve_phrase(phrase):
+        family, presentation = resolve_presentation(family_index, phrase)
+
+        if presentation:
+            return presentation["sku"]
+
+        # Family without its size: always asked, never a learned alias
+        if family:
+            return None
+
+        return resolve_alias(phrase, valid_skus)
+
+    parsed = parse_order_lines(
+        message_text,
+        product_catalog,
+        resolve_phrase=resolve_phrase,
+        index=search_index["parser"]
+    )
+
+    unparsed = []
+    ambiguous_items = []
+
+    for segment in parsed["unparsed"]:
+        quantity, phrase = split_quantity(segment)
+        family, _ = resolve_presentation(family_index, phrase) if phrase else (None, None)
+
+        if not family:
+            unparsed.append(segment)
+            continue
+
+        ambiguous_items.append({
+            "requested_text": phrase,
+            "quantity": quantity or 1,
+            "possible_matches": [
+                {"sku": p["sku"], "name": p["product"]["product"]}
+                for p in family["presentations"]
+            ]
+        })
+
+    return {
+        "items": parsed["items"],
+        "ambiguous_items": ambiguous_items,
+        "unparsed": unparsed
+    }
+
+
+def is_ambiguous_phrase(phrase: str) -> bool:
+    """
+    True when the phrase names a product family with several
+    presentations but not which one.
+    """
+    family, presentation = resolve_presentation(get_search_index()["families"], phrase)
+    return bool(family) and presentation is None
+
+
+def _local_extraction(items: list, ambiguous_items: list | None = None) -> dict:
+    return {
+        "needs_clarification": bool(ambiguous_items),
+        "items": items,
+        "ambiguous_items": ambiguous_items or [],
+        "source": "local"
+    }
+
+
+def complete_local_extraction(parsed: dict):
+    """
+    The extraction of a parse_products_locally result, only when
+    EVERY segment parsed (family-level matches count: they become
+    numbered options); None otherwise.
+    """
+
+    if parsed["unparsed"] or not (parsed["items"] or parsed["ambiguous_items"]):
+        return None
+
+    metrics.increment("extraction.local")
+
+    return _local_extraction(parsed["items"], parsed["ambiguous_items"])
+
+
+def llm_remainder(message_text: str, parsed: dict) -> str:
+    """
+    What the model still has to resolve: only the unparsed segments
+    when part of the message parsed locally, the whole message
+    otherwise.
+    """
+
+    if parsed["items"] or parsed["ambiguous_items"]:
+        metrics.increment("extraction.llm_remainder")
+        return ", ".join(parsed["unparsed"])
+
+    metrics.increment("extraction.llm")
+    return message_text
+
+
+def merge_llm_extraction(message_text: str, parsed: dict, llm_extraction: dict) -> dict:
+    """
+    Local items + the model's extraction of the remainder.
+    Model items feed the learned alias table.
+    """
+
+    learn_from_extraction(llm_extraction, is_ambiguous_phrase)
+
+    ambiguous_items = llm_extraction.get("ambiguous_items", [])
+
+    # Nothing resolved for the remainder → closest products as options
+    if not llm_extraction.get("items") and not ambiguous_items:
+        ambiguous_items = suggest_products(parsed["unparsed"] or [message_text])
+
+    ambiguous_items = parsed["ambiguous_items"] + ambiguous_items
+
+    return {
+        "needs_clarification": bool(
+            llm_extraction.get("needs_clarification") or ambiguous_items
+        ),
+        "items": parsed["items"] + llm_extraction.get("items", []),
+        "ambiguous_items": ambiguous_items,
+        "source": "merged"
+    }
+
+
+def extract_products(message_text: str, extraction=None):
+    """
+    Returns the extraction for a cart message, calling GPT
+    only for what the local parser could not resolve.
+    Model extractions feed the learned alias table.
+    """
+
+    if extraction is not None:
+        if extraction.get("source") not in ("local", "clarification", "merged"):
+            learn_from_extraction(extraction, is_ambiguous_phrase)
+        return extraction
+
+    product_catalog = get_product_catalog()
+
+    parsed = parse_products_locally(message_text, product_catalog)
+
+    local_extraction = complete_local_extraction(parsed)
+
+    if local_extraction is not None:
+        return local_extraction
+
+    llm_extraction = extract_order_products_with_gpt(
+        message_text=llm_remainder(message_text, parsed),
+        product_catalog=product_catalog
+    )
+
+    return merge_llm_extraction(message_text, parsed, llm_extraction)
+
+
+def suggest_products(segments: list) -> list:
+    """
+    Closest catalog products for segments nobody could resolve,
+    in ambiguous_items format (asked as numbered options).
+    """
+
+    ambiguous_items = []
+
+    for segment in segments:
+        quantity, phrase = split_quantity(segment)
+
+        if len(phrase) < ORDER_SUGGESTION_MIN_LENGTH:
+            continue
+
+        candidates = search_products(
+            phrase,
+            k=ORDER_SUGGESTION_MAX_OPTIONS,
+            threshold=ORDER_SUGGESTION_MIN_SIMILARITY
+        )
+
+        if candidates:
+            metrics.increment("extraction.suggested")
+            ambiguous_items.append({
+                "requested_text": phrase,
+                "quantity": quantity or 1,
+                "possible_matches": [
+                    {"sku": c["product"]["sku"], "name": c["product"]["product"]}
+                    for c in candidates
+                ]
+            })
+
+    return ambiguous_items
+
+
+
+# ==========================================================
+# Numbered clarifications
+# Ambiguous options are stored in conversation_state.context
+# so "la 2" / "el de 500" resolves without any LLM call.
+# ==========================================================
+def ask_clarification(customer_id: str, ambiguous_items: list) -> str:
+    """
+    Stores the numbered options as pending and returns the question.
+    """
+
+    pending = build_pending_clarification(ambiguous_items)
+
+    state = get_conversation_state(customer_id)
+    context = dict((state or {}).get("context") or {})
+    context["pending_clarification"] = pending
+
+    update_conversation_context(customer_id, context)
+
+    metrics.increment("clarification.asked")
+
+    return format_clarification_question(pending)
+
+
+def resolve_pending_clarification(message_text: str, pending: dict):
+    """
+    Returns an extraction for the picked options, or None when the
+    reply does not pick any (the message follows the normal flow).
+    Picks are NOT learned as aliases: every option group is a family
+    with several presentations or a list of suggestions, so the pick
+    is this customer's choice, not what the phrase means.
+    """
+
+    resolution = resolve_clarification_reply(message_text, pending)
+
+    if resolution is None:
+        metrics.increment("clarification.unresolved")
+        return None
+
+    items, remaining = resolution
+
+    metrics.increment("clarification.resolved_locally")
+
+    return {
+        "needs_clarification": bool(remaining),
+        "items": items,
+        "ambiguous_items": groups_to_ambiguous_items(remaining),
+        "source": "clarification"
+    }
+
+
 
 def handle_place_order_intent(customer_id, message_text):
     """
@@ -131,99 +505,266 @@ def handle_view_cart(customer_id):
 
     draft_order_id = draft["draft_order_id"]
 
-    totals = price_draft_order_simple(draft_order_id)
+    # 🔹 Rendered on the last cart change: served as stored while
+    # the lines and the active promotion set are the ones it was
+    # rendered from (a failed reprice or a concurrent edit can
+    # leave it behind)
+    cart_summary = draft.get("cart_summary") or {}
+
+    if (
+        summary_matches_cart(draft, get_draft_order_lines(draft_order_id))
+        and cart_summary.get("promotion_version") == get_promotion_index()["version"]
+    ):
+        metrics.increment("cart_summary.hit")
+        return cart_summary["message"]
+
+    metrics.increment("cart_summary.miss")
+
+    pricing = reprice_draft_order(draft_order_id)
+
+    return format_cart_summary(draft_order_id, pricing)
+
+def summary_cart_version(lines) -> str:
+    """
+    Version of the draft lines a summary was rendered from
+    (independent of the order rows are read in).
+    """
+    return cart_version(sorted(lines, key=lambda line: line["sku"]))
+
 
-    return format_cart_summary(draft_order_id, totals)
+def summary_matches_cart(draft, lines) -> bool:
+    """
+    True when the stored summary, and the line numbering saved
+    with it, were rendered from exactly these lines.
+    """
+    cart_summary = draft.get("cart_summary") or {}
+
+    return bool(cart_summary.get("message")) and (
+        cart_summary.get("cart_version") == summary_cart_version(lines)
+    )
 
 # ==========================================================
-# Price Draft Order Simple
+# Draft Order Pricing (persisted promotion allocations)
 # ==========================================================
-def price_draft_order_simple(draft_order_id):
+def reprice_draft_order(draft_order_id, retry=True):
+    """
+    Runs after every cart change: evaluates promotions, writes the
+    per-line allocations that changed and the header totals
+    derived from the stored lines. If the cart changed while it
+    was being priced, it is re-read and priced once more.
+    Returns the pricing shown by format_cart_summary.
+    """
 
     lines = get_draft_order_lines(draft_order_id)
 
-    subtotal = 0
+    cart_lines = get_cart_with_product_data(draft_order_id, lines)
 
-    for line in lines:
-        line_total = line["quantity"] * float(line["unit_price"])
-        subtotal += line_total
+    promotion_index = get_promotion_index()  # compiled once per load
 
-    total = subtotal
+    promotion_result = evaluate_promotions(cart_lines, promotion_index, draft_order_id)
 
-    update_draft_order_totals(draft_order_id)
+    allocations = {
+        allocation["sku"]: allocation
+        for allocation in promotion_result["lines"]
+    }
+
+    # 🔹 Every amount in integer cents, one pass over the cart
+    priced = price_cart(
+        build_cart(lines),
+        [
+            (allocations.get(line["sku"]) or {}).get("discount_amount", 0.0)
+            for line in lines
+        ]
+    )
+
+    changed_lines = []
+
+    for position, line in enumerate(lines):
+        allocation = allocations.get(line["sku"]) or {}
+
+        values = line_values(priced, position)
+        values["applied_promotion_id"] = (
+            allocation.get("promotion_id")
+            if priced["discount"][position] > 0 else None
+        )
+
+        if (
+            line.get("applied_promotion_id") != values["applied_promotion_id"]
+            or any(
+                to_cents(line.get(field)) != to_cents(values[field])
+                for field in ["line_subtotal", "discount_amount", "final_line_total"]
+            )
+        ):
+            line.update(values)
+            changed_lines.append(line)
+
+    # 🔹 Only the pricing columns of the lines whose allocation changed
+    if changed_lines:
+        saved = save_draft_line_allocations(changed_lines)
+
+        # Lines and header keep their previous (consistent) values
+        if saved is None:
+            return draft_pricing(lines, promotion_index, priced)
+
+        # A line was deleted or its quantity changed meanwhile
+        # (concurrent message): price the current cart instead
+        if len(saved) < len(changed_lines) and retry:
+            metrics.increment("draft_pricing.conflict")
+            return reprice_draft_order(draft_order_id, retry=False)
+
+    update_draft_order_totals(draft_order_id, priced=priced)
+
+    return draft_pricing(lines, promotion_index, priced)
+
+
+def draft_pricing(lines, promotion_index, priced=None):
+    """
+    Totals and applied promotions derived from the stored lines:
+    {
+        "lines": [...],
+        "subtotal": float,
+        "total_discount": float,
+        "total": float,
+        "applied_promotions": [{ "promotion_id", "name", "discount" }],
+        "upsell_suggestions": [{ "promotion_id", "message" }],
+        "cart_version": str,
+        "promotion_version": str
+    }
+    priced: the pricing kernel result for these lines, when the
+    caller already computed it (reprice_draft_order).
+    """
+
+    if priced is None:
+        priced = price_lines(lines)
+
+    rules = promotion_index["rules"]
+    position_by_id = promotion_index["position_by_id"]
+
+    # promotion_id → discount cents
+    discounts = {}
+
+    for position, line in enumerate(lines):
+        promotion_id = line.get("applied_promotion_id")
+
+        if promotion_id:
+            discounts[promotion_id] = (
+                discounts.get(promotion_id, 0) + int(priced["discount"][position])
+            )
+
+    applied = []
+
+    for promotion_id in sorted(discounts, key=lambda p: position_by_id.get(p, len(rules))):
+        position = position_by_id.get(promotion_id)
+
+        applied.append({
+            "promotion_id": promotion_id,
+            # A promotion deactivated since the line was priced
+            "name": rules[position].name if position is not None else "Promoción",
+            "discount": from_cents(discounts[promotion_id])
+        })
 
     return {
-        "subtotal": round(subtotal, 2),
-        "total": round(total, 2)
+        "lines": [
+            {**line, **line_values(priced, position)}
+            for position, line in enumerate(lines)
+        ],
+        "subtotal": from_cents(priced["subtotal"]),
+        "total_discount": from_cents(priced["discount_total"]),
+        "total": from_cents(priced["total"]),
+        "applied_promotions": applied,
+        "upsell_suggestions": upsell_suggestions(lines, promotion_index, set(discounts)),
+        "cart_version": summary_cart_version(lines),
+        "promotion_version": promotion_index["version"]
     }
 
 # ==========================================================
 # Cart Summary 
 # ==========================================================
-def format_cart_summary(draft_order_id, totals):
+def format_cart_summary(draft_order_id, pricing):
+    """
+    pricing: reprice_draft_order (persisted line discounts;
+    nothing is evaluated here).
 
-    lines = get_draft_order_lines(draft_order_id)
+    Runs on every cart change: the rendered summary is stored with
+    the draft (with the cart and promotion versions it was built
+    from) so view-cart is a single read.
+    """
 
-    if not lines:
-        return "🛒 Tu carrito está vacío."
+    # Stable numbering: oldest line first
+    lines = sorted(
+        pricing["lines"],
+        key=lambda line: (line.get("created_at") or "", line["sku"])
+    )
 
-    # ------------------------------------------------------
-    # 🧠 1️⃣ Build enriched cart
-    # ------------------------------------------------------
-    cart_lines = get_cart_with_product_data(draft_order_id)
+    message = render_cart_summary(lines, pricing)
 
-    # ------------------------------------------------------
-    # 🧠 2️⃣ Load active promotions
-    # ------------------------------------------------------
-    promotions = get_active_promotions()  # you should already have this
+    # 🔹 Line number → SKU (for "quita la 2" / "cambia la 3 a 5")
+    # and the rendered summary, in one write
+    save_draft_cart_summary(
+        draft_order_id,
+        {
+            str(number): {
+                "sku": line["sku"],
+                "unit_price": float(line["unit_price"])
+            }
+            for number, line in enumerate(lines, start=1)
+        },
+        {
+            "message": message,
+            "cart_version": pricing["cart_version"],
+            "promotion_version": pricing["promotion_version"]
+        }
+    )
 
-    # ------------------------------------------------------
-    # 🧠 3️⃣ Evaluate promotions
-    # ------------------------------------------------------
-    promotion_result = evaluate_promotions(cart_lines, promotions)
+    return message
 
-    total_discount = promotion_result.get("total_discount", 0.0)
 
-    # ------------------------------------------------------
-    # 🧮 4️⃣ Recalculate totals safely
-    # ------------------------------------------------------
-    subtotal = totals.get("subtotal", 0.0)
-    final_total = subtotal - total_discount
+def render_cart_summary(lines, pricing):
+    """
+    Cart summary message of the (already numbered) lines.
+    """
 
-    # Update totals dict (so nothing else breaks)
-    totals["total_discount"] = total_discount
-    totals["total"] = final_total
-    totals["applied_promotions"] = promotion_result.get("applied", [])
-    totals["upsell_suggestions"] = promotion_result.get("upsell", [])
+    if not lines:
+        return "🛒 Tu carrito está vacío."
+
+    subtotal = pricing["subtotal"]
+    total_discount = pricing["total_discount"]
+    final_total = pricing["total"]
 
     # ------------------------------------------------------
-    # 🛒 5️⃣ Build message
+    # 🛒 Build message
     # ------------------------------------------------------
     message = "🛒 *Tu pedido actual:*\n\n"
 
-    for line in lines:
+    for number, line in enumerate(lines, start=1):
         sku = line["sku"]
         quantity = line["quantity"]
         unit_price = float(line["unit_price"])
-        line_total = quantity * unit_price
+        line_total = line["line_subtotal"]
+        discount = line["discount_amount"]
 
-        product = get_product_by_sku(sku)
+        product = get_catalog_product(sku) or get_product_by_sku(sku)
         product_name = product["product"] if product else sku
 
         message += (
-            f"{quantity}x *{product_name}*\n"
-            f"   ${unit_price:.2f} c/u  |  Total: ${line_total:.2f}\n\n"
+            f"{number}. {quantity}x *{product_name}*\n"
+            f"   ${unit_price:.2f} c/u  |  Total: ${line_total:.2f}"
         )
 
+        if discount > 0:
+            message += f"  |  Desc: -${discount:.2f}"
+
+        message += "\n\n"
+
     message += "-----------------------------\n"
     message += f"Subtotal: ${subtotal:.2f}\n"
 
     # ------------------------------------------------------
     # 🎉 Promotions display
     # ------------------------------------------------------
-    if totals["applied_promotions"]:
+    if pricing["applied_promotions"]:
         message += "\n🎉 *Promociones aplicadas:*\n"
-        for promo in totals["applied_promotions"]:
+        for promo in pricing["applied_promotions"]:
             message += f"• {promo['name']} (-${promo['discount']:.2f})\n"
 
         message += f"\nDescuento total: -${total_discount:.2f}\n"
@@ -233,14 +774,15 @@ def format_cart_summary(draft_order_id, totals):
     # ------------------------------------------------------
     # 💡 Upsell
     # ------------------------------------------------------
-    if totals["upsell_suggestions"]:
+    if pricing["upsell_suggestions"]:
         message += "\n💡 *Ofertas disponibles:*\n"
-        for suggestion in totals["upsell_suggestions"]:
+        for suggestion in pricing["upsell_suggestions"]:
             message += f"• {suggestion['message']}\n"
 
     message += (
         "\nEscribe *confirmar* o *cancelar* para finalizar "
         "o agrega más productos."
+        "\nPara editar usa el número: *quita la 2* o *cambia la 1 a 3 piezas*."
     )
 
     return message
@@ -288,7 +830,7 @@ def handle_cancel_order(customer_id):
 # ==========================================================
 # Add to Daft Order 
 # ==========================================================
-def handle_add_to_cart(customer_id, message_text):
+def handle_add_to_cart(customer_id, message_text, extraction=None):
     logging.info("🟢 handle_add_to_cart")
 
     draft = get_active_draft_order(customer_id)
@@ -298,22 +840,8 @@ def handle_add_to_cart(customer_id, message_text):
 
     draft_order_id = draft["draft_order_id"]
 
-    # Load product catalog
-    products = get_all_products()
-
-    product_catalog = [
-        {
-            "sku": p["sku"],
-            "name": p["product"]
-        }
-        for p in products
-    ]
-
-    # GPT extraction
-    extraction = extract_order_products_with_gpt(
-        message_text=message_text,
-        product_catalog=product_catalog
-    )
+    # Product extraction (local resolvers first, GPT as fallback)
+    extraction = extract_products(message_text, extraction)
 
     logging.info("🛒 GPT Extraction Result:")
     logging.info(json.dumps(extraction, indent=2, ensure_ascii=False))
@@ -323,17 +851,7 @@ def handle_add_to_cart(customer_id, message_text):
 
     # Handle ambiguous
     if ambiguous_items:
-        reply = "Necesito un poco más de información 👇\n\n"
-
-        for product in ambiguous_items:
-            reply += f"Para *{product['requested_text']}* tengo estas opciones:\n"
-            for option in product["possible_matches"]:
-                reply += f"- {option['name']} ({option['sku']})\n"
-            reply += "\n"
-
-        reply += "¿Cuál prefieres?"
-
-        return reply
+        return ask_clarification(customer_id, ambiguous_items)
 
     if not items:
         return (
@@ -358,9 +876,9 @@ def handle_add_to_cart(customer_id, message_text):
             quantity=quantity
         )
 
-    totals = price_draft_order_simple(draft_order_id)
+    pricing = reprice_draft_order(draft_order_id)
 
-    cart_summary = format_cart_summary(draft_order_id, totals)
+    cart_summary = format_cart_summary(draft_order_id, pricing)
 
     return f"✅ Listo, ya se agregó a tu pedido.\n{cart_summary}"
 
@@ -369,7 +887,7 @@ def handle_add_to_cart(customer_id, message_text):
 # ==========================================================
 # Modify Draft Order
 # ==========================================================
-def handle_modify_cart(customer_id: str, message_text: str):
+def handle_modify_cart(customer_id: str, message_text: str, extraction=None):
     logging.info("🟢 handle_modify_cart")
 
     draft = get_active_draft_order(customer_id)
@@ -378,23 +896,16 @@ def handle_modify_cart(customer_id: str, message_text: str):
 
     draft_order_id = draft["draft_order_id"]
 
-    operation, remove_all_flag = detect_cart_operation(message_text)
+    # 🔹 Positional edit over the numbered summary (no LLM call)
+    line_command = parse_line_command(message_text)
 
-    # Load products for GPT matching
-    products = get_all_products()
+    if line_command:
+        return apply_line_command(draft, line_command)
 
-    product_catalog = [
-        {
-            "sku": p["sku"],
-            "name": p["product"]
-        }
-        for p in products
-    ]
+    operation, remove_all_flag = detect_cart_operation(message_text)
 
-    extraction = extract_order_products_with_gpt(
-        message_text=message_text,
-        product_catalog=product_catalog
-    )
+    # Product extraction (local resolvers first, GPT as fallback)
+    extraction = extract_products(message_text, extraction)
 
     items = extraction.get("items", [])
 
@@ -428,21 +939,83 @@ def handle_modify_cart(customer_id: str, message_text: str):
             )
 
 
-    update_draft_order_totals(draft_order_id)
+    pricing = reprice_draft_order(draft_order_id)
+
+    cart_summary = format_cart_summary(draft_order_id, pricing)
+
+    return f"✅ Listo, ya se modificó tu pedido.\n{cart_summary}"
 
-    totals = price_draft_order_simple(draft_order_id)
 
-    cart_summary = format_cart_summary(draft_order_id, totals)
+
+def apply_line_command(draft: dict, line_command: dict) -> str:
+    """
+    Applies "quita la N" / "cambia la N a Q" using the line index
+    persisted by the last cart summary: one write, no extraction.
+    The index is only trusted while it matches the current lines;
+    otherwise the customer gets the current numbering instead.
+    """
+
+    draft_order_id = draft["draft_order_id"]
+    number = line_command["line"]
+
+    lines = get_draft_order_lines(draft_order_id)
+
+    if not summary_matches_cart(draft, lines):
+        metrics.increment("cart.line_command.stale_index")
+
+        pricing = reprice_draft_order(draft_order_id)
+        cart_summary = format_cart_summary(draft_order_id, pricing)
+
+        return (
+            "Tu pedido cambió, estos son los números actuales. "
+            "Repite tu cambio con el número correcto 🙏\n"
+            f"{cart_summary}"
+        )
+
+    indexed = (draft.get("line_index") or {}).get(str(number))
+    line = next(
+        (line for line in lines if indexed and line["sku"] == indexed["sku"]),
+        None
+    )
+
+    if not line:
+        metrics.increment("cart.line_command.unknown_line")
+        return (
+            f"No encontré la línea {number} en tu pedido.\n"
+            "Escribe 'ver pedido' para ver los números de cada producto."
+        )
+
+    if line_command["action"] == "remove":
+        delete_draft_line(
+            draft_order_id=draft_order_id,
+            sku=line["sku"]
+        )
+    else:
+        # Price of the current line, not of the index snapshot
+        set_draft_line_quantity(
+            draft_order_id=draft_order_id,
+            sku=line["sku"],
+            quantity=line_command["quantity"],
+            unit_price=float(line["unit_price"])
+        )
+
+    metrics.increment(f"cart.line_command.{line_command['action']}")
+
+    pricing = reprice_draft_order(draft_order_id)
+
+    cart_summary = format_cart_summary(draft_order_id, pricing)
 
     return f"✅ Listo, ya se modificó tu pedido.\n{cart_summary}"
 
 
 
-def handle_cart_intent(customer_id: str, message_text: str):
+def handle_cart_intent(customer_id: str, message_text: str, extraction=None):
     """
     Unified handler for:
     - place_order
     - add_to_cart
+
+    extraction: optional pre-extracted products (fused intent call).
     """
 
     logging.info("🟢 handle_cart_intent")
@@ -450,21 +1023,22 @@ def handle_cart_intent(customer_id: str, message_text: str):
     draft = get_active_draft_order(customer_id)
 
     # 🔹 Extract products from message
-    products = get_all_products()
-    product_catalog = [
-        {"sku": p["sku"], "name": p["product"]}
-        for p in products
-    ]
-
-    extraction = extract_order_products_with_gpt(
-        message_text=message_text,
-        product_catalog=product_catalog
-    )
+    extraction = extract_products(message_text, extraction)
 
     items = extraction.get("items", [])
+    ambiguous_items = extraction.get("ambiguous_items", [])
 
     has_products = len(items) > 0
 
+    # 🔹 Ambiguous products → numbered options, stored as pending
+    clarification = (
+        ask_clarification(customer_id, ambiguous_items)
+        if ambiguous_items else None
+    )
+
+    if clarification and not has_products:
+        return clarification
+
     # =====================================================
     # SCENARIO 1: NO draft + NO products
     # =====================================================
@@ -492,11 +1066,12 @@ def handle_cart_intent(customer_id: str, message_text: str):
                 quantity=item.get("quantity", 1)
             )
 
-        update_draft_order_totals(draft_order_id)
-        totals = price_draft_order_simple(draft_order_id)
-        cart_summary = format_cart_summary(draft_order_id, totals)
+        pricing = reprice_draft_order(draft_order_id)
+        cart_summary = format_cart_summary(draft_order_id, pricing)
 
-        return f"✅ Listo, ya creé tu pedido.\n\n{cart_summary}"
+        reply = f"✅ Listo, ya creé tu pedido.\n\n{cart_summary}"
+
+        return f"{reply}\n\n{clarification}" if clarification else reply
 
     # =====================================================
     # SCENARIO 3: YES draft + NO products
@@ -525,11 +1100,12 @@ def handle_cart_intent(customer_id: str, message_text: str):
                 quantity=item.get("quantity", 1)
             )
 
-        update_draft_order_totals(draft_order_id)
-        totals = price_draft_order_simple(draft_order_id)
-        cart_summary = format_cart_summary(draft_order_id, totals)
+        pricing = reprice_draft_order(draft_order_id)
+        cart_summary = format_cart_summary(draft_order_id, pricing)
+
+        reply = f"✅ Listo, ya se agregó a tu pedido.\n\n{cart_summary}"
 
-        return f"✅ Listo, ya se agregó a tu pedido.\n\n{cart_summary}"
+        return f"{reply}\n\n{clarification}" if clarification else reply
 
 
 
@@ -537,10 +1113,11 @@ def handle_cart_intent(customer_id: str, message_text: str):
 # Get cart with product data
 # ==========================================================
 
-def get_cart_with_product_data(draft_order_id: str):
+def get_cart_with_product_data(draft_order_id: str, lines: list | None = None):
     """
     Returns enriched cart lines including product metadata
     needed for promotion evaluation.
+    lines: the draft lines when the caller already has them.
 
     Output structure:
     [
@@ -560,7 +1137,8 @@ def get_cart_with_product_data(draft_order_id: str):
     # -----------------------------------------------------
     # 1️⃣ Fetch draft order lines
     # -----------------------------------------------------
-    lines = get_draft_order_lines(draft_order_id)
+    if lines is None:
+        lines = get_draft_order_lines(draft_order_id)
 
     if not lines:
         return []
@@ -606,10 +1184,15 @@ def get_cart_with_product_data(draft_order_id: str):
             "category_id": product.get("category_id"),
             "line_id": product.get("line_id"),
             "quantity": quantity,
-            "unit_price": unit_price,
-            "line_subtotal": quantity * unit_price
+            "unit_price": unit_price
         })
 
+    # 🔹 Line subtotals from the pricing kernel (integer cents)
+    priced = price_cart(build_cart(enriched_cart))
+
+    for position, line in enumerate(enriched_cart):
+        line["line_subtotal"] = from_cents(priced["line_subtotal"][position])
+
     return enriched_cart
 
 
@@ -619,9 +1202,12 @@ def get_cart_with_product_data(draft_order_id: str):
 # Evaluate promotions
 # ==========================================================
 
-def evaluate_promotions(cart_lines: list, promotions: list):
+def evaluate_promotions(cart_lines: list, promotion_index: dict, draft_order_id: str | None = None):
     """
-    Evaluates active promotions against enriched cart_lines.
+    Runs the promotion engine (promotions.evaluate_cart: one
+    promotion per line, caps respected) over enriched cart_lines.
+    With a draft_order_id the evaluation is incremental on the
+    draft's previous cart (promotions.evaluate_draft_cart).
 
     cart_lines structure:
     [
@@ -640,178 +1226,95 @@ def evaluate_promotions(cart_lines: list, promotions: list):
     Returns:
     {
         "applied": [ ... ],
-        "upsell": [ ... ],
+        "lines": [ ... ],   # per-line allocation, same order as cart_lines
         "total_discount": float
     }
     """
 
-    applied = []
-    upsell = []
-    total_discount = 0.0
-
     if not cart_lines:
         return {
             "applied": [],
-            "upsell": [],
+            "lines": [],
             "total_discount": 0.0
         }
 
-    # Sort by priority (higher first)
-    promotions_sorted = sorted(
-        promotions,
-        key=lambda x: x.get("priority_weight", 0),
-        reverse=True
-    )
-
-    for promo in promotions_sorted:
-
-        if not promo.get("is_active"):
-            continue
-
-        try:
-            rules = json.loads(promo.get("rules", "{}"))
-            reward = json.loads(promo.get("reward", "{}"))
-        except Exception:
-            continue  # skip malformed promotions safely
-
-        promo_name = promo.get("name")
+    if draft_order_id:
+        return evaluate_draft_cart(draft_order_id, cart_lines, promotion_index)
 
-        # =====================================================
-        # 1️⃣ CATEGORY OR LINE PERCENTAGE PROMOTIONS
-        # =====================================================
-        if rules.get("scope") in ["category", "line"]:
+    return evaluate_cart(cart_lines, promotion_index)
 
-            scope_key = "category_id" if rules["scope"] == "category" else "line_id"
-            eligible_ids = rules.get("category_ids") or rules.get("line_ids") or []
 
-            matching_lines = [
-                line for line in cart_lines
-                if line.get(scope_key) in eligible_ids
-            ]
-
-            if matching_lines:
+def upsell_suggestions(lines: list, promotion_index: dict, applied_ids: set) -> list:
+    """
+    Near-miss promotions of the cart's SKUs plus the featured ones,
+    minus those already applied (never a full scan).
+    lines: anything with "sku" and "quantity".
+    """
 
-                subtotal = sum(line["line_subtotal"] for line in matching_lines)
+    rules = promotion_index["rules"]
 
-                if reward.get("type") == "percentage":
-                    discount = subtotal * (reward.get("value", 0) / 100)
+    upsell_positions = (
+        near_miss_positions(promotion_index, {line["sku"] for line in lines})
+        | set(promotion_index["featured"])
+    )
 
-                    # Optional discount cap
-                    cap = promo.get("max_discount_cap")
-                    if cap:
-                        discount = min(discount, float(cap))
+    upsell = []
 
-                    total_discount += discount
+    for position in sorted(upsell_positions):
 
-                    applied.append({
-                        "promotion_id": promo.get("promotion_id"),
-                        "name": promo_name,
-                        "discount": round(discount, 2)
-                    })
+        promo = rules[position]
 
-            else:
-                # Basic upsell suggestion
-                upsell.append({
-                    "promotion_id": promo.get("promotion_id"),
-                    "message": f"Agrega productos incluidos en '{promo_name}' y obtén {reward.get('value')}% de descuento."
-                })
-
-        # =====================================================
-        # 2️⃣ BUY X GET Y (BROCHAS TYPE)
-        # =====================================================
-        if rules.get("scope") == "product_group":
-
-            eligible_skus = rules.get("product_skus", [])
-            buy_qty = rules.get("buy_quantity", 0)
-            reward_qty = rules.get("reward_quantity", 0)
-
-            matching_lines = [
-                line for line in cart_lines
-                if line["sku"] in eligible_skus
-            ]
+        if promo.promotion_id in applied_ids:
+            continue
 
-            total_qty = sum(line["quantity"] for line in matching_lines)
+        message = upsell_message(promo, lines)
 
-            if total_qty >= buy_qty + reward_qty and reward.get("type") == "percentage":
+        if message:
+            upsell.append({
+                "promotion_id": promo.promotion_id,
+                "message": message
+            })
 
-                # Apply discount to cheapest eligible items
-                expanded_units = []
+    return upsell
 
-                for line in matching_lines:
-                    for _ in range(line["quantity"]):
-                        expanded_units.append(line["unit_price"])
 
-                expanded_units.sort()  # cheapest first
+def upsell_message(promo, cart_lines: list) -> str | None:
+    """
+    Suggestion for a promotion the cart does not activate yet.
+    """
+    promo_name = promo.name
+    reward_value = promo.reward_value
 
-                eligible_rewards = total_qty // (buy_qty + reward_qty)
+    if promo.kind == "percentage":
+        return f"Agrega productos incluidos en '{promo_name}' y obtén {reward_value:g}% de descuento."
 
-                discount = 0.0
-                for i in range(min(eligible_rewards * reward_qty, len(expanded_units))):
-                    discount += expanded_units[i] * (reward.get("value", 0) / 100)
+    if promo.kind == "buy_x_get_y":
 
-                total_discount += discount
+        buy_qty = promo.buy_quantity
+        reward_qty = promo.reward_quantity
 
-                applied.append({
-                    "promotion_id": promo.get("promotion_id"),
-                    "name": promo_name,
-                    "discount": round(discount, 2)
-                })
+        total_qty = sum(
+            line["quantity"] for line in cart_lines
+            if line["sku"] in promo.product_skus
+        )
 
-            else:
-                missing = buy_qty - total_qty
-                if missing > 0:
-                    upsell.append({
-                        "promotion_id": promo.get("promotion_id"),
-                        "message": f"Agrega {missing} producto(s) más para activar '{promo_name}'."
-                    })
-                elif total_qty >= buy_qty and total_qty < buy_qty + reward_qty:
-                    upsell.append({
-                        "promotion_id": promo.get("promotion_id"),
-                        "message": f"Agrega {reward_qty} producto adicional para obtener el beneficio de '{promo_name}'."
-                    })
-
-        # =====================================================
-        # 3️⃣ TRIGGER + REWARD (ARGÁN TYPE)
-        # =====================================================
-        if rules.get("trigger_products"):
-
-            trigger_products = rules.get("trigger_products", [])
-            reward_products = rules.get("reward_products", [])
-
-            has_trigger = any(
-                line["sku"] in trigger_products
-                for line in cart_lines
-            )
+        missing = buy_qty - total_qty
 
-            reward_lines = [
-                line for line in cart_lines
-                if line["sku"] in reward_products
-            ]
+        if missing > 0:
+            return f"Agrega {missing} producto(s) más para activar '{promo_name}'."
 
-            if has_trigger and reward_lines and reward.get("type") == "percentage":
+        if total_qty < buy_qty + reward_qty:
+            return f"Agrega {reward_qty} producto adicional para obtener el beneficio de '{promo_name}'."
 
-                discount = sum(
-                    line["line_subtotal"] * (reward.get("value", 0) / 100)
-                    for line in reward_lines
-                )
+        return None
 
-                total_discount += discount
+    if promo.kind == "bundle":
 
-                applied.append({
-                    "promotion_id": promo.get("promotion_id"),
-                    "name": promo_name,
-                    "discount": round(discount, 2)
-                })
+        has_trigger = any(line["sku"] in promo.trigger_skus for line in cart_lines)
+        has_reward = any(line["sku"] in promo.reward_skus for line in cart_lines)
 
-            elif has_trigger and not reward_lines:
-                upsell.append({
-                    "promotion_id": promo.get("promotion_id"),
-                    "message": f"Agrega el producto complementario y obtén {reward.get('value')}% de descuento en '{promo_name}'."
-                })
+        if has_trigger and not has_reward:
+            return f"Agrega el producto complementario y obtén {reward_value:g}% de descuento en '{promo_name}'."
 
-    return {
-        "applied": applied,
-        "upsell": upsell,
-        "total_discount": round(total_discount, 2)
-    }
+    return None
 
@@ -0,0 +1,227 @@
+import re
+
+from utils import normalize_text
+from order_parser import content_tokens
+
+# ==========================================================
+# Product families & presentations
+#
+# "Shampoo Argán Avyna 250 ml / 500 ml / 1 L" are ONE family
+# in three presentations. Families are built once per catalog
+# version, so matchers resolve a phrase to a family with an
+# inverted-index probe and pick the presentation by size,
+# instead of rediscovering the sizes through fuzzy matching.
+# ==========================================================
+
+# unit → (dimension, factor to the dimension base unit)
+UNITS = {
+    "ml": ("ml", 1), "l": ("ml", 1000), "lt": ("ml", 1000),
+    "lts": ("ml", 1000), "litro": ("ml", 1000), "litros": ("ml", 1000),
+    "g": ("g", 1), "gr": ("g", 1), "grs": ("g", 1), "gramos": ("g", 1),
+    "kg": ("g", 1000), "kilo": ("g", 1000), "kilos": ("g", 1000),
+    "oz": ("oz", 1),
+    "pz": ("pz", 1), "pza": ("pz", 1), "pzas": ("pz", 1),
+    "pieza": ("pz", 1), "piezas": ("pz", 1),
+}
+
+_UNIT_PATTERN = "|".join(sorted(UNITS, key=len, reverse=True))
+
+SIZE_PATTERN = re.compile(
+    rf"\b(\d+(?:[.,]\d+)?)\s*({_UNIT_PATTERN})?\b(?!\s*x)"
+)
+
+NAMED_SIZES = {
+    "medio litro": ("ml", 500),
+    "litro": ("ml", 1000),
+    "medio kilo": ("g", 500),
+    "kilo": ("g", 1000),
+}
+
+NAME_SIZE_PATTERN = re.compile(
+    rf"\s*\b\d+(?:[.,]\d+)?\s*(?:{_UNIT_PATTERN})\b",
+    re.IGNORECASE
+)
+
+
+# ==========================================================
+# Size parsing
+# ==========================================================
+def parse_size(text: str) -> dict | None:
+    """
+    '500 ml' → {"value": 500, "unit": "ml", "dimension": "ml", "amount": 500}
+    '1 L'    → {"value": 1, "unit": "l", "dimension": "ml", "amount": 1000}
+    '500'    → {"value": 500, "unit": None, "dimension": None, "amount": 500}
+    """
+    text = normalize_text(text)
+
+    matches = list(SIZE_PATTERN.finditer(text))
+    match = next((m for m in matches if m.group(2)), None)
+
+    # "medio litro", "un kilo" (only without an explicit number + unit)
+    if match is None:
+        for phrase, (dimension, amount) in NAMED_SIZES.items():
+            if re.search(rf"\b{phrase}\b", text):
+                return {
+                    "value": amount,
+                    "unit": dimension,
+                    "dimension": dimension,
+                    "amount": amount
+                }
+
+    if not matches:
+        return None
+
+    # Prefer a number carrying a unit; the last one otherwise
+    match = match or matches[-1]
+
+    value = float(match.group(1).replace(",", "."))
+    unit = match.group(2)
+    dimension, factor = UNITS[unit] if unit else (None, 1)
+
+    return {
+        "value": value,
+        "unit": unit,
+        "dimension": dimension,
+        "amount": value * factor
+    }
+
+
+def split_size(phrase: str) -> tuple[dict | None, str]:
+    """
+    'shampoo argan de 500 ml' → (size, 'shampoo argan')
+    """
+    size = parse_size(phrase)
+
+    text = normalize_text(phrase)
+
+    for named in NAMED_SIZES:
+        text = re.sub(rf"\b(?:de\s+)?{named}\b", " ", text)
+
+    text = SIZE_PATTERN.sub(" ", text)
+    text = re.sub(r"(?:\s*\b(?:de|del|el|la))+\s*$", "", text.strip())
+
+    return size, " ".join(text.split())
+
+
+def family_display_name(name: str) -> str:
+    return " ".join(NAME_SIZE_PATTERN.sub(" ", name).split())
+
+
+# ==========================================================
+# Family index (built once per catalog version)
+# ==========================================================
+def build_family_index(products: list) -> dict:
+    """
+    {
+        "families": { key: { "key", "name", "tokens", "presentations" } },
+        "by_sku": { sku: key },
+        "postings": { token: set(keys) }
+    }
+    presentations: [{ "sku", "size", "product" }] sorted by amount.
+    """
+    families = {}
+    by_sku = {}
+
+    for product in products:
+        name = product.get("product") or ""
+        size = parse_size(product.get("size") or "") or parse_size(name)
+
+        display_name = family_display_name(name)
+        key = normalize_text(display_name)
+
+        family = families.setdefault(key, {
+            "key": key,
+            "name": display_name,
+            "tokens": content_tokens(display_name),
+            "presentations": []
+        })
+
+        family["presentations"].append({
+            "sku": product["sku"],
+            "size": size,
+            "product": product
+        })
+        by_sku[product["sku"]] = key
+
+    postings = {}
+
+    for key, family in families.items():
+        family["presentations"].sort(
+            key=lambda p: (p["size"] or {}).get("amount") or 0
+        )
+        for token in family["tokens"]:
+            postings.setdefault(token, set()).add(key)
+
+    return {
+        "families": families,
+        "by_sku": by_sku,
+        "postings": postings
+    }
+
+
+def find_family(family_index: dict, phrase: str) -> dict | None:
+    """
+    The unique family whose name contains every token of the
+    (size-less) phrase. One postings intersection, no scan.
+    """
+    tokens = content_tokens(phrase)
+
+    if not tokens or all(token.isdigit() for token in tokens):
+        return None
+
+    postings = [family_index["postings"].get(token, set()) for token in tokens]
+    keys = set.intersection(*postings)
+
+    if len(keys) != 1:
+        return None
+
+    return family_index["families"][keys.pop()]
+
+
+def pick_presentation(family: dict, size: dict | None) -> dict | None:
+    """
+    The presentation matching the requested size; None when no
+    size was given or it does not match exactly one presentation.
+    """
+    if not size:
+        return None
+
+    def matches(presentation_size):
+        if not presentation_size:
+            return False
+
+        # Bare number: "el de 500", "el de 1"
+        if size["dimension"] is None:
+            return size["value"] in (
+                presentation_size["value"],
+                presentation_size["amount"]
+            )
+
+        return (
+            size["dimension"] == presentation_size["dimension"]
+            and size["amount"] == presentation_size["amount"]
+        )
+
+    picked = [p for p in family["presentations"] if matches(p["size"])]
+
+    return picked[0] if len(picked) == 1 else None
+
+
+def resolve_presentation(family_index: dict, phrase: str):
+    """
+    Returns (family, presentation):
+    - (None, None)      phrase is not a known family
+    - (family, None)    family found, size missing / not matching
+    - (family, picked)  single presentation
+    """
+    size, rest = split_size(phrase)
+
+    family = find_family(family_index, rest)
+
+    if not family:
+        return None, None
+
+    if len(family["presentations"]) == 1:
+        return family, family["presentations"][0]
+
+    return family, pick_presentation(family, size)
@@ -0,0 +1,120 @@
+from decimal import Decimal, ROUND_HALF_UP
+
+import numpy as np
+
+# ==========================================================
+# Cart pricing kernel (integer cents)
+#
+# Every money amount of a cart (line subtotal, discount, final
+# line total and the header totals) is computed here, over
+# parallel arrays in integer cents, in one pass. The draft
+# lines, the draft header and the cart summary all read these
+# numbers, so they always add up to the cent.
+#
+# Amounts enter with half-up rounding to the cent (Decimal on
+# their decimal text, never float round()) and leave as
+# 2-decimal floats for the database and display.
+# ==========================================================
+
+_CENT = Decimal("1")
+
+
+def to_cents(amount) -> int:
+    """
+    12.345 → 1235, "9.99" → 999, None → 0
+    """
+    if amount is None:
+        return 0
+
+    return int((Decimal(str(amount)) * 100).quantize(_CENT, rounding=ROUND_HALF_UP))
+
+
+def from_cents(cents) -> float:
+    return int(cents) / 100
+
+
+def build_cart(lines: list) -> dict:
+    """
+    Parallel arrays of a cart:
+    {
+        "skus", "category_ids", "line_ids": [...],   # scope keys
+        "quantity": int64[n],
+        "unit_cents": int64[n]
+    }
+    lines: draft lines or enriched cart lines (same order kept).
+    """
+    return {
+        "skus": [line["sku"] for line in lines],
+        "category_ids": [line.get("category_id") for line in lines],
+        "line_ids": [line.get("line_id") for line in lines],
+        "quantity": np.array([int(line["quantity"]) for line in lines], dtype=np.int64),
+        "unit_cents": np.array([to_cents(line["unit_price"]) for line in lines], dtype=np.int64)
+    }
+
+
+def price_cart(cart: dict, discounts: list | None = None) -> dict:
+    """
+    discounts: per-line discount amounts aligned with the cart
+    (None → no discounts). A discount never exceeds its line.
+
+    Returns (all integer cents):
+    {
+        "line_subtotal": int64[n],
+        "discount": int64[n],
+        "final_line_total": int64[n],
+        "subtotal": int,
+        "discount_total": int,
+        "total": int
+    }
+    """
+    line_subtotal = cart["quantity"] * cart["unit_cents"]
+
+    if discounts is None:
+        discount = np.zeros_like(line_subtotal)
+    else:
+        discount = np.array([to_cents(amount) for amount in discounts], dtype=np.int64)
+        discount = np.clip(discount, 0, line_subtotal)
+
+    final_line_total = line_subtotal - discount
+
+    return {
+        "line_subtotal": line_subtotal,
+        "discount": discount,
+        "final_line_total": final_line_total,
+        "subtotal": int(line_subtotal.sum()),
+        "discount_total": int(discount.sum()),
+        "total": int(final_line_total.sum())
+    }
+
+
+def price_lines(lines: list) -> dict:
+    """
+    price_cart of stored draft lines with their persisted
+    discount_amount.
+    """
+    return price_cart(
+        build_cart(lines),
+        [line.get("discount_amount") for line in lines]
+    )
+
+
+def line_values(priced: dict, position: int) -> dict:
+    """
+    Persistable line amounts of one position.
+    """
+    return {
+        "line_subtotal": from_cents(priced["line_subtotal"][position]),
+        "discount_amount": from_cents(priced["discount"][position]),
+        "final_line_total": from_cents(priced["final_line_total"][position])
+    }
+
+
+def totals(priced: dict) -> dict:
+    """
+    Header amounts (draft_orders columns).
+    """
+    return {
+        "subtotal": from_cents(priced["subtotal"]),
+        "discount_total": from_cents(priced["discount_total"]),
+        "final_total": from_cents(priced["total"])
+    }
@@ -1,8 +1,648 @@
+import itertools
+import json
+import logging
+import os
+import threading
+import time
+from dataclasses import dataclass
 from typing import Dict, List
 
+import metrics
+from cache import TTLCache, hash_payload
+from db import get_active_promotions
+from pricing import from_cents, to_cents
 
-def calculate_promotions(order: dict, promotions: List[dict]) -> Dict[str, dict]:
+
+# ===============================
+# Compiled promotion rules
+# ===============================
+
+@dataclass(frozen=True)
+class PromotionRule:
+    """
+    A promotion row compiled once at load time: JSON parsed,
+    scopes as frozensets, reward percent as a factor.
+
+    kind:
+    - "percentage":   reward on lines in scope (category / line / product)
+    - "buy_x_get_y":  every buy+reward eligible units, reward units discounted
+    - "bundle":       a trigger product in the cart discounts reward products
+    """
+    promotion_id: str
+    name: str
+    kind: str
+    priority: float
+    scope: str | None
+    scope_ids: frozenset
+    product_skus: frozenset
+    trigger_skus: frozenset
+    reward_skus: frozenset
+    buy_quantity: int
+    reward_quantity: int
+    reward_type: str
+    reward_value: float
+    reward_factor: float
+    max_discount_cap: float | None
+
+
+class InvalidPromotion(ValueError):
+    """
+    Raised by compile_promotion for rows that can never be evaluated.
+    """
+
+
+def _json_field(promo: dict, field: str) -> dict:
+    value = promo.get(field)
+
+    if value is None:
+        return {}
+
+    if isinstance(value, str):
+        try:
+            value = json.loads(value or "{}")
+        except ValueError as e:
+            raise InvalidPromotion(f"{field} is not valid JSON: {e}")
+
+    if not isinstance(value, dict):
+        raise InvalidPromotion(f"{field} must be an object")
+
+    return value
+
+
+def _id_set(rules: dict, key: str) -> frozenset:
+    values = rules.get(key) or []
+
+    if not isinstance(values, (list, tuple)):
+        raise InvalidPromotion(f"rules.{key} must be a list")
+
+    return frozenset(str(value) for value in values)
+
+
+def compile_promotion(promo: dict) -> PromotionRule:
+    """
+    Compiles one promotions row. Raises InvalidPromotion.
+    """
+    if not promo.get("promotion_id"):
+        raise InvalidPromotion("missing promotion_id")
+
+    rules = _json_field(promo, "rules")
+    reward = _json_field(promo, "reward")
+
+    scope = rules.get("scope")
+    promotion_type = promo.get("promotion_type")
+
+    trigger_skus = _id_set(rules, "trigger_products")
+    reward_skus = _id_set(rules, "reward_products")
+
+    if promotion_type == "buy_x_get_y" or scope == "product_group":
+        kind = "buy_x_get_y"
+    elif promotion_type == "bundle" or trigger_skus:
+        kind = "bundle"
+    elif scope in ("category", "line", "product"):
+        kind = "percentage"
+    else:
+        raise InvalidPromotion(f"unknown promotion shape (scope={scope!r})")
+
+    try:
+        reward_value = float(reward.get("value", 0))
+        buy_quantity = int(rules.get("buy_quantity") or 0)
+        reward_quantity = int(rules.get("reward_quantity") or 0)
+        cap = promo.get("max_discount_cap")
+        max_discount_cap = float(cap) if cap else None
+    except (TypeError, ValueError) as e:
+        raise InvalidPromotion(f"non numeric value: {e}")
+
+    if not 0 <= reward_value <= 100:
+        raise InvalidPromotion(f"reward value {reward_value} out of 0-100")
+
+    if kind == "buy_x_get_y" and (buy_quantity <= 0 or reward_quantity <= 0):
+        raise InvalidPromotion("buy_quantity and reward_quantity must be positive")
+
+    if kind == "bundle" and not (trigger_skus and reward_skus):
+        raise InvalidPromotion("bundle needs trigger_products and reward_products")
+
+    # category_ids / line_ids / product_skus depending on scope
+    if scope == "product":
+        scope_ids = _id_set(rules, "product_skus")
+    else:
+        scope_ids = _id_set(rules, "category_ids") or _id_set(rules, "line_ids")
+
+    return PromotionRule(
+        promotion_id=str(promo["promotion_id"]),
+        name=promo.get("name") or "",
+        kind=kind,
+        priority=float(promo.get("priority_weight") or 0),
+        scope=scope,
+        scope_ids=scope_ids,
+        product_skus=_id_set(rules, "product_skus"),
+        trigger_skus=trigger_skus,
+        reward_skus=reward_skus,
+        buy_quantity=buy_quantity,
+        reward_quantity=reward_quantity,
+        reward_type=reward.get("type") or "percentage",
+        reward_value=reward_value,
+        reward_factor=reward_value / 100,
+        max_discount_cap=max_discount_cap
+    )
+
+
+def compile_promotions(promotions: List[dict]) -> tuple:
+    """
+    Compiles active rows, highest priority first.
+    Malformed rows are logged once here and left out.
+    """
+    compiled = []
+
+    for promo in promotions:
+        if not promo.get("is_active", True):
+            continue
+
+        try:
+            compiled.append(compile_promotion(promo))
+        except InvalidPromotion as e:
+            logging.error(
+                f"❌ Promotion {promo.get('promotion_id')} "
+                f"({promo.get('name')}) rejected: {e}"
+            )
+
+    compiled.sort(key=lambda rule: rule.priority, reverse=True)
+
+    return tuple(compiled)
+
+
+# ===============================
+# Inverted promotion index
+# ===============================
+
+# Percentage promotions suggested to every cart they do not apply to
+PROMOTION_FEATURED_UPSELLS = int(os.getenv("PROMOTION_FEATURED_UPSELLS", "2"))
+
+
+def _add_posting(postings: dict, keys, position: int):
+    for key in keys:
+        postings.setdefault(key, set()).add(position)
+
+
+def build_promotion_index(rules: tuple, version: str | None = None) -> dict:
+    """
+    Maps cart keys to the positions (in rules, priority order) of
+    the promotions that reference them:
+    - by_sku / by_category / by_line: promotions a cart key can activate
+    - by_reward_sku: bundles by reward SKU (the lines they discount)
+    - near_miss_by_sku: promotions worth an upsell when the cart has
+      the SKU but not the rest (buy_x_get_y units, bundle triggers)
+    - featured: top percentage promotions suggested when not applied
+    """
+    by_sku = {}
+    by_category = {}
+    by_line = {}
+    by_reward_sku = {}
+    near_miss_by_sku = {}
+    featured = []
+
+    for position, rule in enumerate(rules):
+
+        if rule.kind == "percentage":
+            if rule.scope == "category":
+                _add_posting(by_category, rule.scope_ids, position)
+            elif rule.scope == "line":
+                _add_posting(by_line, rule.scope_ids, position)
+            else:
+                _add_posting(by_sku, rule.scope_ids, position)
+
+            if (
+                rule.scope in ("category", "line")
+                and rule.reward_type == "percentage"
+                and len(featured) < PROMOTION_FEATURED_UPSELLS
+            ):
+                featured.append(position)
+
+        elif rule.kind == "buy_x_get_y":
+            _add_posting(by_sku, rule.product_skus, position)
+            _add_posting(near_miss_by_sku, rule.product_skus, position)
+
+        elif rule.kind == "bundle":
+            # Only a trigger can activate a bundle
+            _add_posting(by_sku, rule.trigger_skus, position)
+            _add_posting(by_reward_sku, rule.reward_skus, position)
+            _add_posting(near_miss_by_sku, rule.trigger_skus, position)
+
+    def freeze(postings):
+        return {key: frozenset(value) for key, value in postings.items()}
+
+    return {
+        "version": version,
+        "rules": rules,
+        "position_by_id": {rule.promotion_id: position for position, rule in enumerate(rules)},
+        "by_sku": freeze(by_sku),
+        "by_category": freeze(by_category),
+        "by_line": freeze(by_line),
+        "by_reward_sku": freeze(by_reward_sku),
+        "near_miss_by_sku": freeze(near_miss_by_sku),
+        "featured": tuple(featured)
+    }
+
+
+def candidate_positions(index: dict, skus, category_ids=(), line_ids=()) -> list:
+    """
+    Positions of the promotions referencing any cart key,
+    in priority order.
+    """
+    positions = set()
+
+    for sku in skus:
+        positions |= index["by_sku"].get(sku, frozenset())
+
+    for category_id in category_ids:
+        positions |= index["by_category"].get(category_id, frozenset())
+
+    for line_id in line_ids:
+        positions |= index["by_line"].get(line_id, frozenset())
+
+    return sorted(positions)
+
+
+def near_miss_positions(index: dict, skus) -> set:
+    positions = set()
+
+    for sku in skus:
+        positions |= index["near_miss_by_sku"].get(sku, frozenset())
+
+    return positions
+
+
+# ===============================
+# Loaded promotions (compiled once per load)
+# ===============================
+
+PROMOTIONS_TTL_SECONDS = float(os.getenv("PROMOTIONS_TTL_SECONDS", "300"))
+
+_lock = threading.Lock()
+_loaded = None
+_loaded_at = 0.0
+
+
+def get_promotion_index() -> dict:
+    """
+    Inverted index of the loaded rules (see build_promotion_index).
+    """
+    return get_promotion_set()["index"]
+
+
+def get_promotion_set() -> dict:
+    """
+    { "rules": tuple[PromotionRule], "index": dict, "version": str }
+    of the active promotions, reloaded after PROMOTIONS_TTL_SECONDS.
+    """
+    global _loaded, _loaded_at
+
+    with _lock:
+        if _loaded is None or time.monotonic() - _loaded_at >= PROMOTIONS_TTL_SECONDS:
+            rows = get_active_promotions()
+
+            rules = compile_promotions(rows)
+            version = hash_payload(rows)
+
+            _loaded = {
+                "rules": rules,
+                "index": build_promotion_index(rules, version),
+                "version": version
+            }
+            _loaded_at = time.monotonic()
+
+        return _loaded
+
+
+# ===============================
+# Unified promotion engine
+# ===============================
+
+# Lines competing for capped / buy_x_get_y promotions are solved
+# exhaustively up to this many assignments per group of lines,
+# and by PROMOTION_MAX_PASSES of line moves beyond it (two line
+# moves only in groups up to PROMOTION_PAIR_MOVE_LINES lines)
+PROMOTION_EXACT_ASSIGNMENTS = int(os.getenv("PROMOTION_EXACT_ASSIGNMENTS", "512"))
+PROMOTION_MAX_PASSES = int(os.getenv("PROMOTION_MAX_PASSES", "8"))
+PROMOTION_PAIR_MOVE_LINES = int(os.getenv("PROMOTION_PAIR_MOVE_LINES", "12"))
+
+
+def evaluate_cart(lines: list, promotion_index: dict, cart_skus: set | None = None) -> dict:
     """
+    Evaluates every candidate promotion in one pass and assigns at
+    most ONE promotion per line (no stacking), maximizing the total
+    discount. max_discount_cap bounds each promotion's total;
+    priority decides between equal discounts.
+
+    lines: [{ "sku", "category_id", "line_id", "quantity", "unit_price" }]
+    (line_id is the product line)
+    cart_skus: every SKU of the cart when lines is only part of it
+    (bundle triggers)
+
+    Returns:
+    {
+        "lines": [{ "sku", "promotion_id", "discount_amount" }],  # same order as lines
+        "applied": [{ "promotion_id", "name", "discount" }],       # priority order
+        "total_discount": float                                   # sum of line discounts
+    }
+    """
+    return _evaluate(lines, promotion_index, cart_skus)[0]
+
+
+def _evaluate(lines: list, promotion_index: dict, cart_skus: set | None = None) -> tuple:
+    """
+    evaluate_cart, also returning the per-line eligible positions
+    and the line groups (kept for incremental re-evaluation).
+    """
+    rules = promotion_index["rules"]
+
+    eligible = _eligible_positions(lines, promotion_index, cart_skus)
+
+    full_members = {}
+
+    for i, positions in enumerate(eligible):
+        for position in positions:
+            full_members.setdefault(position, set()).add(i)
+
+    groups = _line_groups(eligible, full_members)
+    members = _assign(lines, eligible, rules, full_members, groups)
+
+    allocations = [
+        {"sku": line["sku"], "promotion_id": None, "discount_amount": 0.0}
+        for line in lines
+    ]
+
+    for position in sorted(members):
+
+        rule = rules[position]
+
+        for i, discount in _allocate_rule(rule, lines, members[position]).items():
+            allocations[i]["promotion_id"] = rule.promotion_id
+            allocations[i]["discount_amount"] = discount
+
+    return _cart_result(allocations, promotion_index), eligible, groups
+
+
+# ===============================
+# Incremental re-evaluation (per draft)
+# ===============================
+
+PROMOTION_CACHE_MAX_DRAFTS = int(os.getenv("PROMOTION_CACHE_MAX_DRAFTS", "2048"))
+PROMOTION_CACHE_TTL_SECONDS = float(os.getenv("PROMOTION_CACHE_TTL_SECONDS", "3600"))
+
+# Recompute in full after every incremental evaluation and compare
+PROMOTION_VERIFY_INCREMENTAL = os.getenv("PROMOTION_VERIFY_INCREMENTAL", "false").lower() == "true"
+
+# Re-evaluate in full when the touched groups cover more of the cart
+PROMOTION_INCREMENTAL_MAX_SHARE = float(os.getenv("PROMOTION_INCREMENTAL_MAX_SHARE", "0.5"))
+
+# draft_order_id → last evaluation (see evaluate_draft_cart).
+# Entries are never mutated, so they are not copied on read.
+_draft_results = TTLCache(
+    PROMOTION_CACHE_MAX_DRAFTS,
+    PROMOTION_CACHE_TTL_SECONDS,
+    copy_values=False
+)
+
+
+def cart_version(lines: list) -> str:
+    return hash_payload([
+        [line["sku"], line.get("category_id"), line.get("line_id"), line["quantity"], line["unit_price"]]
+        for line in lines
+    ])
+
+
+def evaluate_draft_cart(draft_order_id: str, lines: list, promotion_index: dict) -> dict:
+    """
+    evaluate_cart with the last result of the draft cached by cart
+    version and promotion version:
+    - same cart → cached result
+    - one SKU added / removed / changed → only the line groups that
+      share a promotion indexed under that SKU, its category or its
+      line are re-evaluated; every other allocation is reused
+    - anything else (or touched groups above
+      PROMOTION_INCREMENTAL_MAX_SHARE of the lines) → full evaluation
+    """
+    metrics.increment("promotions.evaluations")
+
+    version = cart_version(lines)
+    entry = _draft_results.get(draft_order_id)
+
+    if entry and entry["promotion_version"] == promotion_index["version"]:
+
+        if entry["cart_version"] == version:
+            metrics.increment("promotions.cached")
+            return entry["result"]
+
+        changed = _changed_skus(entry["lines"], lines)
+
+        if changed is not None and len(changed) == 1:
+            updated = _evaluate_delta(entry, lines, changed.pop(), promotion_index)
+
+            if updated is not None:
+                metrics.increment("promotions.incremental")
+
+                if PROMOTION_VERIFY_INCREMENTAL:
+                    updated["result"] = _verify_incremental(
+                        draft_order_id, updated["result"], lines, promotion_index
+                    )
+
+                updated["cart_version"] = version
+                _store_draft_result(draft_order_id, updated)
+
+                return updated["result"]
+
+    metrics.increment("promotions.full")
+
+    result, eligible, groups = _evaluate(lines, promotion_index)
+
+    _store_draft_result(draft_order_id, {
+        "cart_version": version,
+        "promotion_version": promotion_index["version"],
+        "lines": lines,
+        "result": result,
+        **_group_maps(lines, eligible, groups)
+    })
+
+    return result
+
+
+def _store_draft_result(draft_order_id: str, entry: dict):
+    """
+    entry: {
+        "cart_version", "promotion_version", "lines", "result",
+        "eligible": { sku: positions },
+        "group_of": { sku: frozenset(skus of its line group) }
+    }
+    """
+    _draft_results.set(draft_order_id, entry)
+
+
+def _group_maps(lines: list, eligible: list, groups: list) -> dict:
+    group_of = {}
+
+    for group in groups:
+        skus = frozenset(lines[i]["sku"] for i in group)
+        for sku in skus:
+            group_of[sku] = skus
+
+    return {
+        "eligible": {line["sku"]: positions for line, positions in zip(lines, eligible)},
+        "group_of": group_of
+    }
+
+
+def _changed_skus(old_lines: list, new_lines: list) -> set | None:
+    """
+    SKUs added, removed or changed. None when a SKU appears twice
+    (allocations are reused by SKU).
+    """
+    old_by_sku = {line["sku"]: line for line in old_lines}
+    new_by_sku = {line["sku"]: line for line in new_lines}
+
+    if len(old_by_sku) != len(old_lines) or len(new_by_sku) != len(new_lines):
+        return None
+
+    return {
+        sku for sku in old_by_sku.keys() | new_by_sku.keys()
+        if old_by_sku.get(sku) != new_by_sku.get(sku)
+    }
+
+
+def _evaluate_delta(entry: dict, lines: list, changed_sku: str, index: dict) -> dict | None:
+    """
+    Re-evaluates the line groups touched by one SKU change and
+    reuses the cached allocations of every other line. Returns the
+    updated cache entry (without cart_version), or None when the
+    touched groups are most of the cart.
+
+    Only promotions indexed under the changed line's SKU, category
+    or line can change; a line group containing none of their
+    lines (nor the changed one) keeps its eligibility and its
+    members, so its allocations are still valid.
+    """
+    rules = index["rules"]
+    old_eligible = entry["eligible"]
+    group_of = entry["group_of"]
+
+    new_skus = {line["sku"] for line in lines}
+
+    # Promotions the change can touch (scope or bundle trigger)
+    affected = frozenset().union(*(
+        _line_keys_positions(line, index)
+        for line in entry["lines"] + lines
+        if line["sku"] == changed_sku
+    ))
+
+    seeds = {changed_sku}
+    seeds.update(
+        sku for sku, positions in old_eligible.items()
+        if not affected.isdisjoint(positions)
+    )
+
+    # Bundles the change triggers / untriggers
+    for position in affected:
+        if rules[position].kind == "bundle":
+            seeds.update(rules[position].reward_skus & new_skus)
+
+    resolve = set()
+
+    for sku in seeds:
+        resolve |= group_of.get(sku, {sku})
+
+    resolve &= new_skus
+
+    if len(resolve) > PROMOTION_INCREMENTAL_MAX_SHARE * len(lines):
+        return None
+
+    subset = [line for line in lines if line["sku"] in resolve]
+    partial, eligible, groups = _evaluate(subset, index, cart_skus=new_skus)
+
+    allocations = {
+        allocation["sku"]: allocation
+        for allocation in entry["result"]["lines"]
+    }
+    allocations.update({
+        allocation["sku"]: allocation
+        for allocation in partial["lines"]
+    })
+
+    # Untouched groups keep their maps, touched ones are replaced
+    maps = {
+        "eligible": {
+            sku: positions for sku, positions in old_eligible.items()
+            if sku in new_skus and sku not in resolve
+        },
+        "group_of": {
+            sku: group for sku, group in group_of.items()
+            if sku in new_skus and sku not in resolve
+        }
+    }
+
+    for name, values in _group_maps(subset, eligible, groups).items():
+        maps[name].update(values)
+
+    return {
+        "promotion_version": index["version"],
+        "lines": lines,
+        "result": _cart_result(
+            [dict(allocations[line["sku"]]) for line in lines],
+            index
+        ),
+        **maps
+    }
+
+
+def _cart_result(line_allocations: list, index: dict) -> dict:
+    """
+    evaluate_cart's result rebuilt from per-line allocations
+    (totals summed in integer cents).
+    """
+    totals = {}
+
+    for allocation in line_allocations:
+        if allocation["promotion_id"] is not None:
+            totals[allocation["promotion_id"]] = (
+                totals.get(allocation["promotion_id"], 0) + to_cents(allocation["discount_amount"])
+            )
+
+    rules = index["rules"]
+    position_by_id = index["position_by_id"]
+
+    return {
+        "lines": line_allocations,
+        "applied": [
+            {
+                "promotion_id": promotion_id,
+                "name": rules[position_by_id[promotion_id]].name,
+                "discount": from_cents(totals[promotion_id])
+            }
+            for promotion_id in sorted(totals, key=position_by_id.get)
+        ],
+        "total_discount": from_cents(sum(totals.values()))
+    }
+
+
+def _verify_incremental(draft_order_id: str, result: dict, lines: list, index: dict) -> dict:
+    full = evaluate_cart(lines, index)
+
+    if full == result:
+        metrics.increment("promotions.verify.match")
+        return result
+
+    metrics.increment("promotions.verify.mismatch")
+    logging.warning(
+        f"⚠️ Incremental promotions mismatch for draft {draft_order_id}: "
+        f"{result['total_discount']} vs full {full['total_discount']}"
+    )
+
+    return full
+
+
+def calculate_promotions(order: dict, promotion_index: dict) -> Dict[str, dict]:
+    """
+    evaluate_cart over order lines (line_id = order line,
+    line_id_ref = product line).
+
     Returns:
     {
         line_id: {
@@ -11,163 +651,467 @@ def calculate_promotions(order: dict, promotions: List[dict]) -> Dict[str, dict]
         }
     }
     """
+    order_lines = order["lines"]
 
-    best_discounts = {}
+    result = evaluate_cart(
+        [
+            {
+                "sku": line["sku"],
+                "category_id": line.get("category_id"),
+                "line_id": line.get("line_id_ref"),
+                "quantity": line["quantity"],
+                "unit_price": line["unit_price"]
+            }
+            for line in order_lines
+        ],
+        promotion_index
+    )
 
-    for promo in promotions:
-        promo_result = _evaluate_promotion(order, promo)
+    return {
+        line["line_id"]: {
+            "promotion_id": allocation["promotion_id"],
+            "discount_amount": allocation["discount_amount"]
+        }
+        for line, allocation in zip(order_lines, result["lines"])
+        if allocation["discount_amount"] > 0
+    }
 
-        for line_id, result in promo_result.items():
 
-            current_best = best_discounts.get(line_id)
+def _line_eligible(rule: PromotionRule, line: dict, cart_skus: set) -> bool:
 
-            if not current_best:
-                best_discounts[line_id] = result
-            else:
-                if result["discount_amount"] > current_best["discount_amount"]:
-                    best_discounts[line_id] = result
+    # Only percentage rewards are implemented
+    if rule.reward_type != "percentage":
+        return False
 
-    return best_discounts
+    if rule.kind == "percentage":
+        if rule.scope == "category":
+            return line.get("category_id") in rule.scope_ids
+        if rule.scope == "line":
+            return line.get("line_id") in rule.scope_ids
+        return line["sku"] in rule.scope_ids
 
+    if rule.kind == "buy_x_get_y":
+        return line["sku"] in rule.product_skus
 
-# ===============================
-# Promotion Dispatcher
-# ===============================
+    if rule.kind == "bundle":
+        return line["sku"] in rule.reward_skus and not rule.trigger_skus.isdisjoint(cart_skus)
 
-def _evaluate_promotion(order: dict, promo: dict) -> Dict[str, dict]:
+    return False
 
-    promo_type = promo["promotion_type"]
 
-    if promo_type == "percentage":
-        return _evaluate_percentage(order, promo)
+def _line_keys_positions(line: dict, index: dict) -> frozenset:
+    """
+    Every promotion indexed under the line's SKU, category or line.
+    """
+    return (
+        index["by_sku"].get(line["sku"], frozenset())
+        | index["by_reward_sku"].get(line["sku"], frozenset())
+        | index["by_category"].get(line.get("category_id"), frozenset())
+        | index["by_line"].get(line.get("line_id"), frozenset())
+    )
 
-    if promo_type == "buy_x_get_y":
-        return _evaluate_buy_x_get_y(order, promo)
 
-    if promo_type == "bundle":
-        return _evaluate_bundle(order, promo)
+def _eligible_positions(lines: list, index: dict, cart_skus: set | None = None) -> list:
+    """
+    Per line, the positions (priority order) of the promotions
+    that can discount it, from the inverted index.
+    """
+    rules = index["rules"]
 
-    return {}
+    if cart_skus is None:
+        cart_skus = {line["sku"] for line in lines}
 
-def _evaluate_percentage(order: dict, promo: dict) -> Dict[str, dict]:
+    eligible = []
 
-    rules = promo["rules"]
-    reward = promo["reward"]
-    percent = reward["value"]
+    for line in lines:
+        eligible.append(sorted(
+            position for position in _line_keys_positions(line, index)
+            if _line_eligible(rules[position], line, cart_skus)
+        ))
 
-    discounts = {}
+    return eligible
 
-    for line in order["lines"]:
 
-        if not _line_matches_scope(line, rules):
-            continue
+def _rule_discounts(rule: PromotionRule, lines: list, members) -> Dict[int, float]:
+    """
+    Uncapped discount per member line (positions in lines) when
+    exactly these lines take the promotion.
+    """
+    if rule.kind == "buy_x_get_y":
+
+        runs = [
+            (lines[i]["unit_price"], lines[i]["quantity"], i)
+            for i in sorted(members)
+        ]
+
+        total_units = sum(quantity for _, quantity, _ in runs)
+        reward_units = (
+            total_units // (rule.buy_quantity + rule.reward_quantity)
+        ) * rule.reward_quantity
+
+        discounts = dict.fromkeys(sorted(members), 0.0)
+
+        for i, unit_price, units in allocate_cheapest_units(runs, reward_units):
+            discounts[i] += unit_price * units * rule.reward_factor
+
+        return discounts
+
+    # Sorted: sums must not depend on set order (incremental == full)
+    return {
+        i: lines[i]["quantity"] * lines[i]["unit_price"] * rule.reward_factor
+        for i in sorted(members)
+    }
+
 
-        subtotal = line["quantity"] * line["unit_price"]
-        discount = round(subtotal * percent / 100, 2)
+def _rule_value(rule: PromotionRule, lines: list, members) -> float:
 
-        if discount <= 0:
+    if not members:
+        return 0.0
+
+    value = sum(_rule_discounts(rule, lines, members).values())
+
+    if rule.max_discount_cap:
+        value = min(value, rule.max_discount_cap)
+
+    return value
+
+
+def _assign(lines: list, eligible: list, rules: tuple, full_members: dict, groups: list) -> Dict[int, set]:
+    """
+    Line → promotion assignment. Returns { position: set(line indexes) }.
+
+    1. Each line takes the promotion giving it the most when every
+       eligible line takes it (exact when nothing is capped and
+       there is no buy_x_get_y).
+    2. Otherwise lines sharing promotions are solved as independent
+       groups: exhaustively when a group has at most
+       PROMOTION_EXACT_ASSIGNMENTS assignments, else by moving one
+       or two lines at a time while the cart total improves.
+
+    full_members: { position: every eligible line }
+    groups: lines connected through shared promotions (_line_groups)
+    """
+    shares = {
+        position: _rule_discounts(rules[position], lines, members)
+        for position, members in full_members.items()
+    }
+
+    assignment = {}
+
+    for i, positions in enumerate(eligible):
+        if positions:
+            # Positions are in priority order: max() keeps the first on ties
+            assignment[i] = max(positions, key=lambda position: shares[position][i])
+
+    def competing(group):
+        return any(
+            rules[position].kind == "buy_x_get_y" or rules[position].max_discount_cap
+            for i in group
+            for position in eligible[i]
+        )
+
+    for group in groups:
+        if competing(group):
+            _improve_group(group, lines, eligible, rules, shares, assignment)
+
+    members = {}
+
+    for i, position in assignment.items():
+        members.setdefault(position, set()).add(i)
+
+    return members
+
+
+def _line_groups(eligible: list, full_members: dict) -> list:
+    """
+    Lines connected through shared promotions (independent subproblems).
+    """
+    groups = []
+    seen = set()
+
+    for start, positions in enumerate(eligible):
+
+        if start in seen or not positions:
             continue
 
-        discounts[line["line_id"]] = {
-            "promotion_id": promo["promotion_id"],
-            "discount_amount": discount
+        group = []
+        pending = [start]
+        seen.add(start)
+
+        while pending:
+            i = pending.pop()
+            group.append(i)
+
+            for position in eligible[i]:
+                for j in full_members[position]:
+                    if j not in seen:
+                        seen.add(j)
+                        pending.append(j)
+
+        groups.append(sorted(group))
+
+    return groups
+
+
+class _GroupState:
+    """
+    Members and value of every promotion of a line group under the
+    current assignment. Additive promotions (percentage, bundle) keep
+    a running uncapped sum, so evaluating a move is O(1) for them;
+    buy_x_get_y is recomputed over its members.
+    """
+
+    def __init__(self, group: list, lines: list, rules: tuple, shares: dict, assignment: dict):
+        self.lines = lines
+        self.rules = rules
+        self.shares = shares
+        self.assignment = assignment
+        self.members = {}
+        self.raw = {}
+        self.values = {}
+
+        for i in group:
+            self.members.setdefault(assignment[i], set()).add(i)
+
+        for position, line_set in self.members.items():
+            self.raw[position] = self._raw(position, line_set)
+            self.values[position] = self._cap(position, self.raw[position])
+
+    def _raw(self, position: int, line_set) -> float:
+        rule = self.rules[position]
+
+        if rule.kind == "buy_x_get_y":
+            return sum(_rule_discounts(rule, self.lines, line_set).values()) if line_set else 0.0
+
+        share = self.shares[position]
+        return sum(share[i] for i in sorted(line_set))
+
+    def _cap(self, position: int, raw: float) -> float:
+        cap = self.rules[position].max_discount_cap
+        return min(raw, cap) if cap else raw
+
+    def total(self) -> float:
+        return sum(self.values.values())
+
+    def _moved(self, position: int, out_line=None, in_line=None) -> tuple:
+        """
+        (raw, value) of a promotion after one line leaves / joins it.
+        """
+        if self.rules[position].kind == "buy_x_get_y":
+            line_set = set(self.members.get(position, ()))
+            line_set.discard(out_line)
+            if in_line is not None:
+                line_set.add(in_line)
+            raw = self._raw(position, line_set)
+        else:
+            share = self.shares[position]
+            raw = self.raw.get(position, 0.0)
+            if out_line is not None:
+                raw -= share[out_line]
+            if in_line is not None:
+                raw += share[in_line]
+
+        return raw, self._cap(position, raw)
+
+    def evaluate_single(self, i: int, position: int) -> tuple:
+        """
+        Fast path of evaluate() for one line.
+        """
+        current = self.assignment[i]
+
+        out_raw, out_value = self._moved(current, out_line=i)
+        in_raw, in_value = self._moved(position, in_line=i)
+
+        gain = (
+            out_value - self.values[current]
+            + in_value - self.values.get(position, 0.0)
+        )
+
+        return gain, {
+            current: ((i,), (), out_raw, out_value),
+            position: ((), (i,), in_raw, in_value)
         }
 
-    return discounts
+    def evaluate(self, moves) -> tuple:
+        """
+        (gain, changes) of moving lines: moves = ((line, position), ...)
+        """
+        added = {}
+        removed = {}
 
-def _line_matches_scope(line: dict, rules: dict) -> bool:
+        for i, position in moves:
+            removed.setdefault(self.assignment[i], []).append(i)
+            added.setdefault(position, []).append(i)
 
-    scope = rules.get("scope")
+        changes = {}
+        gain = 0.0
 
-    if scope == "line":
-        return line["line_id_ref"] in rules.get("line_ids", [])
+        for position in removed.keys() | added.keys():
+            out_lines = removed.get(position, [])
+            in_lines = added.get(position, [])
 
-    if scope == "category":
-        return line["category_id"] in rules.get("category_ids", [])
+            if self.rules[position].kind == "buy_x_get_y":
+                line_set = self.members.get(position, set())
+                raw = self._raw(position, (line_set - set(out_lines)) | set(in_lines))
+            else:
+                share = self.shares[position]
+                raw = (
+                    self.raw.get(position, 0.0)
+                    - sum(share[i] for i in out_lines)
+                    + sum(share[i] for i in in_lines)
+                )
 
-    if scope == "product":
-        return line["sku"] in rules.get("product_skus", [])
+            value = self._cap(position, raw)
+            gain += value - self.values.get(position, 0.0)
+            changes[position] = (out_lines, in_lines, raw, value)
 
-    return False
+        return gain, changes
 
-def _evaluate_buy_x_get_y(order: dict, promo: dict) -> Dict[str, dict]:
+    def apply(self, moves, changes: dict):
+        for position, (out_lines, in_lines, raw, value) in changes.items():
+            line_set = self.members.setdefault(position, set())
+            line_set.difference_update(out_lines)
+            line_set.update(in_lines)
+            self.raw[position] = raw
+            self.values[position] = value
 
-    rules = promo["rules"]
-    reward = promo["reward"]
+        for i, position in moves:
+            self.assignment[i] = position
 
-    buy_qty = rules["buy_quantity"]
-    reward_qty = rules["reward_quantity"]
-    percent = reward["value"]
 
-    eligible_units = []
+def _improve_group(group: list, lines: list, eligible: list, rules: tuple, shares: dict, assignment: dict):
 
-    for line in order["lines"]:
-        if line["sku"] in rules["product_skus"]:
-            for _ in range(line["quantity"]):
-                eligible_units.append({
-                    "line_id": line["line_id"],
-                    "unit_price": line["unit_price"]
-                })
+    free = [i for i in group if len(eligible[i]) > 1]
 
-    total_required = buy_qty + reward_qty
-    total_units = len(eligible_units)
+    if not free:
+        return
 
-    if total_units < total_required:
-        return {}
+    space = 1
+    for i in free:
+        space *= len(eligible[i])
 
-    times_applicable = total_units // total_required
-    total_reward_units = times_applicable * reward_qty
+    # Exhaustive: candidates are in priority order, so the first
+    # best assignment found prefers higher priority promotions
+    if space <= PROMOTION_EXACT_ASSIGNMENTS:
 
-    eligible_units.sort(key=lambda x: x["unit_price"])
+        best_value = -1.0
+        best = None
 
-    discounted_units = eligible_units[:total_reward_units]
+        for choice in itertools.product(*(eligible[i] for i in free)):
+            assignment.update(zip(free, choice))
+            value = _GroupState(group, lines, rules, shares, assignment).total()
 
-    discounts = {}
+            if value > best_value + 1e-9:
+                best_value = value
+                best = choice
 
-    for unit in discounted_units:
-        discount_amount = round(unit["unit_price"] * percent / 100, 2)
+        assignment.update(zip(free, best))
+        return
 
-        if unit["line_id"] not in discounts:
-            discounts[unit["line_id"]] = {
-                "promotion_id": promo["promotion_id"],
-                "discount_amount": 0
-            }
+    # Local search: move one line, or two lines together (joint
+    # buy_x_get_y thresholds, swaps under caps), while the total improves
+    state = _GroupState(group, lines, rules, shares, assignment)
 
-        discounts[unit["line_id"]]["discount_amount"] += discount_amount
+    def single_moves():
+        for i in free:
+            for position in eligible[i]:
+                if position != assignment[i]:
+                    yield ((i, position),)
 
-    return discounts
+    def pair_moves():
+        # Quadratic: small groups only, lines sharing a promotion
+        if len(free) > PROMOTION_PAIR_MOVE_LINES:
+            return
 
-def _evaluate_bundle(order: dict, promo: dict) -> Dict[str, dict]:
+        for a, i in enumerate(free):
+            for j in free[a + 1:]:
+                if set(eligible[i]).isdisjoint(eligible[j]):
+                    continue
+                for position_i in eligible[i]:
+                    for position_j in eligible[j]:
+                        if position_i != assignment[i] and position_j != assignment[j]:
+                            yield ((i, position_i), (j, position_j))
 
-    rules = promo["rules"]
-    reward = promo["reward"]
-    percent = reward["value"]
+    def improve(candidates) -> bool:
+        moved = False
 
-    trigger_skus = rules["trigger_products"]
-    reward_skus = rules["reward_products"]
+        for moves in candidates:
 
-    has_trigger = any(
-        line["sku"] in trigger_skus
-        for line in order["lines"]
-    )
+            # A previous move this pass may have made it a no-op
+            if any(assignment[i] == position for i, position in moves):
+                continue
+
+            if len(moves) == 1:
+                gain, changes = state.evaluate_single(*moves[0])
+            else:
+                gain, changes = state.evaluate(moves)
+
+            if gain <= 1e-9:
+                continue
+
+            state.apply(moves, changes)
+            moved = True
+
+        return moved
 
-    if not has_trigger:
+    # Pairs only once single moves stop improving
+    for _ in range(PROMOTION_MAX_PASSES):
+        if not improve(single_moves()) and not improve(pair_moves()):
+            break
+
+
+def _allocate_rule(rule: PromotionRule, lines: list, members) -> Dict[int, float]:
+    """
+    Final per-line discounts (2 decimals) of a promotion over its
+    assigned lines. A capped total is spread proportionally; the
+    rounding residual goes to the largest line so lines add up to
+    the promotion total. Rounding is done in integer cents.
+    """
+    discounts = _rule_discounts(rule, lines, members)
+
+    raw_total = sum(discounts.values())
+
+    if raw_total <= 0:
         return {}
 
-    discounts = {}
+    total = to_cents(_rule_value(rule, lines, members))
+    scale = from_cents(total) / raw_total
 
-    for line in order["lines"]:
-        if line["sku"] in reward_skus:
+    cents = {i: to_cents(discount * scale) for i, discount in discounts.items()}
 
-            subtotal = line["quantity"] * line["unit_price"]
-            discount = round(subtotal * percent / 100, 2)
+    residual = total - sum(cents.values())
 
-            if discount <= 0:
-                continue
+    if residual:
+        largest = max(sorted(cents), key=lambda i: cents[i])
+        cents[largest] += residual
 
-            discounts[line["line_id"]] = {
-                "promotion_id": promo["promotion_id"],
-                "discount_amount": discount
-            }
+    return {i: from_cents(amount) for i, amount in cents.items()}
+
+
+def allocate_cheapest_units(runs: list, reward_units: int) -> list:
+    """
+    Allocates reward units to the cheapest units first, working on
+    (unit_price, quantity) runs instead of one entry per unit.
+
+    runs: [(unit_price, quantity, key)]
+    Returns: [(key, unit_price, units)] in allocation order.
+
+    O(lines log lines), independent of the quantities. Ties keep
+    the runs order (same as a stable sort of the expanded units).
+    """
+
+    allocations = []
+    remaining = reward_units
+
+    for unit_price, quantity, key in sorted(runs, key=lambda run: run[0]):
+
+        if remaining <= 0:
+            break
+
+        units = min(quantity, remaining)
+
+        if units > 0:
+            allocations.append((key, unit_price, units))
+            remaining -= units
 
-    return discounts
+    return allocations
@@ -0,0 +1,173 @@
+"""
+Offline prompt budget check.
+
+Renders every LLM prompt against fixtures/catalog.json and exits
+with status 1 when the input token count of any prompt grows past
+its budget, so catalog growth and prompt edits cannot silently
+double the latency bill.
+
+    python prompt_budget.py
+
+Budgets are deliberately ~20% above the current size: raise them
+consciously in the same change that grows a prompt.
+"""
+import json
+import os
+import sys
+
+from ai import (
+    build_intent_messages,
+    build_extraction_messages,
+    build_fused_messages,
+    build_response_messages,
+    build_price_context
+)
+from history import compact_history
+from utils import estimate_tokens
+
+FIXTURE_CATALOG = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)),
+    "fixtures",
+    "catalog.json"
+)
+
+# Max input tokens per rendered prompt
+PROMPT_BUDGETS = {
+    "intent": 1150,
+    "extraction": 1550,
+    "fused": 2650,
+    "response.ask_prices": 1650,
+    "response.product_info": 4200,
+}
+
+# Tokens the chat format adds around every message
+MESSAGE_OVERHEAD_TOKENS = 4
+
+SAMPLE_MESSAGE = "quiero 2 shampoo argan de 500 y una mascarilla keratina"
+
+SAMPLE_CONTEXT = {"product_name": "shampoo argan"}
+
+SAMPLE_HISTORY = [
+    {"role": "user", "content": "hola, quiero hacer un pedido"},
+    {"role": "assistant", "content": "Perfecto 👍 Empecemos tu pedido."},
+    {"role": "user", "content": "2 AVY-ARG-SHP-250"},
+    {
+        "role": "assistant",
+        "content": (
+            "✅ Listo, ya se agregó a tu pedido.\n\n"
+            "🛒 *Tu pedido actual:*\n\n"
+            "1. 2x *Shampoo Argán Avyna 250 ml*\n"
+            "   $199.00 c/u  |  Total: $398.00\n\n"
+            "-----------------------------\n"
+            "Subtotal: $398.00\n\n*Total: $398.00*\n"
+        )
+    },
+    {"role": "user", "content": "cuánto cuesta el de 500?"},
+    {
+        "role": "assistant",
+        "content": "El precio de *Shampoo Argán Avyna 500 ml* es $309 MXN 💰"
+    },
+]
+
+SAMPLE_FLOW_PROMPT = (
+    "Eres un asistente de ventas de un distribuidor de productos "
+    "profesionales para salón. Responde en español de México, breve "
+    "y amable, usando SOLO los datos proporcionados."
+)
+
+
+def count_message_tokens(messages: list) -> int:
+    return sum(
+        estimate_tokens(message["content"]) + MESSAGE_OVERHEAD_TOKENS
+        for message in messages
+    )
+
+
+def render_prompts(products: list) -> dict:
+    """
+    Renders every prompt the webhook can send, keyed like PROMPT_BUDGETS.
+    """
+    product_catalog = [
+        {"sku": p["sku"], "name": p["product"]}
+        for p in products
+    ]
+
+    # The webhook always sends compacted history
+    history = compact_history(SAMPLE_HISTORY, cart_id="draft-fixture")
+
+    # Same shape as db.get_detailed_products()
+    detailed_products = [
+        {
+            "name": p["product"],
+            "sku": p.get("sku"),
+            "line": p.get("line"),
+            "category": p.get("category"),
+            "description": p.get("description"),
+            "size": p.get("size"),
+            "price": p.get("price")
+        }
+        for p in products
+    ]
+
+    def response(context_data):
+        return build_response_messages(
+            base_system_prompt=SAMPLE_FLOW_PROMPT,
+            user_message=SAMPLE_MESSAGE,
+            context_data=context_data,
+            greeting_type="continuation",
+            time_of_day="afternoon",
+            distributor_name="Salón Fixture"
+        )
+
+    return {
+        "intent": build_intent_messages(
+            SAMPLE_MESSAGE,
+            SAMPLE_CONTEXT,
+            history
+        ),
+        "extraction": build_extraction_messages(
+            SAMPLE_MESSAGE,
+            product_catalog
+        ),
+        "fused": build_fused_messages(
+            SAMPLE_MESSAGE,
+            product_catalog,
+            SAMPLE_CONTEXT,
+            history
+        ),
+        "response.ask_prices": response(build_price_context(products)),
+        "response.product_info": response(
+            json.dumps({"products": detailed_products})
+        ),
+    }
+
+
+def check_budgets(products: list) -> list:
+    """
+    Returns a list of (prompt, tokens, budget, ok) rows.
+    """
+    rows = []
+
+    for name, messages in render_prompts(products).items():
+        tokens = count_message_tokens(messages)
+        budget = PROMPT_BUDGETS[name]
+        rows.append((name, tokens, budget, tokens <= budget))
+
+    return rows
+
+
+def main() -> int:
+    with open(FIXTURE_CATALOG, encoding="utf-8") as f:
+        products = json.load(f)
+
+    rows = check_budgets(products)
+
+    for name, tokens, budget, ok in rows:
+        status = "OK  " if ok else "OVER"
+        print(f"{status} {name:<24} {tokens:>6} / {budget} tokens")
+
+    return 0 if all(ok for *_, ok in rows) else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
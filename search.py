@@ -0,0 +1,254 @@
+import os
+import threading
+import zlib
+from difflib import SequenceMatcher
+
+import numpy as np
+
+from catalog import get_catalog
+from order_parser import build_parser_index
+from presentations import build_family_index
+from utils import normalize_text
+
+# ==========================================================
+# Catalog search index
+#
+# Built once per catalog version (not per query):
+# - pre-normalized product names
+# - character trigram → product positions (inverted index)
+# - hashed trigram vectors of every name (NumPy matrix,
+#   L2-normalized) so a query is scored against the whole
+#   catalog with ONE matrix-vector product
+# - product families with their presentations by size
+# - the order-line parser index (SKUs, name tokens) and the
+#   set of valid SKUs, so cart messages don't re-tokenize the
+#   catalog
+# ==========================================================
+
+# Max candidates confirmed with SequenceMatcher per query
+SEARCH_MAX_CANDIDATES = 64
+
+FUZZY_MATCH_THRESHOLD = 0.75
+
+# Hashed trigram dimensions (n_products × dim float32 matrix)
+SEARCH_VECTOR_DIM = int(os.getenv("SEARCH_VECTOR_DIM", "512"))
+
+# Min cosine similarity for search_products results
+SEARCH_MIN_SIMILARITY = float(os.getenv("SEARCH_MIN_SIMILARITY", "0.3"))
+
+_lock = threading.Lock()
+_index = None
+
+
+def trigrams(text: str) -> set:
+    return {text[i:i + 3] for i in range(len(text) - 2)}
+
+
+def _trigram_bucket(gram: str) -> int:
+    # crc32, not hash(): stable across processes
+    return zlib.crc32(gram.encode("utf-8")) % SEARCH_VECTOR_DIM
+
+
+def vectorize(text: str) -> np.ndarray:
+    """
+    L2-normalized hashed trigram vector of a normalized text.
+    """
+    vector = np.zeros(SEARCH_VECTOR_DIM, dtype=np.float32)
+
+    for gram in trigrams(f" {text} "):
+        vector[_trigram_bucket(gram)] += 1.0
+
+    norm = np.linalg.norm(vector)
+
+    return vector / norm if norm else vector
+
+
+def _vectorize_all(names: list) -> np.ndarray:
+    matrix = np.zeros((len(names), SEARCH_VECTOR_DIM), dtype=np.float32)
+
+    buckets = {}
+    rows = []
+    columns = []
+
+    for row, name in enumerate(names):
+        for gram in trigrams(f" {name} "):
+            if gram not in buckets:
+                buckets[gram] = _trigram_bucket(gram)
+            rows.append(row)
+            columns.append(buckets[gram])
+
+    np.add.at(matrix, (rows, columns), 1.0)
+
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+
+    return matrix / norms
+
+
+def build_search_index(products: list, version: str | None = None) -> dict:
+    """
+    products: catalog rows ({ "product", "sku", "price", ... })
+    """
+    names = [normalize_text(p.get("product") or "") for p in products]
+
+    postings = {}
+
+    for position, name in enumerate(names):
+        for gram in trigrams(name):
+            postings.setdefault(gram, set()).add(position)
+
+    return {
+        "version": version,
+        "products": products,
+        "names": names,
+        "exact": {name: position for position, name in enumerate(names)},
+        "postings": postings,
+        "vectors": _vectorize_all(names),
+        "families": build_family_index(products),
+        "parser": build_parser_index([
+            {"sku": p["sku"], "name": p.get("product")}
+            for p in products
+        ]),
+        "valid_skus": {p["sku"] for p in products if p.get("sku")}
+    }
+
+
+def get_search_index() -> dict:
+    """
+    Index of the current in-memory catalog, rebuilt only when
+    the catalog version changes.
+    """
+    global _index
+
+    snapshot = get_catalog()
+
+    with _lock:
+        if _index is None or _index["version"] != snapshot["version"]:
+            _index = build_search_index(
+                snapshot["products"],
+                snapshot["version"]
+            )
+
+        return _index
+
+
+def _contained(index: dict, normalized_query: str, grams: set) -> list:
+    """
+    Positions of names containing the query: intersect the
+    postings of its trigrams (rarest first), then verify.
+    """
+    postings = sorted(
+        (index["postings"].get(gram, set()) for gram in grams),
+        key=len
+    )
+
+    candidates = set(postings[0]).intersection(*postings[1:])
+
+    return sorted(
+        position for position in candidates
+        if normalized_query in index["names"][position]
+    )
+
+
+def top_k(scores: np.ndarray, k: int, threshold: float) -> list:
+    """
+    Positions of the k best scores >= threshold, best first.
+    """
+    candidates = np.flatnonzero(scores >= threshold)
+
+    if len(candidates) > k:
+        best = np.argpartition(scores[candidates], -k)[-k:]
+        candidates = candidates[best]
+
+    # Ties keep catalog order
+    order = np.lexsort((candidates, -scores[candidates]))
+
+    return candidates[order].tolist()
+
+
+def score_query(index: dict, normalized_query: str) -> np.ndarray:
+    """
+    Cosine similarity of the query against every product name.
+    """
+    return index["vectors"] @ vectorize(normalized_query)
+
+
+def find_matches(index: dict, query: str) -> list:
+    """
+    Same semantics as the original linear matcher:
+    1. exact normalized name → that product only
+    2. names containing the query
+    3. otherwise names with SequenceMatcher ratio > threshold,
+       confirmed only on the best vector-scored candidates
+    """
+    normalized_query = normalize_text(query)
+
+    if not normalized_query or not index["products"]:
+        return []
+
+    position = index["exact"].get(normalized_query)
+    if position is not None:
+        return [index["products"][position]]
+
+    grams = trigrams(normalized_query)
+
+    # Too short for trigrams: containment over the pre-normalized names
+    if not grams:
+        return [
+            index["products"][position]
+            for position, name in enumerate(index["names"])
+            if normalized_query in name
+        ]
+
+    contained = _contained(index, normalized_query, grams)
+
+    if contained:
+        return [index["products"][position] for position in contained]
+
+    candidates = top_k(
+        score_query(index, normalized_query),
+        SEARCH_MAX_CANDIDATES,
+        threshold=0.0
+    )
+
+    fuzzy = [
+        position for position in candidates
+        if SequenceMatcher(
+            None,
+            normalized_query,
+            index["names"][position]
+        ).ratio() > FUZZY_MATCH_THRESHOLD
+    ]
+
+    return [index["products"][position] for position in sorted(fuzzy)]
+
+
+# ==========================================================
+# Shared search API (flows, orders, prompt builders)
+# ==========================================================
+def search(index: dict, query: str, k: int = 5, threshold: float = SEARCH_MIN_SIMILARITY) -> list:
+    """
+    Top-k products by trigram cosine similarity:
+    [{ "product": {...}, "score": float }], best first.
+    """
+    normalized_query = normalize_text(query)
+
+    if not normalized_query or not index["products"]:
+        return []
+
+    scores = score_query(index, normalized_query)
+
+    return [
+        {
+            "product": index["products"][position],
+            "score": round(float(scores[position]), 4)
+        }
+        for position in top_k(scores, k, threshold)
+    ]
+
+
+def search_products(query: str, k: int = 5, threshold: float = SEARCH_MIN_SIMILARITY) -> list:
+    """
+    search() over the current in-memory catalog.
+    """
+    return search(get_search_index(), query, k, threshold)
@@ -0,0 +1,318 @@
+import json
+import logging
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from db import (
+    ORDER_LINES_ID_BATCH,
+    get_active_promotions,
+    get_order_lines_for_orders,
+    get_orders_page,
+    get_products_by_ids
+)
+from promotions import build_promotion_index, compile_promotions, evaluate_cart
+
+# ==========================================================
+# Promotion what-if simulation
+#
+# Replays past orders against a proposed promotion set with the
+# unified engine (promotions.evaluate_cart) and reports what that
+# set would have discounted: aggregate discount, orders affected,
+# per-SKU and per-promotion impact.
+#
+# Orders are read in keyset pages (order_id > last seen) and
+# each page is evaluated in a worker process; the parent only
+# fetches pages and merges partial aggregates. Workers compile
+# the promotion set once, in their initializer.
+#
+#   python simulation.py proposed.json 2026-09-01 2026-10-01 [--with-active]
+#   # proposed.json: list of promotion rows (promotions table shape)
+# ==========================================================
+
+USAGE = (
+    "python simulation.py proposed.json <since> <until> [--with-active]\n"
+    "proposed.json: list of promotion rows (promotions table shape)"
+)
+
+SIMULATION_PAGE_SIZE = int(os.getenv("SIMULATION_PAGE_SIZE", "500"))
+
+# 1 → evaluate in-process (no pool)
+SIMULATION_WORKERS = int(os.getenv("SIMULATION_WORKERS", str(os.cpu_count() or 1)))
+
+# Pages submitted ahead of the slowest worker
+SIMULATION_MAX_PENDING_PAGES = 2
+
+SIMULATION_TOP_SKUS = int(os.getenv("SIMULATION_TOP_SKUS", "50"))
+
+_worker_index = None
+
+
+# ==========================================================
+# Order stream
+# ==========================================================
+def iter_order_pages(since: str, until: str, page_size: int = SIMULATION_PAGE_SIZE):
+    """
+    Yields pages of orders created in [since, until):
+    [{ "order_id", "lines": [{ sku, category_id, line_id,
+       quantity, unit_price, discount_amount }] }]
+    Product metadata is fetched once per product across pages.
+    """
+    products = {}
+    after_order_id = None
+
+    while True:
+        orders = get_orders_page(since, until, after_order_id, page_size)
+
+        if not orders:
+            return
+
+        order_ids = [order["order_id"] for order in orders]
+        lines = get_order_lines_for_orders(order_ids)
+
+        missing = list({line["product_id"] for line in lines} - products.keys())
+
+        for start in range(0, len(missing), ORDER_LINES_ID_BATCH):
+            for product in get_products_by_ids(missing[start:start + ORDER_LINES_ID_BATCH]):
+                products[product["product_id"]] = product
+
+        lines_by_order = {order_id: [] for order_id in order_ids}
+
+        for line in lines:
+            product = products.get(line["product_id"], {})
+            lines_by_order[line["order_id"]].append({
+                "sku": line["sku"],
+                "category_id": product.get("category_id"),
+                "line_id": product.get("line_id"),
+                "quantity": int(line["quantity"]),
+                "unit_price": float(line["unit_price"]),
+                "discount_amount": float(line.get("discount_amount") or 0)
+            })
+
+        yield [
+            {"order_id": order_id, "lines": lines_by_order[order_id]}
+            for order_id in order_ids
+        ]
+
+        if len(orders) < page_size:
+            return
+
+        after_order_id = order_ids[-1]
+
+
+# ==========================================================
+# Page evaluation (runs in workers)
+# ==========================================================
+def _init_worker(promotion_rows: list):
+    global _worker_index
+    _worker_index = build_promotion_index(compile_promotions(promotion_rows))
+
+
+def empty_summary() -> dict:
+    return {
+        "orders": 0,
+        "orders_affected": 0,
+        "gross_sales": 0.0,
+        "recorded_discount": 0.0,
+        "discount": 0.0,
+        "by_sku": {},
+        "by_promotion": {}
+    }
+
+
+def simulate_page(orders: list, promotion_index: dict | None = None) -> dict:
+    """
+    Partial summary of one page of orders.
+    """
+    index = promotion_index or _worker_index
+    names = {rule.promotion_id: rule.name for rule in index["rules"]}
+
+    summary = empty_summary()
+
+    for order in orders:
+        lines = order["lines"]
+        summary["orders"] += 1
+
+        for line in lines:
+            summary["gross_sales"] += line["quantity"] * line["unit_price"]
+            summary["recorded_discount"] += line["discount_amount"]
+
+        if not lines:
+            continue
+
+        result = evaluate_cart(lines, index)
+
+        if result["total_discount"] <= 0:
+            continue
+
+        summary["orders_affected"] += 1
+        summary["discount"] += result["total_discount"]
+
+        for line, allocation in zip(lines, result["lines"]):
+            if allocation["discount_amount"] <= 0:
+                continue
+
+            impact = summary["by_sku"].setdefault(
+                line["sku"],
+                {"orders": 0, "units": 0, "discount": 0.0}
+            )
+            impact["orders"] += 1
+            impact["units"] += line["quantity"]
+            impact["discount"] += allocation["discount_amount"]
+
+        for applied in result["applied"]:
+            impact = summary["by_promotion"].setdefault(
+                applied["promotion_id"],
+                {"name": names.get(applied["promotion_id"]), "orders": 0, "discount": 0.0}
+            )
+            impact["orders"] += 1
+            impact["discount"] += applied["discount"]
+
+    return summary
+
+
+def merge_summary(total: dict, partial: dict):
+    for key in ["orders", "orders_affected", "gross_sales", "recorded_discount", "discount"]:
+        total[key] += partial[key]
+
+    for group in ["by_sku", "by_promotion"]:
+        for key, impact in partial[group].items():
+            merged = total[group].get(key)
+
+            if merged is None:
+                total[group][key] = dict(impact)
+                continue
+
+            for field, value in impact.items():
+                if field != "name":
+                    merged[field] += value
+
+
+def _report(summary: dict, promotion_count: int, elapsed: float, top_skus: int) -> dict:
+    by_sku = sorted(
+        summary["by_sku"].items(),
+        key=lambda item: (-item[1]["discount"], item[0])
+    )
+    by_promotion = sorted(
+        summary["by_promotion"].items(),
+        key=lambda item: (-item[1]["discount"], item[0])
+    )
+
+    return {
+        "promotions": promotion_count,
+        "orders": summary["orders"],
+        "orders_affected": summary["orders_affected"],
+        "gross_sales": round(summary["gross_sales"], 2),
+        "recorded_discount": round(summary["recorded_discount"], 2),
+        "simulated_discount": round(summary["discount"], 2),
+        "discount_delta": round(summary["discount"] - summary["recorded_discount"], 2),
+        "by_sku": [
+            {
+                "sku": sku,
+                "orders": impact["orders"],
+                "units": impact["units"],
+                "discount": round(impact["discount"], 2)
+            }
+            for sku, impact in by_sku[:top_skus]
+        ],
+        "by_promotion": [
+            {
+                "promotion_id": promotion_id,
+                "name": impact["name"],
+                "orders": impact["orders"],
+                "discount": round(impact["discount"], 2)
+            }
+            for promotion_id, impact in by_promotion
+        ],
+        "elapsed_ms": round(elapsed * 1000, 1),
+        "orders_per_second": round(summary["orders"] / elapsed, 1) if elapsed else None
+    }
+
+
+# ==========================================================
+# Entry point
+# ==========================================================
+def simulate_promotions(
+    promotions: list,
+    since: str,
+    until: str,
+    include_active: bool = False,
+    workers: int = SIMULATION_WORKERS,
+    page_size: int = SIMULATION_PAGE_SIZE,
+    top_skus: int = SIMULATION_TOP_SKUS
+) -> dict:
+    """
+    What the given promotion rows (plus the active set when
+    include_active) would have discounted on the orders created
+    in [since, until). recorded_discount is what those orders
+    actually got, for comparison.
+    """
+    started_at = time.perf_counter()
+
+    rows = (get_active_promotions() if include_active else []) + list(promotions)
+    rules = compile_promotions(rows)
+
+    summary = empty_summary()
+
+    if not rules:
+        logging.warning("⚠️ Simulation without valid promotions")
+        return _report(summary, 0, time.perf_counter() - started_at, top_skus)
+
+    pages = iter_order_pages(since, until, page_size)
+
+    if workers <= 1:
+        index = build_promotion_index(rules)
+        for page in pages:
+            merge_summary(summary, simulate_page(page, index))
+    else:
+        with ProcessPoolExecutor(
+            max_workers=workers,
+            initializer=_init_worker,
+            initargs=(rows,)
+        ) as pool:
+            pending = []
+
+            for page in pages:
+                pending.append(pool.submit(simulate_page, page))
+
+                # Bounded read-ahead: don't buffer the whole month
+                while len(pending) >= workers * SIMULATION_MAX_PENDING_PAGES:
+                    merge_summary(summary, pending.pop(0).result())
+
+            for future in pending:
+                merge_summary(summary, future.result())
+
+    report = _report(summary, len(rules), time.perf_counter() - started_at, top_skus)
+
+    logging.info(
+        f"🧪 Simulated {len(rules)} promotions on {report['orders']} orders: "
+        f"{report['orders_affected']} affected, ${report['simulated_discount']:.2f} "
+        f"discount ({report['orders_per_second']} orders/s)"
+    )
+
+    return report
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+
+    args = [arg for arg in sys.argv[1:] if not arg.startswith("--")]
+
+    if len(args) != 3:
+        print(USAGE)
+        sys.exit(1)
+
+    with open(args[0], encoding="utf-8") as f:
+        proposed = json.load(f)
+
+    print(json.dumps(
+        simulate_promotions(
+            proposed,
+            args[1],
+            args[2],
+            include_active="--with-active" in sys.argv
+        ),
+        indent=2,
+        ensure_ascii=False
+    ))
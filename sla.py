@@ -0,0 +1,90 @@
+import asyncio
+import logging
+import os
+import threading
+import time
+
+import metrics
+
+# ==========================================================
+# Reply SLA timer
+#
+# If no reply has gone out N seconds after an inbound message,
+# a short interim message is sent so the customer does not
+# re-send (which doubles load). The timer is cancelled as soon
+# as the real reply starts going out.
+# ==========================================================
+
+INTERIM_REPLY_SECONDS = float(os.getenv("INTERIM_REPLY_SECONDS", "6"))
+
+INTERIM_REPLY_TEXT = os.getenv(
+    "INTERIM_REPLY_TEXT",
+    "Estoy revisando tu solicitud, dame un momento ⏳"
+)
+
+
+class ReplyTimer:
+    """
+    One timer per inbound message.
+
+    - start(): arms the timer on the running event loop
+    - reply_sent(): thread-safe, call right before the real reply
+    - finish(intent): records breach counters per intent
+    """
+
+    def __init__(
+        self,
+        send,
+        received_at: float | None = None,
+        threshold_seconds: float = INTERIM_REPLY_SECONDS
+    ):
+        self._send = send
+        self.received_at = received_at or time.monotonic()
+        self.threshold_seconds = threshold_seconds
+        self.breached = False
+        self._replied = False
+        self._lock = threading.Lock()
+        self._loop = None
+        self._task = None
+
+    def start(self):
+        if self.threshold_seconds <= 0:
+            return
+
+        self._loop = asyncio.get_running_loop()
+        self._task = self._loop.create_task(self._run())
+
+    async def _run(self):
+        # Measured from message receipt, not from start()
+        elapsed = time.monotonic() - self.received_at
+        await asyncio.sleep(max(self.threshold_seconds - elapsed, 0))
+
+        with self._lock:
+            if self._replied:
+                return
+            self.breached = True
+
+        logging.info("⏳ Reply SLA breached, sending interim message")
+
+        try:
+            await asyncio.to_thread(self._send, INTERIM_REPLY_TEXT)
+        except Exception as e:
+            logging.error(f"❌ Error sending interim message: {e}")
+
+    def reply_sent(self):
+        with self._lock:
+            if self._replied:
+                return
+            self._replied = True
+
+        if self._task and not self._task.done():
+            self._loop.call_soon_threadsafe(self._task.cancel)
+
+    def finish(self, intent: str | None):
+        self.reply_sent()
+
+        intent = intent or "unknown"
+        metrics.increment(f"sla.{intent}.messages")
+
+        if self.breached:
+            metrics.increment(f"sla.{intent}.breached")
@@ -38,3 +38,50 @@ def split_message(text: str, max_length: int = 1500):
     chunks.append(text)
     
     return chunks
+
+
+def stream_chunks(deltas, max_length: int = 1500, min_length: int = 300):
+    """
+    Turns a stream of text deltas into WhatsApp-safe chunks.
+
+    A chunk is emitted as soon as the buffer holds a paragraph
+    break past min_length, so the first part can be sent while
+    the rest is still being generated. Chunks never exceed
+    max_length (same rules as split_message).
+    """
+    buffer = ""
+
+    for delta in deltas:
+        buffer += delta
+
+        while True:
+            split_index = buffer.find("\n\n", min_length)
+
+            if split_index == -1 or split_index > max_length:
+                if len(buffer) <= max_length:
+                    break
+
+                split_index = buffer.rfind("\n", 0, max_length)
+                if split_index == -1:
+                    split_index = max_length
+
+            chunk = buffer[:split_index].strip()
+            buffer = buffer[split_index:].strip()
+
+            if chunk:
+                yield chunk
+
+    if buffer.strip():
+        yield from split_message(buffer.strip(), max_length)
+
+
+# ==========================================================
+# Token estimation
+# ~4 characters per token: stable and dependency free, good
+# enough for budgets (not for billing)
+# ==========================================================
+def estimate_tokens(text: str) -> int:
+    if not text:
+        return 0
+
+    return (len(text) + 3) // 4